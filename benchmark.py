@@ -0,0 +1,302 @@
+"""
+Benchmark das etapas da conciliação com planilhas sintéticas.
+
+    python benchmark.py [--linhas 1000 10000 100000 1000000] [--repeticoes N]
+                        [--saida benchmark_resultados.jsonl] [--sem-memoria]
+
+Gera extrato e sistema no mesmo formato do XLSX do Aspose (cabeçalhos,
+rodapés, linhas de histórico quebradas), mede tempo e pico de memória de
+cada etapa e acrescenta o resultado em um arquivo JSONL. Cada execução é
+comparada com a anterior do mesmo tamanho, para regressões aparecerem.
+"""
+import argparse
+import datetime as dt
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+import xlsxwriter
+
+import conciliacao_v1 as cc
+import layouts
+
+MAX_LINHAS_XLSX = 1048576
+HISTORICOS = ["Pix - Enviado", "Pix - Recebido", "Pagamento de Boleto", "TED Recebida",
+              "Tarifa Pacote de Serviços", "Transferência Enviada", "Depósito Online"]
+VALORES_REPETIDOS = [990, 1250, 5000, 50000]   # centavos; alimentam as chaves duplicadas
+LIMITE_REGRESSAO = 0.20
+MIN_SEGUNDOS_COMPARAR = 0.05   # etapas mais rápidas que isso são só ruído
+
+def _brl(centavos):
+    texto = format(abs(centavos) / 100, ",.2f")
+    return texto.replace(",", "X").replace(".", ",").replace("X", ".")
+
+def gerar_planilhas(linhas, seed=1, duplicados=0.2, deslocados=0.1, quebras=0.02,
+                    so_sistema=0.1, dias=30):
+    """
+    Retorna (extrato_xlsx, sistema_xlsx) em bytes.
+
+    linhas      lançamentos no extrato
+    duplicados  fração de lançamentos com valor repetido (chaves iguais)
+    deslocados  fração dos lançamentos do sistema com data 1 a 5 dias antes
+    quebras     fração de lançamentos com o histórico quebrado em duas linhas
+    so_sistema  lançamentos extras só no sistema, em fração de `linhas`
+    """
+    rnd = random.Random(seed)
+    inicio = dt.date(2024, 1, 2)
+    extrato, sistema = [], []
+    saldo = 1000000
+
+    for i in range(linhas):
+        data = inicio + dt.timedelta(days=i * dias // max(linhas, 1))
+        if rnd.random() < duplicados:
+            valor = rnd.choice(VALORES_REPETIDOS)
+        else:
+            valor = rnd.randint(100, 500000)
+        debito = rnd.random() < 0.5
+        saldo += -valor if debito else valor
+        historico = rnd.choice(HISTORICOS)
+
+        extrato.append([data.strftime("%d/%m/%Y"), "0000", "14020", historico,
+                        str(rnd.randint(1000, 99999)), _brl(valor) + (" D" if debito else " C"),
+                        _brl(saldo) + (" C" if saldo >= 0 else " D")])
+        if rnd.random() < quebras:
+            extrato.append([" ", " ", " ", "COMPLEMENTO %d" % i, None, None, None])
+
+        # ~85% dos lançamentos do banco aparecem no sistema
+        if rnd.random() < 0.85:
+            if rnd.random() < deslocados:
+                data = data - dt.timedelta(days=rnd.randint(1, 5))
+            sistema.append([str(1000 + i), data.strftime("%d/%m/%Y"), historico.upper(),
+                            valor / 100 if debito else 0.0, 0.0 if debito else valor / 100, saldo / 100])
+
+    for j in range(int(linhas * so_sistema)):
+        data = inicio + dt.timedelta(days=rnd.randint(0, dias - 1))
+        sistema.append([str(10 ** 7 + j), data.strftime("%d/%m/%Y"), "LANC MANUAL",
+                        rnd.randint(100, 90000) / 100, 0.0, 0.0])
+
+    if len(extrato) + layouts.EXTRATO_BB.topo + layouts.EXTRATO_BB.rodape > MAX_LINHAS_XLSX:
+        raise ValueError("O extrato não cabe em uma planilha (%d linhas)." % len(extrato))
+
+    # Extrato: 12 linhas de cabeçalho, lançamentos como texto, 2 de rodapé
+    buffer = io.BytesIO()
+    wb = xlsxwriter.Workbook(buffer, {"constant_memory": True})
+    ws = wb.add_worksheet()
+    r = 0
+    for k in range(layouts.EXTRATO_BB.topo):
+        ws.write_string(r, 0, "Cabeçalho %d" % k)
+        r += 1
+    for linha in extrato:
+        for c, valor in enumerate(linha):
+            if valor is not None:
+                ws.write_string(r, c, valor)
+        r += 1
+    ws.write_string(r, 0, "Transação efetuada com sucesso por autoatendimento")
+    ws.write_string(r + 1, 0, "Serviço de Atendimento ao Consumidor")
+    wb.close()
+    extrato_xlsx = buffer.getvalue()
+
+    # Sistema: topo, "Banco:", cabeçalho, separador, lançamentos numéricos, total
+    buffer = io.BytesIO()
+    wb = xlsxwriter.Workbook(buffer, {"constant_memory": True})
+    ws = wb.add_worksheet()
+    for k in range(7):
+        ws.write_string(k, 0, "Relatório %d" % k)
+    ws.write_string(7, 0, "Banco: 001 - BANCO DO BRASIL")
+    ws.write_row(8, 0, ["NLanc", "Dtlan", "Histórico", "Debito", "Crédito", "Saldo"])
+    ws.write_row(9, 0, ["-" * 6] * 6)
+    r = 10
+    for linha in sistema:
+        ws.write_row(r, 0, linha)
+        r += 1
+    ws.write_row(r, 0, ["", "", "", "Total Geral", 0, 0])
+    wb.close()
+
+    return extrato_xlsx, buffer.getvalue()
+
+def _etapas(extrato_xlsx, sistema_xlsx, streaming=False):
+    # Mesma sequência do conciliar_tratados, uma etapa por vez: cada item é
+    # (nome, etapa que devolve o tamanho da saída, função que conta a entrada)
+    estado = {}
+
+    def parse_extrato():
+        estado["extrato"] = cc.tratamento_extrato_bb(extrato_xlsx, streaming=streaming)
+        return len(estado["extrato"])
+
+    def parse_sistema():
+        estado["sistema"] = cc.tratamento_sistema_BB(sistema_xlsx)
+        return len(estado["sistema"])
+
+    def pendentes():
+        indice = estado["indice"]
+        estado["apenas_extrato"] = estado["extrato"].take(indice.livres(0))
+        estado["apenas_sistema"] = estado["sistema"].take(indice.livres(1))
+
+    def conciliacao_exata():
+        estado["indice"] = indice = cc.IndiceConciliacao(estado["extrato"], estado["sistema"])
+        pos_extrato, pos_sistema = indice.casar_exato()
+        estado["conciliado"] = cc._tabela_conciliados(estado["extrato"], estado["sistema"], pos_extrato, pos_sistema)
+        pendentes()
+        return len(estado["conciliado"])
+
+    def conciliacao_aproximada():
+        casados = len(estado["indice"].casar_janela(cc.LIMITE_DIAS)[0])
+        pendentes()
+        return casados
+
+    def conciliacao_por_soma():
+        grupos = estado["indice"].casar_por_soma()
+        pendentes()
+        return grupos["Grupo"].nunique()
+
+    def somas_por_dia():
+        pos_extrato, pos_sistema = estado["indice"].casar_por_dia()
+        pendentes()
+        return estado["extrato"]["Data"].take(pos_extrato).nunique()    # dias que bateram
+
+    def gravacao_xlsx():
+        estado["planilha"] = cc.gravar_planilha({
+            "Valores Exatos Conciliados": estado["conciliado"],
+            "Não Identificados-Extrato": estado["apenas_extrato"],
+            "Não Identificados-Sistema": estado["apenas_sistema"],
+        })
+        return len(estado["planilha"])
+
+    def conciliacao_completa():
+        return len(cc.conciliar_tratados(estado["extrato"], estado["sistema"]))
+
+    return [
+        ("parse_extrato", parse_extrato, lambda: len(extrato_xlsx)),
+        ("parse_sistema", parse_sistema, lambda: len(sistema_xlsx)),
+        ("conciliacao_exata", conciliacao_exata, lambda: len(estado["extrato"]) + len(estado["sistema"])),
+        ("conciliacao_aproximada", conciliacao_aproximada,
+         lambda: len(estado["apenas_extrato"]) + len(estado["apenas_sistema"])),
+        ("conciliacao_por_soma", conciliacao_por_soma,
+         lambda: len(estado["apenas_extrato"]) + len(estado["apenas_sistema"])),
+        ("somas_por_dia", somas_por_dia, lambda: len(estado["apenas_extrato"]) + len(estado["apenas_sistema"])),
+        ("gravacao_xlsx", gravacao_xlsx,
+         lambda: len(estado["conciliado"]) + len(estado["apenas_extrato"]) + len(estado["apenas_sistema"])),
+        ("conciliar_tratados", conciliacao_completa, lambda: len(estado["extrato"]) + len(estado["sistema"])),
+    ]
+
+def medir(extrato_xlsx, sistema_xlsx, memoria=True, streaming=False):
+    """
+    Executa as etapas e retorna {etapa: {segundos, pico_mb, entrada, saida}};
+    entrada/saida contam linhas (bytes do XLSX no parse e na gravação).
+    Com memoria=True roda uma segunda vez sob tracemalloc, para o rastreamento
+    não distorcer os tempos.
+    """
+    resultado = {}
+    for nome, etapa, entrada in _etapas(extrato_xlsx, sistema_xlsx, streaming):
+        linhas_entrada = entrada()
+        inicio = time.perf_counter()
+        saida = etapa()
+        resultado[nome] = {"segundos": round(time.perf_counter() - inicio, 4),
+                           "entrada": linhas_entrada, "saida": saida}
+
+    if memoria:
+        for nome, etapa, _ in _etapas(extrato_xlsx, sistema_xlsx, streaming):
+            tracemalloc.start()
+            try:
+                etapa()
+                _, pico = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            resultado[nome]["pico_mb"] = round(pico / 2**20, 2)
+    return resultado
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+def ler_resultados(caminho):
+    if not os.path.exists(caminho):
+        return []
+    with open(caminho, encoding="utf-8") as f:
+        return [json.loads(linha) for linha in f if linha.strip()]
+
+def comparar(atual, anterior, limite=LIMITE_REGRESSAO):
+    """
+    Compara os tempos de duas execuções do mesmo tamanho. Retorna as
+    etapas que ficaram mais de `limite` (fração) mais lentas.
+    """
+    regressoes = []
+    for nome, medida in atual["etapas"].items():
+        antes = anterior["etapas"].get(nome)
+        if not antes or max(antes["segundos"], medida["segundos"]) < MIN_SEGUNDOS_COMPARAR:
+            continue
+        variacao = medida["segundos"] / antes["segundos"] - 1
+        marca = ""
+        if variacao > limite:
+            marca = "  <-- REGRESSÃO"
+            regressoes.append(nome)
+        print("    %-24s %9.3fs -> %9.3fs (%+.0f%%)%s"
+              % (nome, antes["segundos"], medida["segundos"], variacao * 100, marca))
+    return regressoes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark das etapas da conciliação.")
+    parser.add_argument("--linhas", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="tamanhos do extrato a medir")
+    parser.add_argument("--repeticoes", type=int, default=1, help="execuções por tamanho (fica a mais rápida)")
+    parser.add_argument("--duplicados", type=float, default=0.2)
+    parser.add_argument("--deslocados", type=float, default=0.1)
+    parser.add_argument("--quebras", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--streaming", action="store_true", help="usa o parse do extrato em blocos")
+    parser.add_argument("--sem-memoria", action="store_true", help="não mede o pico de memória")
+    parser.add_argument("--saida", default="benchmark_resultados.jsonl", help="arquivo JSONL de resultados")
+    parser.add_argument("--limite", type=float, default=LIMITE_REGRESSAO,
+                        help="fração de piora que conta como regressão")
+    args = parser.parse_args(argv)
+
+    historico = ler_resultados(args.saida)
+    regressoes = []
+    for linhas in args.linhas:
+        print("%d linhas: gerando planilhas..." % linhas)
+        extrato_xlsx, sistema_xlsx = gerar_planilhas(linhas, seed=args.seed, duplicados=args.duplicados,
+                                                     deslocados=args.deslocados, quebras=args.quebras)
+        medidas = [medir(extrato_xlsx, sistema_xlsx, memoria=not args.sem_memoria, streaming=args.streaming)
+                   for _ in range(max(args.repeticoes, 1))]
+        etapas = {nome: min((m[nome] for m in medidas), key=lambda x: x["segundos"]) for nome in medidas[0]}
+
+        registro = {
+            "quando": dt.datetime.now().isoformat(timespec="seconds"),
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "linhas": linhas,
+            "parametros": {"duplicados": args.duplicados, "deslocados": args.deslocados,
+                           "quebras": args.quebras, "seed": args.seed, "streaming": args.streaming},
+            "etapas": etapas,
+        }
+        for nome, medida in etapas.items():
+            print("    %-24s %9.3fs  %8s MB  %d -> %d" % (nome, medida["segundos"], medida.get("pico_mb", "-"),
+                                                       medida["entrada"], medida["saida"]))
+
+        anterior = [r for r in historico if r["linhas"] == linhas and r["parametros"] == registro["parametros"]]
+        if anterior:
+            print("  comparado com %s (%s):" % (anterior[-1]["commit"] or "?", anterior[-1]["quando"]))
+            regressoes += ["%d/%s" % (linhas, nome) for nome in comparar(registro, anterior[-1], args.limite)]
+
+        with open(args.saida, "a", encoding="utf-8") as f:
+            f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+        historico.append(registro)
+
+    if regressoes:
+        print("Regressões: %s" % ", ".join(regressoes))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,134 +2,697 @@ import pandas as pd
 import numpy as np
 import re
 import io
+import json
+import os
+import time
+import unicodedata
+from dataclasses import dataclass
+
+import xlsxwriter
+
+import layouts
+import leitor_xlsx
+from instrumentacao import etapa
+
+try:
+    import python_calamine  # noqa: F401 (leitor de XLSX em Rust, opcional, usado pelo pd.read_excel)
+    _MOTOR_XLSX = "calamine"
+except ImportError:
+    _MOTOR_XLSX = None
+
+# Layout da chave int64: [dia desde 1970 (16 bits) | débito − crédito em centavos (46 bits)]
+_BITS_VALOR = 46
+_DESLOCA_VALOR = np.int64(1) << (_BITS_VALOR - 1)
+_MAX_DIAS = 1 << 16
+_EPOCA = np.datetime64("1970-01-01", "D")
+
+def _para_data(series):
+    # "dd/mm/aaaa" no caminho rápido; depois "aaaa-mm-dd hh:mm:ss" (célula de
+    # data lida como texto), que o dayfirst do parser genérico inverteria
+    datas = pd.to_datetime(series, format="%d/%m/%Y", errors="coerce")
+    resto = datas.isna() & series.notna()
+    if resto.any():
+        datas[resto] = pd.to_datetime(series[resto].astype(str), format="ISO8601", errors="coerce")
+        resto = datas.isna() & series.notna()
+    if resto.any():
+        datas[resto] = pd.to_datetime(series[resto].astype(str), dayfirst=True,
+                                      errors="coerce", format="mixed")
+    return datas
+
+def _numero_brl(series):
+    # "1.234,56" / "1234,56" / "R$ 10,00" -> float (NaN se vazio ou inválido)
+    texto = series.astype("string").str.replace(r"\s+|R\$|\.", "", regex=True).str.replace(",", ".", regex=False)
+    return pd.to_numeric(texto, errors="coerce")
+
+def _centavos_brl(series):
+    # "1.234,56" / "1234,56" -> 123456 (vazio ou inválido = 0)
+    return _reais_para_centavos(_numero_brl(series))
+
+def _reais_para_centavos(series, vazio=0):
+    # Reais -> int64 em centavos; com vazio=None devolve Int64 com <NA>
+    centavos = np.rint(pd.to_numeric(series, errors="coerce").astype(float).to_numpy() * 100)
+    nulos = np.isnan(centavos)
+    if vazio is None:
+        inteiros = pd.array(np.where(nulos, 0, centavos).astype(np.int64), dtype="Int64")
+        inteiros[nulos] = pd.NA
+        return pd.Series(inteiros, index=series.index)
+    return pd.Series(np.where(nulos, vazio, centavos).astype(np.int64), index=series.index)
+
+def _saldo_centavos(series):
+    # "7.145,68 C" -> 714568 ; "10,00 D" -> -1000 ; vazio -> <NA>
+    texto = series.astype("string").str.strip()
+    sinal = np.where(texto.str.endswith("D").fillna(False), -1, 1)
+    return _reais_para_centavos(_numero_brl(texto.str.rstrip("CD ")), vazio=None) * sinal
+
+def _categorizar(df, colunas=("Histórico", "Documento")):
+    # Textos muito repetidos viram categoria (um código inteiro por linha)
+    for col in colunas:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
 
-# Tratamento do Extrato Bancário
-def tratamento_extrato_bb(xlsx_bytes, salvar_em=None):
-    # Lê o XLSX a partir de bytes (sem usar caminho no disco)
-    extrato = pd.read_excel(io.BytesIO(xlsx_bytes), dtype=str, header=None, engine="openpyxl")
-
-    # Remove cabeçalho/rodapé padrão do relatório
-    extrato = extrato.iloc[12:-2]
-
-    # Filtros de linhas indesejadas
-    extrato = extrato[~extrato.iloc[:, 0].str.contains(r'autoatendimento|Evaluation', case=False, na=False)]
-    extrato = extrato[~extrato.iloc[:, 0].str.contains(r'A CONTA NAO FOI MOVIMENTADA', case=False, na=False)]
-    extrato = extrato[~extrato.iloc[:, 3].str.contains(r'500 Tar DOC/TED', case=False, na=False)]
-
-    # Junta tudo para facilitar split
-    extrato["Linha_Unica"] = extrato.fillna("").astype(str).agg("|".join, axis=1)
-
-    # Split nas primeiras 7 colunas (ajuste se necessário)
-    extrato_split = extrato["Linha_Unica"].str.split(r"\|+", expand=True)
-    extrato_split = extrato_split[[0, 1, 2, 3, 4, 5, 6]]
-    extrato_split.columns = ["Data", "Agencia de Origem", "Lote", "Historico", "Documento", "Valor", "Saldo"]
-
-    # Corrige "Histórico" quando a linha de valores vem quebrada
-    extrato_split["Valor_Seguinte"] = extrato_split["Valor"].shift(-1)
-    extrato_split["Historico_Seguinte"] = extrato_split["Historico"].shift(-1)
-
-    # Se a próxima linha NÃO tiver valor, concatena o histórico
-    extrato_split["Historico_Corrigido"] = np.where(
-        extrato_split["Valor_Seguinte"].notna(),
-        extrato_split["Historico"],
-        (extrato_split["Historico"].fillna("") + " " + extrato_split["Historico_Seguinte"].fillna("")).str.strip()
-    )
+def chave_conciliacao(datas, debito_centavos, credito_centavos, texto_data=None):
+    """
+    Chave de conciliação int64 a partir da data e dos valores em centavos.
 
-    # Limpa linhas com data inválida
-    extrato_split["Data"] = extrato_split["Data"].astype(str).str.strip()
-    mask_data_valida = (
-        extrato_split["Data"].notna() &
-        extrato_split["Data"].ne("") &
-        extrato_split["Data"].str.lower().ne("nan")
+    Linhas comuns (só débito ou só crédito) viram uma chave positiva com o
+    dia e o valor líquido empacotados. Linhas fora desse caso (data inválida,
+    débito e crédito juntos, valores gigantes) recebem um hash negativo de
+    (data, débito, crédito), então nunca colidem com as chaves empacotadas.
+    """
+    datas = pd.to_datetime(datas, errors="coerce")
+    deb = np.asarray(debito_centavos, dtype=np.int64)
+    cred = np.asarray(credito_centavos, dtype=np.int64)
+    dias = (datas.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]") - _EPOCA).astype(np.int64)
+    liquido = deb - cred
+
+    simples = (
+        datas.notna().to_numpy()
+        & (dias >= 0) & (dias < _MAX_DIAS)
+        & ((deb == 0) | (cred == 0))
+        & (np.abs(liquido) < _DESLOCA_VALOR)
     )
-    extrato_split = extrato_split[mask_data_valida]
+    chave = np.where(simples, (dias << _BITS_VALOR) | (liquido + _DESLOCA_VALOR), 0)
+
+    if not simples.all():
+        base = texto_data if texto_data is not None else datas
+        partes = pd.DataFrame({
+            "data": np.asarray(base.astype(str))[~simples],
+            "deb": deb[~simples],
+            "cred": cred[~simples],
+        })
+        h = pd.util.hash_pandas_object(partes, index=False).to_numpy()
+        chave[~simples] = -1 - (h >> np.uint64(2)).astype(np.int64)
+
+    return pd.Series(chave, index=datas.index, name="Chave Procx")
+
+def _tamanho(fonte):
+    # Bytes do XLSX ou linhas da tabela já extraída
+    return len(fonte) if fonte is not None else None
+
+def _ler_planilha(fonte, topo=0, rodape=0):
+    """
+    1ª aba como tabela de texto, igual ao pd.read_excel(dtype=str), já sem
+    as `topo` primeiras e as `rodape` últimas linhas. Com o python-calamine
+    instalado o pd.read_excel usa ele; sem, o XLSX é lido em streaming
+    (leitor_xlsx) direto para as colunas.
+    """
+    # Tabela já extraída em memória (converter.convert_pdf_bytes_to_table)
+    if isinstance(fonte, pd.DataFrame):
+        tabela = fonte.copy()
+        tabela.columns = range(tabela.shape[1])
+    elif _MOTOR_XLSX:
+        tabela = pd.read_excel(io.BytesIO(fonte), dtype=str, header=None, engine=_MOTOR_XLSX)
+    else:
+        return _colunas_planilha(fonte, topo, rodape)
+    return tabela.iloc[topo:len(tabela) - rodape]
+
+def _colunas_planilha(xlsx_bytes, topo, rodape):
+    # Uma passada: as linhas do topo só contam para a largura
+    linhas, total, largura = [], 0, 0
+    for i, valores in enumerate(leitor_xlsx.linhas(xlsx_bytes)):
+        linha = [_celula_texto(v) for v in valores]
+        usadas = _largura_usada(linha)
+        if usadas:
+            total = i + 1
+            largura = max(largura, usadas)
+        if i >= topo:
+            linhas.append(linha)
+
+    # Mesmas dimensões do pd.read_excel: sem as linhas vazias do fim
+    del linhas[max(0, total - topo - rodape):]
+    colunas = {j: np.empty(len(linhas), dtype=object) for j in range(largura)}
+    for j, coluna in colunas.items():
+        coluna[:] = [linha[j] if j < len(linha) else None for linha in linhas]
+    return pd.DataFrame(colunas, index=pd.RangeIndex(topo, topo + len(linhas)), dtype=str)
+
+EXTRATO_LOTE = 50_000       # linhas por bloco no modo streaming
+_SEPARADOR_TOKENS = re.compile(layouts.SEPARADOR + "+")
+
+# Conferência do saldo corrente logo após o tratamento (ver verificar_saldo):
+# True interrompe com SaldoInconsistente, AVISAR_SALDO só anota o problema
+# em df.attrs[AVISO_SALDO] e segue, False não confere.
+# CONCILIACAO_VALIDAR_SALDO: "1" (padrão), "avisar" ou "0"
+AVISAR_SALDO = "avisar"
+AVISO_SALDO = "aviso_saldo"
+VALIDAR_SALDO = {"0": False, AVISAR_SALDO: AVISAR_SALDO}.get(
+    os.environ.get("CONCILIACAO_VALIDAR_SALDO", "1").strip().lower(), True)
+REPARAR_LINHAS = os.environ.get("CONCILIACAO_REPARAR_LINHAS") == "1"
+_VALOR_DC = re.compile(r"^\s*-?[\d.]+,\d{2}\s*[DC]\s*$")
+
+class SaldoInconsistente(ValueError):
+    """
+    O saldo corrente informado não fecha com os débitos e créditos lidos:
+    sinal de colunas deslocadas no tratamento. `quebras` tem as linhas
+    onde o saldo deixou de fechar (ver verificar_saldo).
+    """
 
-    # Seleciona e renomeia colunas finais
-    extrato_split = extrato_split[["Data", "Agencia de Origem", "Lote", "Historico_Corrigido", "Documento", "Valor", "Saldo"]]
-    extrato_split = extrato_split.rename(columns={"Historico_Corrigido": "Histórico"})
+    def __init__(self, nome, quebras):
+        super().__init__(nome, quebras)
+        self.nome = nome
+        self.quebras = quebras
+
+    def __str__(self):
+        primeira = self.quebras.iloc[0]
+        data = primeira["Data"].strftime("%d/%m/%Y") if pd.notna(primeira["Data"]) else "sem data"
+        return ("%s: o saldo não fecha em %d linha(s); a primeira é a linha %d da planilha (%s, %s), "
+                "diferença de %s" % (self.nome, len(self.quebras), self.quebras.index[0] + 1, data,
+                                     primeira["Histórico"], _reais_texto(primeira["Diferença"])))
+
+def _reais_texto(centavos):
+    texto = "{:,.2f}".format(centavos / 100)
+    return "R$ " + texto.replace(",", "X").replace(".", ",").replace("X", ".")
+
+# Colunas de saída de cada tipo de planilha (antes da Chave Procx)
+_SAIDA = {
+    "extrato": ["Data", "Histórico", "Documento", "Débito", "Crédito", "Saldo"],
+    "sistema": ["NLanc", "Data", "Histórico", "Débito", "Crédito", "Saldo"],
+}
+
+# Textos que o pd.read_excel trata como vazio por padrão
+_NA_PANDAS = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+              "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+def _celula_texto(valor):
+    # Mesmo texto que o pd.read_excel(dtype=str) produziria para a célula
+    if valor is None or (isinstance(valor, float) and np.isnan(valor)):
+        return None
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    texto = str(valor)
+    return None if texto in _NA_PANDAS else texto
+
+def _linhas_planilha(fonte):
+    """
+    Linhas da 1ª aba como tuplas de texto (None = vazio), lidas em streaming.
+    Retorna (quantidade de linhas, largura, iterador) com as mesmas
+    dimensões que o pd.read_excel enxerga: sem linhas vazias no fim e com
+    todas as linhas completadas até a largura da maior.
+    """
+    if isinstance(fonte, pd.DataFrame):
+        linhas = (tuple(_celula_texto(v) for v in linha)
+                  for linha in fonte.itertuples(index=False, name=None))
+        return fonte.shape[0], fonte.shape[1], linhas
+
+    def abrir():
+        for linha in leitor_xlsx.linhas(fonte):
+            yield [_celula_texto(v) for v in linha]
+
+    # 1ª passada (sem guardar nada): dimensões reais dos dados
+    total, largura = 0, 0
+    for i, linha in enumerate(abrir()):
+        usadas = _largura_usada(linha)
+        if usadas:
+            total = i + 1
+            largura = max(largura, usadas)
+
+    def linhas():
+        for i, linha in enumerate(abrir()):
+            if i >= total:
+                break
+            linha = linha[:largura]
+            yield tuple(linha) + (None,) * (largura - len(linha))
+
+    return total, largura, linhas()
+
+def _largura_usada(linha):
+    # Células até a última não vazia
+    usadas = len(linha)
+    while usadas and linha[usadas - 1] is None:
+        usadas -= 1
+    return usadas
+
+def _nomes_cabecalho(linha):
+    return [str(nome).strip() if nome is not None and not pd.isna(nome) else None for nome in linha]
+
+def _posicoes(compilado, nomes):
+    # Posição de cada coluna do layout na linha de cabeçalho encontrada
+    layout = compilado.layout
+    faltam = [nome for nome in compilado.renomear if nome not in nomes]
+    if faltam:
+        raise ValueError("Layout %r: colunas ausentes no cabeçalho: %s" % (layout.nome, ", ".join(faltam)))
+    return [nomes.index(nome) for nome in compilado.renomear]
+
+def _colunas_lidas(compilado):
+    layout = compilado.layout
+    nomes = layout.tokens or tuple(compilado.renomear)
+    return [compilado.renomear.get(nome, nome) for nome in nomes]
+
+def iterar_planilha(fonte, layout, tamanho_lote=EXTRATO_LOTE, reparar=False):
+    """
+    Trata a planilha em blocos de até `tamanho_lote` linhas, gerando
+    DataFrames já normalizados (mesmas colunas do tratar_planilha). A
+    memória fica limitada ao bloco corrente, qualquer que seja o tamanho
+    da planilha. A correção do histórico quebrado olha a linha seguinte,
+    então a 1ª linha de cada bloco fica retida até o próximo chegar.
+    """
+    compilado = layouts.compilar(layout)
+    colunas = _colunas_lidas(compilado)
+    total, largura, linhas = _linhas_planilha(fonte)
+    fim = total - layout.rodape
+
+    posicoes, pular = None, 0
+    bloco, indices = [], []
+    for i, linha in enumerate(linhas):
+        if i < layout.topo:
+            continue
+        if i >= fim:
+            break
+        texto = layouts.SEPARADOR.join(c or "" for c in linha)
+        classe = compilado.classificar_linha(texto)
+        if classe == layouts.CABECALHO:
+            if posicoes is None:
+                posicoes = _posicoes(compilado, _nomes_cabecalho(linha))
+                pular = layout.pular_apos_cabecalho
+            continue
+        if classe == layouts.DESCARTE:
+            continue
+
+        if layout.tokens:
+            registro = _SEPARADOR_TOKENS.split(texto)[:len(colunas)]
+            registro += [None] * (len(colunas) - len(registro))
+        elif posicoes is None:
+            continue                    # antes do cabeçalho
+        elif pular:
+            pular -= 1
+            continue
+        else:
+            registro = [linha[j] for j in posicoes]
 
-    # Separa Débito/Crédito a partir do sufixo D/C
-    valor_str = extrato_split["Valor"].astype(str).str.strip()
-    extrato_split["Débito"] = np.where(valor_str.str.endswith("D"), extrato_split["Valor"], np.nan)
-    extrato_split["Débito"] = extrato_split["Débito"].str.replace("D", "", regex=False).str.strip()
-    extrato_split["Crédito"] = np.where(valor_str.str.endswith("C"), extrato_split["Valor"], np.nan)
-    extrato_split["Crédito"] = extrato_split["Crédito"].str.replace("C", "", regex=False).str.strip()
+        bloco.append(registro)
+        indices.append(i)
+        if len(bloco) > tamanho_lote:
+            yield _bloco(layout, colunas, bloco[:-1], indices[:-1], proxima=bloco[-1], reparar=reparar)
+            bloco, indices = bloco[-1:], indices[-1:]
 
-    # Normaliza valores (troca ponto dos milhares e garante "0,00")
-    for col in ["Débito", "Crédito"]:
-        extrato_split[col] = extrato_split[col].str.replace(".", "", regex=False)
-        extrato_split[col] = extrato_split[col].fillna("0,00")
+    if bloco:
+        yield _bloco(layout, colunas, bloco, indices, proxima=None, reparar=reparar)
 
-    # Mantém somente colunas necessárias
-    extrato_split = extrato_split[["Data", "Histórico", "Documento", "Débito", "Crédito", "Saldo"]]
+def iterar_extrato_bb(xlsx_bytes, tamanho_lote=EXTRATO_LOTE):
+    return iterar_planilha(xlsx_bytes, layouts.EXTRATO_BB, tamanho_lote=tamanho_lote)
 
-    # Chave de conciliação
-    extrato_split["Chave Procx"] = extrato_split.apply(
-        lambda r: f'{r["Data"]}|{r["Débito"]}|{r["Crédito"]}', axis=1
-    )
+def _bloco(layout, colunas, registros, indices, proxima, reparar=False):
+    # A linha seguinte ao bloco entra só para a correção do histórico e sai depois
+    if proxima is not None:
+        registros, indices = registros + [proxima], indices + [-1]
+    dados = pd.DataFrame(registros, index=indices, columns=colunas, dtype=str)
+    return _normalizar(dados, layout, com_proxima=proxima is not None, reparar=reparar)
 
-    # Limpa NaN/espaços em colunas-alvo
-    cols_alvo = ["Histórico", "Saldo"]
-    extrato_split[cols_alvo] = (
-        extrato_split[cols_alvo]
-        .fillna("-")
-        .apply(lambda s: s.astype(str)
-                         .str.replace(r"\bnan\b", "-", flags=re.IGNORECASE, regex=True)
-                         .str.replace(r"\s+", " ", regex=True)
-                         .str.strip())
-    )
-    extrato_split["Histórico"] = extrato_split["Histórico"].str.replace("-", "", regex=False)
+def _vazio(layout):
+    colunas = _colunas_lidas(layouts.compilar(layout))
+    return _bloco(layout, colunas, [[""] + [None] * (len(colunas) - 1)], [0], None).iloc[:0]
+
+def tratar_planilha(fonte, layout, salvar_em=None, streaming=False, tamanho_lote=EXTRATO_LOTE,
+                    validar_saldo=None, reparar=None):
+    """
+    Trata a planilha (bytes XLSX ou tabela extraída do PDF) conforme o
+    layout (ver layouts.py). Devolve as colunas de _SAIDA[layout.tipo]
+    mais a Chave Procx, com datas tipadas e valores em centavos.
+
+    Com `validar_saldo` (padrão VALIDAR_SALDO) o saldo corrente é
+    conferido e um SaldoInconsistente sai antes de qualquer conciliação;
+    com AVISAR_SALDO a mensagem fica em df.attrs[AVISO_SALDO] e o
+    tratamento segue.
+    Com `reparar` (padrão REPARAR_LINHAS) as linhas com colunas deslocadas
+    para a esquerda são corrigidas antes (ver _reparar_deslocadas).
+    """
+    validar_saldo = VALIDAR_SALDO if validar_saldo is None else validar_saldo
+    reparar = REPARAR_LINHAS if reparar is None else reparar
+    if streaming:
+        # Lê e normaliza em blocos; só o resultado final fica inteiro na memória
+        with etapa("leitura_%s" % layout.tipo, entrada=_tamanho(fonte)) as e:
+            partes = [p for p in iterar_planilha(fonte, layout, tamanho_lote=tamanho_lote, reparar=reparar)
+                      if len(p)]
+            df = pd.concat(partes) if partes else _vazio(layout)
+            e.saida = len(df)
+    else:
+        with etapa("leitura_%s" % layout.tipo, entrada=_tamanho(fonte)) as e:
+            dados = _extrair(_ler_planilha(fonte, layout.topo, layout.rodape), layout)
+            e.saida = len(dados)
+        with etapa("normalizacao_%s" % layout.tipo, entrada=len(dados)) as e:
+            df = _normalizar(dados, layout, reparar=reparar)
+            e.saida = len(df)
+
+    if validar_saldo and layout.saldo_corrente:
+        with etapa("validacao_saldo_%s" % layout.tipo, entrada=len(df)) as e:
+            quebras = verificar_saldo(df, layout.saldo_corrente)
+            e.saida = len(quebras)
+        if len(quebras):
+            erro = SaldoInconsistente(layout.tipo.capitalize(), quebras)
+            if validar_saldo != AVISAR_SALDO:
+                raise erro
+            df.attrs[AVISO_SALDO] = str(erro)
+
+    _categorizar(df)
 
     # Salvar opcionalmente em disco
     if salvar_em:
-        extrato_split.to_excel(salvar_em, index=False)
+        df.to_excel(salvar_em, index=False)
 
-    return extrato_split
+    return df
 
+# Tratamento do Extrato Bancário
+def tratamento_extrato_bb(xlsx_bytes, salvar_em=None, streaming=False, tamanho_lote=EXTRATO_LOTE, **opcoes):
+    return tratar_planilha(xlsx_bytes, layouts.EXTRATO_BB, salvar_em=salvar_em,
+                           streaming=streaming, tamanho_lote=tamanho_lote, **opcoes)
 
-def tratamento_sistema_BB(xlsx_bytes, salvar_em=None):
-    sistema = pd.read_excel(io.BytesIO(xlsx_bytes), dtype=str, header=None, engine="openpyxl")
+def tratamento_extrato(xlsx_bytes, banco=layouts.BANCO_PADRAO, salvar_em=None, streaming=False,
+                       tamanho_lote=EXTRATO_LOTE, **opcoes):
+    return tratar_planilha(xlsx_bytes, layouts.layout_extrato(banco), salvar_em=salvar_em,
+                           streaming=streaming, tamanho_lote=tamanho_lote, **opcoes)
 
-    # Remove cabeçalhos/rodapés
-    sistema = sistema.iloc[7:]
-    sistema = sistema[~sistema.iloc[:, 3].str.contains(
-        r'Total|Saldo Atual|Total Geral|Saldo Anterior|Histórico|CONTA ÚNICA|Página',
-        case=False, na=False)]
-    sistema = sistema[~sistema.iloc[:, 0].str.contains(r'Evaluation|Banco:|Conta:', case=False, na=False)]
-    sistema = sistema[~sistema.iloc[:, 0].isna()]
+def _extrair(tabela, layout):
+    """
+    Linhas de dados da tabela, com as colunas do layout (texto). Uma
+    passada: as células de cada linha são unidas e classificadas pela
+    regex compilada do layout.
+    """
+    compilado = layouts.compilar(layout)
+    colunas = _colunas_lidas(compilado)
+    if tabela.shape[1] == 0:
+        return pd.DataFrame(columns=colunas, dtype=str)
+
+    celulas = tabela.fillna("").astype(str)
+    linhas = celulas.iloc[:, 0]
+    for j in range(1, celulas.shape[1]):
+        linhas = linhas + layouts.SEPARADOR + celulas.iloc[:, j]
+    classes = compilado.classificar(linhas)
+
+    if layout.tokens:
+        dados = linhas[classes == layouts.DADO].str.split(_SEPARADOR_TOKENS, expand=True, regex=True)
+        dados = dados.reindex(columns=range(len(colunas)))
+        dados.columns = colunas
+        return dados
+
+    cabecalhos = np.flatnonzero(classes == layouts.CABECALHO)
+    if not len(cabecalhos):
+        raise ValueError("Layout %r: linha de cabeçalho não encontrada" % (layout.nome,))
+    posicoes = _posicoes(compilado, _nomes_cabecalho(tabela.iloc[cabecalhos[0]]))
+
+    # Linhas de dados depois do 1º cabeçalho, menos as que ele manda pular
+    linhas_dados = np.flatnonzero(classes == layouts.DADO)
+    linhas_dados = linhas_dados[linhas_dados > cabecalhos[0]][layout.pular_apos_cabecalho:]
+    dados = tabela.iloc[linhas_dados, posicoes]
+    dados.columns = colunas
+    return dados
+
+def _valores(series, layout):
+    if layout.numeros == layouts.NUMEROS_BRL:
+        return _centavos_brl(series)
+    return _reais_para_centavos(series)
+
+def _reparar_deslocadas(dados):
+    """
+    Linha sem Documento no modo tokens: o valor cai em Documento, o saldo
+    em Valor e o Saldo fica vazio. Um Documento com cara de valor D/C não
+    existe de verdade, então essas linhas voltam uma coluna para a direita.
+    """
+    if not {"Documento", "Valor", "Saldo"}.issubset(dados.columns):
+        return dados
+    deslocadas = (
+        dados["Saldo"].isna()
+        & dados["Documento"].str.match(_VALOR_DC, na=False)
+        & dados["Valor"].str.match(_VALOR_DC, na=False)
+    )
+    if deslocadas.any():
+        dados.loc[deslocadas, "Saldo"] = dados.loc[deslocadas, "Valor"]
+        dados.loc[deslocadas, "Valor"] = dados.loc[deslocadas, "Documento"]
+        dados.loc[deslocadas, "Documento"] = None
+    return dados
 
-    # A primeira linha após filtro vira cabeçalho
-    sistema.columns = sistema.iloc[0]
-    sistema = sistema.iloc[2:]  # pula linha de separador
+def verificar_saldo(df, saldo_corrente):
+    """
+    Confere o saldo corrente contra os débitos e créditos lidos. Nas linhas
+    com Saldo, saldo − movimento acumulado tem de ser constante (o saldo
+    inicial); onde muda, o saldo parou de fechar. Devolve essas linhas
+    (Data, Histórico, Saldo e a Diferença em centavos); vazio = tudo certo.
+    """
+    sinal = 1 if saldo_corrente == layouts.SALDO_BANCO else -1
+    movimento = np.cumsum((df["Crédito"].to_numpy(dtype=np.int64) - df["Débito"].to_numpy(dtype=np.int64)) * sinal)
+    tem_saldo = df["Saldo"].notna().to_numpy()
+    base = df["Saldo"].to_numpy(dtype=np.int64, na_value=0)[tem_saldo] - movimento[tem_saldo]
+
+    saltos = np.diff(base)
+    quebra = np.flatnonzero(saltos != 0)
+    quebras = df.iloc[np.flatnonzero(tem_saldo)[quebra + 1]][["Data", "Histórico", "Saldo"]]
+    return quebras.assign(**{"Diferença": saltos[quebra]})
+
+def _normalizar(dados, layout, com_proxima=False, reparar=False):
+    if reparar and layout.tokens:
+        dados = _reparar_deslocadas(dados)
+    if layout.historico_quebrado:
+        # Corrige "Histórico" quando a linha de valores vem quebrada: se a
+        # próxima linha NÃO tiver valor, concatena o histórico dela
+        if "Valor" in dados:
+            tem_valor = dados["Valor"].notna()
+        else:
+            tem_valor = dados["Débito"].notna() | dados["Crédito"].notna()
+        historico = dados["Histórico"]
+        dados["Histórico"] = np.where(
+            tem_valor.shift(-1, fill_value=False),
+            historico,
+            (historico.fillna("") + " " + historico.shift(-1).fillna("")).str.strip()
+        )
+    if com_proxima:
+        dados = dados.iloc[:-1]
 
-    # Seleção e renomeação
-    sistema = sistema[["NLanc", "Dtlan", "Histórico", "Debito", "Crédito", "Saldo"]]
-    sistema = sistema.rename(columns={"Dtlan": "Data", "Debito": "Débito"})
+    # Limpa linhas com data inválida
+    dados["Data"] = dados["Data"].astype(str).str.strip()
+    mask_data_valida = (
+        dados["Data"].notna() &
+        dados["Data"].ne("") &
+        dados["Data"].str.lower().ne("nan")
+    )
+    dados = dados[mask_data_valida]
+
+    # Débito/Crédito em centavos, conforme a convenção do layout
+    if layout.convencao == layouts.CONVENCAO_COLUNAS:
+        dados["Débito"] = _valores(dados["Débito"], layout)
+        dados["Crédito"] = _valores(dados["Crédito"], layout)
+    elif layout.convencao == layouts.CONVENCAO_SUFIXO:
+        valor_str = dados["Valor"].astype(str).str.strip()
+        valor = _valores(valor_str.str.rstrip("DC "), layout)
+        dados["Débito"] = np.where(valor_str.str.endswith("D"), valor, 0)
+        dados["Crédito"] = np.where(valor_str.str.endswith("C"), valor, 0)
+    elif layout.convencao == layouts.CONVENCAO_SINAL:
+        valor = _valores(dados["Valor"], layout)
+        dados["Débito"] = np.where(valor < 0, -valor, 0)
+        dados["Crédito"] = np.where(valor > 0, valor, 0)
+    else:
+        raise ValueError("Layout %r: convenção de débito/crédito desconhecida: %r"
+                         % (layout.nome, layout.convencao))
 
-    # Normaliza números em "Débito" e "Crédito"
-    for col in ["Débito", "Crédito"]:
-        s = pd.to_numeric(sistema[col], errors="coerce").round(2)
-        sistema[col] = s.map(lambda x: f"{x:.2f}".replace(".", ",") if pd.notna(x) else "")
-        sistema[col] = sistema[col].fillna("0,00")
+    if "Saldo" not in dados:
+        dados["Saldo"] = pd.array([pd.NA] * len(dados), dtype="Int64")
+    elif layout.numeros == layouts.NUMEROS_BRL:
+        dados["Saldo"] = _saldo_centavos(dados["Saldo"])
+    else:
+        dados["Saldo"] = _reais_para_centavos(dados["Saldo"], vazio=None)
 
-    # Remove possíveis linhas de cabeçalho remanescentes
-    sistema = sistema[~sistema["Data"].astype(str).str.contains(r'Dtlan', case=False, na=False)]
+    # Mantém somente colunas necessárias
+    dados = dados.reindex(columns=_SAIDA[layout.tipo])
 
-    # Chave de conciliação
-    sistema["Chave Procx"] = sistema.apply(
-        lambda r: f'{r["Data"]}|{r["Débito"]}|{r["Crédito"]}', axis=1
+    # Chave de conciliação (int64, vetorizada) e data tipada
+    datas = _para_data(dados["Data"])
+    dados["Chave Procx"] = chave_conciliacao(
+        datas, dados["Débito"], dados["Crédito"], texto_data=dados["Data"],
     )
+    dados["Data"] = datas
+
+    if layout.limpar_historico:
+        # Limpa NaN/espaços no histórico
+        dados["Histórico"] = (
+            dados["Histórico"]
+            .fillna("-")
+            .astype(str)
+            .str.replace(r"\bnan\b", "-", flags=re.IGNORECASE, regex=True)
+            .str.replace(r"\s+", " ", regex=True)
+            .str.strip()
+            .str.replace("-", "", regex=False)
+        )
+
+    return dados
 
-    if salvar_em:
-        sistema.to_excel(salvar_em, index=False)
 
-    return sistema
+def tratamento_sistema_BB(xlsx_bytes, salvar_em=None, **opcoes):
+    return tratar_planilha(xlsx_bytes, layouts.SISTEMA_PADRAO, salvar_em=salvar_em, **opcoes)
 
-def concilaicao(df_extrato, df_sistema):
-    df_conciliado = pd.merge(df_extrato, df_sistema,how="inner", on = "Chave Procx",suffixes=("_Extrato","_Sistema"))
-    df_conciliado = df_conciliado[["Data_Extrato","Histórico_Extrato","Débito_Extrato","Crédito_Extrato","Data_Sistema","Histórico_Sistema","Débito_Sistema","Crédito_Sistema"]]
+def _ocorrencia(df):
+    # 0 para a 1ª linha de cada chave, 1 para a 2ª, ...
+    return df.groupby("Chave Procx", sort=False).cumcount()
 
-    return df_conciliado
+# Desempate por texto entre linhas de mesma chave (mesma data e valor)
+DESEMPATE_TEXTO = True
+_NGRAMA = 3
+_TERMO_COMUM = 0.5          # termo em mais da metade das linhas do bloco não distingue ("PIX", "TED"...)
+_PESO_DOCUMENTO = 1.0       # número de documento em comum vale mais que qualquer histórico parecido
+
+def _texto_normalizado(serie):
+    # Maiúsculas, sem acentos, só letras/dígitos separados por um espaço
+    return (serie.astype("string").fillna("")
+            .str.normalize("NFKD").str.replace(r"[\u0300-\u036f]", "", regex=True)
+            .str.upper().str.replace(r"[^0-9A-Z]+", " ", regex=True).str.strip())
+
+def _termos(df):
+    """
+    Termos de cada linha para o desempate: trigramas das palavras do
+    histórico e números de documento ("#123456", sem zeros à esquerda),
+    vindos da coluna Documento ou de números soltos no histórico.
+    """
+    historicos = _texto_normalizado(df["Histórico"]).tolist()
+    documentos = (df["Documento"].astype("string").fillna("").tolist()
+                  if "Documento" in df else [""] * len(df))
+    termos = []
+    for historico, documento in zip(historicos, documentos):
+        linha = set()
+        for palavra in historico.split():
+            if palavra.isdigit() and len(palavra.lstrip("0")) >= 3:
+                linha.add("#" + palavra.lstrip("0"))
+                continue
+            palavra = " %s " % palavra
+            linha.update(palavra[i:i + _NGRAMA] for i in range(len(palavra) - _NGRAMA + 1))
+        numero = re.sub(r"\D", "", documento).lstrip("0")
+        if len(numero) >= 3:
+            linha.add("#" + numero)
+        termos.append(linha)
+    return termos
+
+def _indice_termos(df, posicoes):
+    # Índice invertido em formato longo: (chave, termo, linha)
+    termos = _termos(df.iloc[posicoes])
+    tamanhos = [len(t) for t in termos]
+    linhas = np.repeat(posicoes, tamanhos)
+    return pd.DataFrame({
+        "chave": df["Chave Procx"].to_numpy()[linhas],
+        "termo": [termo for t in termos for termo in t],
+        "linha": linhas,
+    })
+
+def _ocorrencias(df_extrato, df_sistema, desempate=None):
+    """
+    Número de ocorrência de cada linha dentro da sua Chave Procx, para o
+    casamento 1-para-1 (k-ésima do extrato com a k-ésima do sistema).
+
+    Sem desempate é a ordem das linhas. Com desempate, nas chaves com mais
+    de um candidato em algum lado, os pares mais parecidos no texto
+    (histórico e documento) recebem as primeiras ocorrências. Os
+    candidatos vêm de um índice invertido de termos dentro de cada chave,
+    sem comparar todos contra todos; termos comuns à maioria do bloco são
+    ignorados. O número de pares por chave não muda, só quem casa com quem.
+    """
+    ocorr_extrato = _ocorrencia(df_extrato).to_numpy(copy=True)
+    ocorr_sistema = _ocorrencia(df_sistema).to_numpy(copy=True)
+    if desempate is None:
+        desempate = DESEMPATE_TEXTO
+    if not desempate or not len(df_extrato) or not len(df_sistema):
+        return ocorr_extrato, ocorr_sistema
+
+    qtd_extrato = df_extrato["Chave Procx"].value_counts()
+    qtd_sistema = df_sistema["Chave Procx"].value_counts()
+    qtd = pd.concat([qtd_extrato.rename("e"), qtd_sistema.rename("s")], axis=1, join="inner")
+    ambiguas = qtd[(qtd["e"] > 1) | (qtd["s"] > 1)]
+    if ambiguas.empty:
+        return ocorr_extrato, ocorr_sistema
+
+    pos_extrato = np.flatnonzero(df_extrato["Chave Procx"].isin(ambiguas.index).to_numpy())
+    pos_sistema = np.flatnonzero(df_sistema["Chave Procx"].isin(ambiguas.index).to_numpy())
+    indice_extrato = _indice_termos(df_extrato, pos_extrato)
+    indice_sistema = _indice_termos(df_sistema, pos_sistema)
+
+    # Tira os termos presentes em mais de _TERMO_COMUM das linhas do bloco
+    frequencia = (pd.concat([indice_extrato, indice_sistema])
+                  .groupby(["chave", "termo"], sort=False).size().rename("freq"))
+    tamanho_bloco = (ambiguas["e"] + ambiguas["s"]).rename("tam")
+    uteis = frequencia.to_frame().join(tamanho_bloco, on="chave")
+    uteis = uteis.index[uteis["freq"] <= _TERMO_COMUM * uteis["tam"]]
+    indice_extrato = indice_extrato.set_index(["chave", "termo"]).loc[lambda d: d.index.isin(uteis)].reset_index()
+    indice_sistema = indice_sistema.set_index(["chave", "termo"]).loc[lambda d: d.index.isin(uteis)].reset_index()
+
+    # Pares que dividem algum termo, com a pontuação: Dice dos trigramas + documento
+    indice_extrato["documento"] = indice_extrato["termo"].str.startswith("#")
+    pares = indice_extrato.merge(indice_sistema, on=["chave", "termo"], suffixes=("_e", "_s"))
+    if pares.empty:
+        return ocorr_extrato, ocorr_sistema
+    pontos = pares.groupby(["linha_e", "linha_s"], sort=False).agg(
+        chave=("chave", "first"), comuns=("documento", "size"), documento=("documento", "any"))
+    n_extrato = indice_extrato.groupby("linha")["termo"].size()
+    n_sistema = indice_sistema.groupby("linha")["termo"].size()
+    e = pontos.index.get_level_values("linha_e")
+    s = pontos.index.get_level_values("linha_s")
+    pontos["pontos"] = (2 * pontos["comuns"].to_numpy()
+                        / (n_extrato.reindex(e).to_numpy() + n_sistema.reindex(s).to_numpy())
+                        + _PESO_DOCUMENTO * pontos["documento"].to_numpy())
+    pontos = pontos.reset_index().sort_values(["pontos", "linha_e", "linha_s"],
+                                              ascending=[False, True, True], kind="stable")
+
+    # Guloso: maior pontuação primeiro, cada linha em um par só
+    usados_extrato, usados_sistema, escolhidos = set(), set(), []
+    for i, j in zip(pontos["linha_e"].to_numpy(), pontos["linha_s"].to_numpy()):
+        if i in usados_extrato or j in usados_sistema:
+            continue
+        usados_extrato.add(i)
+        usados_sistema.add(j)
+        escolhidos.append((i, j))
+    escolhidos = np.array(escolhidos, dtype=np.int64).reshape(-1, 2)
+
+    # Pares escolhidos: ocorrências 0..p-1 da chave; o resto segue na ordem original
+    chaves_e = df_extrato["Chave Procx"].to_numpy()
+    chaves_s = df_sistema["Chave Procx"].to_numpy()
+    ordem_par = pd.Series(chaves_e[escolhidos[:, 0]]).groupby(chaves_e[escolhidos[:, 0]], sort=False).cumcount()
+    pares_por_chave = ordem_par.groupby(chaves_e[escolhidos[:, 0]], sort=False).size()
+    ocorr_extrato[escolhidos[:, 0]] = ordem_par.to_numpy()
+    ocorr_sistema[escolhidos[:, 1]] = ordem_par.to_numpy()
+    for ocorr, posicoes, chaves, usados in ((ocorr_extrato, pos_extrato, chaves_e, usados_extrato),
+                                            (ocorr_sistema, pos_sistema, chaves_s, usados_sistema)):
+        resto = posicoes[~np.isin(posicoes, list(usados))]
+        if len(resto):
+            chave_resto = pd.Series(chaves[resto])
+            ocorr[resto] = (chave_resto.map(pares_por_chave).fillna(0).astype(np.int64).to_numpy()
+                            + chave_resto.groupby(chaves[resto], sort=False).cumcount().to_numpy())
+    return ocorr_extrato, ocorr_sistema
+
+def concilaicao(df_extrato, df_sistema, um_para_um=True, desempate=None):
+    # Chaves repetidas casam por ocorrência (1ª com 1ª, 2ª com 2ª...), com
+    # os pares mais parecidos no texto primeiro (ver _ocorrencias): no
+    # máximo min(n, m) pares por chave, sem produto cartesiano
+    pos_extrato, pos_sistema = IndiceConciliacao(df_extrato, df_sistema).casar_exato(um_para_um, desempate)
+    return _tabela_conciliados(df_extrato, df_sistema, pos_extrato, pos_sistema)
+
+def _tabela_conciliados(df_extrato, df_sistema, pos_extrato, pos_sistema):
+    colunas = {}
+    for lado, df, posicoes in (("Extrato", df_extrato, pos_extrato), ("Sistema", df_sistema, pos_sistema)):
+        for col in ("Data", "Histórico", "Débito", "Crédito"):
+            colunas["%s_%s" % (col, lado)] = df[col].take(posicoes).reset_index(drop=True)
+    return pd.DataFrame(colunas)
+
+def separar_pendentes(df_extrato, df_sistema, um_para_um=True, desempate=None):
+    """
+    Linhas de cada lado que ficaram de fora do concilaicao (mesmo modo).
+    Retorna (apenas_extrato, apenas_sistema) com as colunas originais.
+    """
+    indice = IndiceConciliacao(df_extrato, df_sistema)
+    indice.casar_exato(um_para_um, desempate)
+    return df_extrato[~indice.usado[0]], df_sistema[~indice.usado[1]]
 
 def to_number_brl(series: pd.Series) -> pd.Series:
     s = series.copy()
@@ -168,7 +731,7 @@ def write_resumo_sheet(writer, rows, sheet_name="Resumo"):
           ("Diferença líquida (A–B)", 50.00, 'money_diff', 'credito'),  # ou 'debito'
         ]
     """
-    wb = writer.book
+    wb = getattr(writer, "book", writer)    # pd.ExcelWriter ou xlsxwriter.Workbook
     ws = wb.add_worksheet(sheet_name)
 
     # --- Paleta (dark)
@@ -287,242 +850,833 @@ def write_resumo_sheet(writer, rows, sheet_name="Resumo"):
 
 
 def _prep(df, col_data, col_deb, col_cred, dayfirst=True):
+    # Datas em datetime64 e valores em centavos (int64); aceita ainda
+    # texto nas datas e reais nos valores, vindos de fora do tratamento
     df = df.copy()
-    df[col_data] = pd.to_datetime(df[col_data].astype(str), dayfirst=dayfirst, errors='coerce')
-    df[col_deb]  = pd.to_numeric(df[col_deb],  errors='coerce').fillna(0).round(2)
-    df[col_cred] = pd.to_numeric(df[col_cred], errors='coerce').fillna(0).round(2)
-    df = df[df[col_data].notna()].reset_index(drop=True)
+    if not pd.api.types.is_datetime64_any_dtype(df[col_data]):
+        df[col_data] = pd.to_datetime(df[col_data].astype(str), dayfirst=dayfirst, errors='coerce')
+    for col in (col_deb, col_cred):
+        if not pd.api.types.is_integer_dtype(df[col]):
+            df[col] = _reais_para_centavos(df[col])
+    df = df[df[col_data].notna()]
     return df
 
-def _make_key(df, col_data, col_deb, col_cred):
-    # garante datetime aqui também
-    col = pd.to_datetime(df[col_data], errors='coerce')
-    return (
-        col.dt.strftime('%Y-%m-%d') + '|' +
-        df[col_deb].map(lambda x: f'{x:.2f}') + '|' +
-        df[col_cred].map(lambda x: f'{x:.2f}')
-    )
+def _dias(datas):
+    # datetime64 -> dias desde 1970 (int64)
+    return (pd.to_datetime(datas).to_numpy(dtype="datetime64[ns]").astype("datetime64[D]") - _EPOCA).astype(np.int64)
+
+def _celulas(chaves):
+    # Agrupa itens por chave: (chaves únicas ordenadas, início de cada célula, tamanho, itens ordenados)
+    ordem = np.argsort(chaves, kind="stable")
+    unicas, inicio, tamanho = np.unique(chaves[ordem], return_index=True, return_counts=True)
+    return unicas, inicio, tamanho, ordem
+
+def _posicao_no_grupo(grupos, quantidades):
+    # Quanto de cada grupo já foi consumido antes de cada registro (na ordem dada)
+    ordem = np.argsort(grupos, kind="stable")
+    acumulado = np.cumsum(quantidades[ordem]) - quantidades[ordem]
+    g = grupos[ordem]
+    inicio_grupo = np.r_[True, g[1:] != g[:-1]]
+    base = np.maximum.accumulate(np.where(inicio_grupo, acumulado, 0))
+    resultado = np.empty_like(quantidades)
+    resultado[ordem] = acumulado - base
+    return resultado
+
+def _varrer_janela(celulas_b, celulas_s, limite_frente, limite_tras):
+    """
+    Casamento 1-para-1 entre dois lados pelo mesmo valor com data
+    deslocada: o lado s pode estar até `limite_frente` dias antes do lado b
+    ou até `limite_tras` dias depois. Vence sempre o menor deslocamento
+    (para frente antes de para trás, depois data e posição de b, depois
+    posição de s) -- o mesmo resultado de testar dia a dia e tirar os usados.
+
+    Cada lado chega indexado em células (valor, dia): (chave da célula,
+    com o dia nos dígitos baixos, em ordem; início e tamanho de cada célula
+    em `itens`; itens). A varredura da janela trabalha só com as contagens
+    das células, então o custo é O(janela × células), sem gerar pares
+    candidatos. Retorna (itens de b, itens de s, deslocamento) com
+    deslocamento = dia_b − dia_s.
+    """
+    vazio = np.empty(0, dtype=np.int64)
+    cel_b, ini_b, tam_b, itens_b = celulas_b
+    cel_s, ini_s, tam_s, itens_s = celulas_s
+    resto_b = tam_b.copy()
+    resto_s = tam_s.copy()
+
+    janela = max(limite_frente, limite_tras)
+    deslocamentos = []
+    for k in range(1, janela + 1):
+        if k <= limite_frente:
+            deslocamentos.append(k)
+        if k <= limite_tras:
+            deslocamentos.append(-k)
+
+    reg_b, reg_s, reg_d, reg_m = [], [], [], []
+    for d in deslocamentos:
+        vivos = np.flatnonzero(resto_b)
+        if vivos.size == 0:
+            break
+        alvo = cel_b[vivos] - d
+        j = np.searchsorted(cel_s, alvo)
+        achou = j < len(cel_s)
+        achou[achou] = cel_s[j[achou]] == alvo[achou]
+        cb, cs = vivos[achou], j[achou]
+        m = np.minimum(resto_b[cb], resto_s[cs])
+        ok = m > 0
+        if not ok.any():
+            continue
+        cb, cs, m = cb[ok], cs[ok], m[ok]
+        resto_b[cb] -= m
+        resto_s[cs] -= m
+        reg_b.append(cb); reg_s.append(cs); reg_m.append(m)
+        reg_d.append(np.full(len(m), d, dtype=np.int64))
+
+    if not reg_m:
+        return vazio, vazio, vazio
+
+    cb = np.concatenate(reg_b); cs = np.concatenate(reg_s)
+    m = np.concatenate(reg_m); d = np.concatenate(reg_d)
+
+    # Dentro de cada célula os itens são consumidos em ordem de posição
+    pos_b = ini_b[cb] + _posicao_no_grupo(cb, m)
+    pos_s = ini_s[cs] + _posicao_no_grupo(cs, m)
+    total = m.sum()
+    passo = np.arange(total) - np.repeat(np.cumsum(m) - m, m)
+    idx_b = itens_b[np.repeat(pos_b, m) + passo]
+    idx_s = itens_s[np.repeat(pos_s, m) + passo]
+    return idx_b, idx_s, np.repeat(d, m)
+
+LIMITE_DIAS = 10            # dias que o sistema pode vir antes do banco na data deslocada
 
 def buscar_aproximado_data_pra_frente(
     df_banco_nc, df_sis_nc,
     *,  # força nomeados
     col_data_b='Data', col_deb_b='Débito', col_cred_b='Crédito',
     col_data_s='Data', col_deb_s='Débito', col_cred_s='Crédito',
-    limite_dias=10, dayfirst=True
+    limite_dias=LIMITE_DIAS, limite_dias_tras=0, dayfirst=True
 ):
     # 1) prepara e cria IDs
-    b = _prep(df_banco_nc, col_data_b, col_deb_b, col_cred_b, dayfirst=dayfirst).reset_index(drop=True)
-    s = _prep(df_sis_nc,   col_data_s, col_deb_s, col_cred_s, dayfirst=dayfirst).reset_index(drop=True)
+    # (IDs = rótulos do índice de entrada, para o chamador tirar os casados)
+    b = _prep(df_banco_nc, col_data_b, col_deb_b, col_cred_b, dayfirst=dayfirst)
+    s = _prep(df_sis_nc,   col_data_s, col_deb_s, col_cred_s, dayfirst=dayfirst)
     b['id_bco'] = b.index
     s['id_sis'] = s.index
+    b = b.reset_index(drop=True)
+    s = s.reset_index(drop=True)
+
+    # 2) índice (valor, dia) dos dois lados e casamento 1-para-1 em uma
+    # varredura da janela (sistema + offset = banco)
+    indice = IndiceConciliacao(
+        pd.DataFrame({"Data": b[col_data_b], "Débito": b[col_deb_b], "Crédito": b[col_cred_b]}),
+        pd.DataFrame({"Data": s[col_data_s], "Débito": s[col_deb_s], "Crédito": s[col_cred_s]}),
+    )
+    idx_b, idx_s, offset = indice.casar_janela(limite_dias, limite_dias_tras)
 
-    conciliados = []
-
-    for d in range(1, limite_dias + 1):
-        if b.empty or s.empty:
-            break
-
-        # chave banco (data original)
-        b2 = b.copy()
-        b2['_chave'] = _make_key(b2, col_data_b, col_deb_b, col_cred_b)
-        b_sel = b2[['id_bco', '_chave', col_data_b, col_deb_b, col_cred_b]].rename(columns={
-            col_data_b: 'data_banco',
-            col_deb_b:  'debito_banco',
-            col_cred_b: 'credito_banco',
-        })
-
-        # chave sistema (data + d dias) — sobrescreve a coluna de data diretamente
-        s_tmp = s.copy()
-        s_tmp['data_sistema_original'] = s_tmp[col_data_s]
-        s_tmp[col_data_s] = s_tmp[col_data_s] + pd.to_timedelta(d, unit='D')
-        s_tmp['_chave'] = _make_key(s_tmp, col_data_s, col_deb_s, col_cred_s)
-        s_sel = s_tmp[['id_sis', '_chave', col_data_s, 'data_sistema_original', col_deb_s, col_cred_s]].rename(columns={
-            col_data_s: 'data_sistema_ajustada',
-            col_deb_s:  'debito_sistema',
-            col_cred_s: 'credito_sistema',
-        })
+    # monta resultado
+    approx = pd.DataFrame({
+        'id_bco': b['id_bco'].to_numpy()[idx_b],
+        'id_sis': s['id_sis'].to_numpy()[idx_s],
+        'data_banco': b[col_data_b].to_numpy()[idx_b],
+        'debito_banco': b[col_deb_b].to_numpy()[idx_b],
+        'credito_banco': b[col_cred_b].to_numpy()[idx_b],
+        'data_sistema_original': s[col_data_s].to_numpy()[idx_s],
+        'data_sistema_ajustada': s[col_data_s].to_numpy()[idx_s] + offset.astype('timedelta64[D]'),
+        'debito_sistema': s[col_deb_s].to_numpy()[idx_s],
+        'credito_sistema': s[col_cred_s].to_numpy()[idx_s],
+        'offset_dias': offset,
+    })
+    approx = approx.sort_values(['offset_dias', 'data_banco'], kind='stable').reset_index(drop=True)
+
+    pend_banco = b.drop(index=idx_b).drop(columns=['id_bco'])
+    pend_sis   = s.drop(index=idx_s).drop(columns=['id_sis'])
 
-        # merge usando nomes já padronizados -> sem sufixos confusos
-        m = b_sel.merge(s_sel, on='_chave', how='inner')
+    return approx, pend_banco, pend_sis
 
-        if not m.empty:
-            m['offset_dias'] = d
-            conciliados.append(m)
+def liquido_por_dia(df):
+    # Débito − crédito (centavos) de cada data
+    return (df["Débito"] - df["Crédito"]).groupby(df["Data"]).sum()
 
-            # tira IDs já usados para garantir 1-para-1
-            usados_b = set(m['id_bco'])
-            usados_s = set(m['id_sis'])
-            b = b[~b['id_bco'].isin(usados_b)].copy()
-            s = s[~s['id_sis'].isin(usados_s)].copy()
+TOLERANCIA_DIA = 10.00      # diferença aceita (reais) entre os líquidos do mesmo dia
 
-    # monta resultado
-    if conciliados:
-        approx = pd.concat(conciliados, ignore_index=True)
-        approx = approx[['id_bco','id_sis','data_banco','debito_banco','credito_banco',
-                         'data_sistema_original','data_sistema_ajustada','debito_sistema','credito_sistema',
-                         'offset_dias']].sort_values(['offset_dias','data_banco']).reset_index(drop=True)
+def comparar_por_dia(df_extrato, df_sistema, tolerancia=TOLERANCIA_DIA):
+    """
+    Compara o líquido (débito − crédito, centavos) de cada data nos dois
+    lados. Devolve um DataFrame indexado pela data, com Extrato, Sistema,
+    Diferença (Int64; <NA> quando a data falta de um lado) e Bate: a data
+    está nos dois lados e a diferença não passa da `tolerancia` em reais.
+    """
+    dias = pd.concat({"Extrato": liquido_por_dia(df_extrato),
+                      "Sistema": liquido_por_dia(df_sistema)}, axis=1).sort_index()
+    dias = dias.astype("Int64")
+    dias["Diferença"] = dias["Extrato"] - dias["Sistema"]
+    dias["Bate"] = dias["Diferença"].abs().le(round(tolerancia * 100)).fillna(False).astype(bool)
+    return dias
+
+def _colunas_valor(df):
+    return [c for c in df.columns if str(c).startswith(("Débito", "Crédito", "Saldo", "Valor"))]
+
+# Saída
+ABA_RESUMO = "Resumo"
+_LOTE_GRAVACAO = 10_000     # linhas convertidas por vez na gravação
+_EPOCA_EXCEL = np.datetime64("1899-12-30", "D")
+
+def _celulas_excel(serie, valor=False):
+    # Coluna -> valores prontos para o xlsxwriter (None = célula vazia).
+    # Datas viram o número de série do Excel; centavos viram reais
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        numeros = (serie.to_numpy(dtype="datetime64[ns]") - _EPOCA_EXCEL) / np.timedelta64(1, "D")
+    elif valor:
+        numeros = pd.to_numeric(serie, errors="coerce").astype(float).to_numpy() / 100
+    elif pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+        numeros = serie.to_numpy(dtype=float, na_value=np.nan)
     else:
-        approx = pd.DataFrame(columns=[
-            'id_bco','id_sis','data_banco','debito_banco','credito_banco',
-            'data_sistema_original','data_sistema_ajustada','debito_sistema','credito_sistema','offset_dias'
-        ])
+        celulas = serie.to_numpy(dtype=object, copy=True)
+        celulas[pd.isna(celulas)] = None
+        return celulas.tolist()
+    celulas = numeros.astype(object)
+    celulas[np.isnan(numeros)] = None
+    return celulas.tolist()
+
+def _gravar_aba(wb, df, sheet_name, formatos):
+    # Linhas em ordem e em blocos: com constant_memory cada linha vai para o
+    # disco assim que a seguinte começa
+    ws = wb.add_worksheet(sheet_name)
+    valores = set(_colunas_valor(df))
+    for i, col in enumerate(df.columns):
+        if col in valores:
+            ws.set_column(i, i, 14, formatos["valor"])
+        elif pd.api.types.is_datetime64_any_dtype(df[col]):
+            ws.set_column(i, i, None, formatos["data"])
+    ws.write_row(0, 0, [str(col) for col in df.columns], formatos["cabecalho"])
 
-    pend_banco = b.drop(columns=['id_bco'])
-    pend_sis   = s.drop(columns=['id_sis'])
+    r = 1
+    for ini in range(0, len(df), _LOTE_GRAVACAO):
+        bloco = df.iloc[ini:ini + _LOTE_GRAVACAO]
+        colunas = [_celulas_excel(bloco[col], col in valores) for col in bloco.columns]
+        for linha in zip(*colunas):
+            ws.write_row(r, 0, linha)
+            r += 1
+
+# Casamento por soma (um lançamento = vários do outro lado)
+SOMA_LIMITE_DIAS = 5        # distância máxima entre as datas do item e das parcelas
+SOMA_MAX_ITENS = 5          # parcelas por grupo
+SOMA_MAX_CANDIDATOS = 20    # candidatos por item (os mais próximos na data)
+SOMA_TEMPO_LIMITE = float(os.environ.get("CONCILIACAO_SOMA_TEMPO_LIMITE", 5.0))    # segundos por conciliação
+_SOMA_MAX_PISTAS = 8        # palavras guardadas por linha (ver IndiceConciliacao._pistas)
+_PISTA = re.compile(r"[A-Z]{4,}|\d{4,}")
+
+def _palavras(texto):
+    # Pistas de um texto: palavras de 4+ letras (sem acento) e números de 4+ dígitos
+    texto = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode().upper()
+    return _PISTA.findall(texto)
+
+def _somas_da_metade(valores, distancias, max_itens):
+    # Todos os subconjuntos de até max_itens itens: (soma, tamanho, distância, máscara)
+    mascaras = np.arange(1 << len(valores), dtype=np.int64)
+    bits = (mascaras[:, None] >> np.arange(len(valores))) & 1
+    tamanhos = bits.sum(axis=1)
+    ok = tamanhos <= max_itens
+    bits = bits[ok]
+    return bits @ valores, tamanhos[ok], bits @ distancias, mascaras[ok]
+
+def _subconjunto_com_soma(alvo, valores, distancias, max_itens):
+    """
+    Menor subconjunto (2 a max_itens itens; empate: menor distância total)
+    de `valores` (centavos, positivos e menores que `alvo`) que soma
+    exatamente `alvo`.
+    Meet-in-the-middle: as somas de cada metade são enumeradas e cruzadas
+    por busca binária. Retorna as posições escolhidas ou None.
+    """
+    if max_itens == 2:
+        # Só pares: basta a tabela de somas dois a dois
+        i, j = np.nonzero(np.triu(valores[:, None] + valores[None, :] == alvo, 1))
+        if not len(i):
+            return None
+        melhor = np.argmin(distancias[i] + distancias[j])
+        return [int(i[melhor]), int(j[melhor])]
+    meio = len(valores) // 2
+    s1, t1, d1, m1 = _somas_da_metade(valores[:meio], distancias[:meio], max_itens)
+    s2, t2, d2, m2 = _somas_da_metade(valores[meio:], distancias[meio:], max_itens)
+
+    # Para cada soma da 1ª metade basta a melhor combinação
+    ordem = np.lexsort((d1, t1, s1))
+    s1, t1, d1, m1 = s1[ordem], t1[ordem], d1[ordem], m1[ordem]
+    primeira = np.r_[True, s1[1:] != s1[:-1]]
+    s1, t1, d1, m1 = s1[primeira], t1[primeira], d1[primeira], m1[primeira]
+
+    falta = alvo - s2
+    j = np.minimum(np.searchsorted(s1, falta), len(s1) - 1)
+    i2 = np.flatnonzero(s1[j] == falta)
+    i1 = j[i2]
+    tamanho = t1[i1] + t2[i2]
+    ok = (tamanho >= 2) & (tamanho <= max_itens)
+    if not ok.any():
+        return None
+    i1, i2 = i1[ok], i2[ok]
+    melhor = np.lexsort((d1[i1] + d2[i2], tamanho[ok]))[0]
+    mascara1, mascara2 = int(m1[i1[melhor]]), int(m2[i2[melhor]])
+    return ([p for p in range(meio) if mascara1 >> p & 1] +
+            [meio + p for p in range(len(valores) - meio) if mascara2 >> p & 1])
+
+def buscar_por_soma(
+    df_extrato, df_sistema,
+    *,  # força nomeados
+    limite_dias=SOMA_LIMITE_DIAS, max_itens=SOMA_MAX_ITENS,
+    max_candidatos=SOMA_MAX_CANDIDATOS, tempo_limite=SOMA_TEMPO_LIMITE,
+):
+    """
+    Casamentos um-para-muitos entre os pendentes: para cada item (dos dois
+    lados, do maior valor para o menor) procura no outro lado de 2 a
+    `max_itens` itens, até `limite_dias` dias de distância, cuja soma de
+    débito − crédito bate no centavo. Só entram candidatos com o mesmo sinal
+    e valor absoluto menor que o do item, limitados aos `max_candidatos`
+    mais próximos na data. Grupos de mais de 2 parcelas só usam candidatos
+    com uma pista em comum com o item: uma palavra do Histórico ou o
+    Documento (ver _palavras); sem essa exigência, entre muitos pendentes
+    quase sempre há 4 ou 5 valores quaisquer que somam o item.
+    Cada item entra em no máximo um grupo; os itens
+    barrados pelo corte de candidatos são tentados de novo quando outros
+    grupos liberam o corte, então buscar de novo nos pendentes que sobraram
+    não acha grupos novos. A busca para ao estourar `tempo_limite` segundos.
+
+    Retorna DataFrame [Grupo, Origem, id] com id = rótulo do índice de
+    entrada (Origem "Extrato" ou "Sistema"); o item do grupo vem primeiro.
+    """
+    extrato = _prep(df_extrato, 'Data', 'Débito', 'Crédito')
+    sistema = _prep(df_sistema, 'Data', 'Débito', 'Crédito')
+    grupos = IndiceConciliacao(extrato, sistema).casar_por_soma(
+        limite_dias=limite_dias, max_itens=max_itens, max_candidatos=max_candidatos, tempo_limite=tempo_limite)
+    ids = grupos["Origem"].map({"Extrato": 0, "Sistema": 1}).to_numpy()
+    rotulos = (extrato.index.to_numpy(), sistema.index.to_numpy())
+    grupos["id"] = [rotulos[k][p] for k, p in zip(ids, grupos["posicao"].to_numpy())]
+    return grupos[["Grupo", "Origem", "id"]]
+
+# Índice de casamento, compartilhado pelas etapas
+class IndiceConciliacao:
+    """
+    Índice dos dois lados de uma conciliação, montado uma vez e consultado
+    por todas as etapas (exata, data deslocada, soma e dia) no lugar de
+    merges e groupbys refeitos a cada etapa.
+
+    Por lado (0 = extrato, 1 = sistema) guarda, por linha: o código do
+    valor (débito, crédito em centavos, o mesmo nos dois lados), o dia, o
+    líquido e o mapa `usado` das linhas já casadas. As listas de postagem
+    são ordenadas uma vez só: por (valor, dia, posição) para a data
+    deslocada e por (dia, posição) para a soma. Cada etapa só enxerga as
+    linhas não usadas e marca as que casar. As posições recebidas e
+    devolvidas são posições (iloc) nas tabelas de entrada.
+    """
 
-    return approx, pend_banco, pend_sis
+    def __init__(self, extrato, sistema):
+        self.tabelas = (extrato, sistema)
+        corte = len(extrato)
+        debito = np.concatenate([_centavos_int(df["Débito"]) for df in self.tabelas])
+        credito = np.concatenate([_centavos_int(df["Crédito"]) for df in self.tabelas])
+        valor = np.unique(np.stack([debito, credito], axis=1), axis=0, return_inverse=True)[1].reshape(-1)
+        dia = np.concatenate([_dias(df["Data"]) for df in self.tabelas])
+        valida = np.concatenate([df["Data"].notna().to_numpy() for df in self.tabelas])
+
+        def lados(array):
+            return array[:corte], array[corte:]
+        self.valor = lados(valor.astype(np.int64))
+        self.dia = lados(dia)
+        self.liquido = lados(debito - credito)
+        self.valida = lados(valida)
+        self.usado = (np.zeros(corte, dtype=bool), np.zeros(len(sistema), dtype=bool))
+
+        self.por_valor, self.por_dia = [], []
+        for k in (0, 1):
+            posicoes = np.flatnonzero(self.valida[k])
+            self.por_valor.append(posicoes[np.lexsort((self.dia[k][posicoes], self.valor[k][posicoes]))])
+            self.por_dia.append(posicoes[np.argsort(self.dia[k][posicoes], kind="stable")])
+        self._chave = None
+        self._pista = None
+
+    def livres(self, lado):
+        """Posições ainda não casadas do lado (0 = extrato, 1 = sistema)."""
+        return np.flatnonzero(~self.usado[lado])
+
+    def _marcar(self, pos_extrato, pos_sistema):
+        self.usado[0][pos_extrato] = True
+        self.usado[1][pos_sistema] = True
+
+    def _chaves(self):
+        # Chave Procx codificada em comum nos dois lados (só a etapa exata usa)
+        if self._chave is None:
+            codigos, unicas = pd.factorize(pd.concat([df["Chave Procx"] for df in self.tabelas],
+                                                     ignore_index=True), use_na_sentinel=False)
+            corte = len(self.tabelas[0])
+            self._chave = (codigos[:corte], codigos[corte:], len(unicas))
+        return self._chave
+
+    def _pistas(self):
+        # Por lado, matriz linhas x _SOMA_MAX_PISTAS com as palavras do
+        # Histórico e do Documento codificadas em comum nos dois lados; -1
+        # completa as linhas (só a soma usa)
+        if self._pista is None:
+            codigos, self._pista = {}, []
+            for df in self.tabelas:
+                texto = pd.Series("", index=df.index, dtype="string")
+                for col in ("Histórico", "Documento"):
+                    if col in df:
+                        texto = texto + " " + df[col].astype("string").fillna("")
+                rotulos, unicos = pd.factorize(texto)
+                pistas = np.full((len(unicos), _SOMA_MAX_PISTAS), -1, dtype=np.int64)
+                for u, t in enumerate(unicos):
+                    ids = [codigos.setdefault(p, len(codigos)) for p in dict.fromkeys(_palavras(t))]
+                    ids = ids[:_SOMA_MAX_PISTAS]
+                    pistas[u, :len(ids)] = ids
+                self._pista.append(pistas[rotulos])
+        return self._pista
+
+    def casar_exato(self, um_para_um=True, desempate=None):
+        """
+        Mesma Chave Procx (data + valor). 1-para-1: a k-ésima ocorrência da
+        chave em um lado com a k-ésima no outro (ver _ocorrencias); senão,
+        todos os pares de cada chave. Primeira etapa: parte das tabelas
+        inteiras. Devolve (pos_extrato, pos_sistema), na ordem do extrato.
+        """
+        chave_e, chave_s, n = self._chaves()
+        qtd_e = np.bincount(chave_e, minlength=n)
+        qtd_s = np.bincount(chave_s, minlength=n)
+        if not um_para_um:
+            # Cada linha do extrato com todas as do sistema de mesma chave
+            pos_e = np.flatnonzero(qtd_s[chave_e] > 0)
+            unicas, inicio, tamanho, itens = _celulas(chave_s)
+            celula = np.searchsorted(unicas, chave_e[pos_e])
+            vezes = tamanho[celula]
+            passo = np.arange(vezes.sum()) - np.repeat(np.cumsum(vezes) - vezes, vezes)
+            pos_s = itens[np.repeat(inicio[celula], vezes) + passo]
+            pos_e = np.repeat(pos_e, vezes)
+        else:
+            ocorr_e, ocorr_s = _ocorrencias(*self.tabelas, desempate)
+            pos_e = np.flatnonzero(ocorr_e < qtd_s[chave_e])
+            casadas_s = np.flatnonzero(ocorr_s < qtd_e[chave_s])
+            # Alinha os dois lados por (chave, ocorrência)
+            ordem_e = np.lexsort((ocorr_e[pos_e], chave_e[pos_e]))
+            ordem_s = np.lexsort((ocorr_s[casadas_s], chave_s[casadas_s]))
+            pos_s = np.empty_like(pos_e)
+            pos_s[ordem_e] = casadas_s[ordem_s]
+        self._marcar(pos_e, pos_s)
+        return pos_e, pos_s
+
+    def casar_janela(self, limite_frente, limite_tras=0):
+        """
+        Mesmo valor, sistema até `limite_frente` dias antes do extrato ou
+        até `limite_tras` depois (ver _varrer_janela). Devolve (pos_extrato,
+        pos_sistema, deslocamento = dia do extrato − dia do sistema).
+        """
+        vazio = np.empty(0, dtype=np.int64)
+        itens = [p[~self.usado[k][p]] for k, p in enumerate(self.por_valor)]
+        if not len(itens[0]) or not len(itens[1]):
+            return vazio, vazio, vazio
+        janela = max(limite_frente, limite_tras)
+        dias = [self.dia[k][itens[k]] for k in (0, 1)]
+        menor = min(d.min() for d in dias)
+        largura = max(d.max() for d in dias) - menor + 2 * janela + 1
+
+        # Postagens já em ordem de (valor, dia): as células são os trechos de mesma chave
+        celulas = []
+        for k in (0, 1):
+            chave = self.valor[k][itens[k]] * largura + (dias[k] - menor + janela)
+            inicio = np.flatnonzero(np.r_[True, chave[1:] != chave[:-1]])
+            celulas.append((chave[inicio], inicio, np.diff(np.r_[inicio, len(chave)]), itens[k]))
+
+        pos_e, pos_s, deslocamento = _varrer_janela(celulas[0], celulas[1], limite_frente, limite_tras)
+        self._marcar(pos_e, pos_s)
+        return pos_e, pos_s, deslocamento
+
+    def casar_por_soma(self, limite_dias=SOMA_LIMITE_DIAS, max_itens=SOMA_MAX_ITENS,
+                       max_candidatos=SOMA_MAX_CANDIDATOS, tempo_limite=SOMA_TEMPO_LIMITE):
+        """
+        Um-para-muitos entre as linhas livres (ver buscar_por_soma).
+        Devolve DataFrame [Grupo, Origem, posicao]; o item do grupo vem primeiro.
+        """
+        # Itens do maior valor absoluto para o menor, dos dois lados
+        alvos = [(abs(int(self.liquido[k][i])), k, i) for k in (0, 1)
+                 for i in np.flatnonzero(self.valida[k] & ~self.usado[k] & (self.liquido[k] != 0)).tolist()]
+        alvos.sort(key=lambda a: -a[0])
+
+        # Um item que não casou com a janela cortada em max_candidatos pode
+        # casar depois que outros grupos tiram linhas do corte (entram as
+        # seguintes); sem corte, perder candidatos nunca cria uma soma. Esses
+        # itens ficam guardados e voltam quando uma linha casada cai dentro
+        # do corte, até não sair grupo novo: rodar de novo sobre os pendentes
+        # (EstadoConciliacao) não acha grupos novos
+        grupos = []
+        cortados = {}       # (lado, posição) -> (alvo, distância do corte)
+        prazo = time.perf_counter() + tempo_limite
+        while alvos:
+            antes = len(grupos)
+            novos = self._passada_soma(grupos, alvos, prazo, limite_dias, max_itens, max_candidatos)
+            if novos is None:
+                break
+            cortados.update(((k, i), (alvo, corte)) for alvo, k, i, corte in novos)
+            if len(grupos) == antes:
+                break
+            # Linhas casadas nesta passada que estavam no corte de cada item
+            casados = []
+            for k in (0, 1):
+                posicoes = np.array([p for _, lado, itens in grupos[antes:] if lado == k for p in itens],
+                                    dtype=np.int64)
+                casados.append((self.dia[k][posicoes], self.liquido[k][posicoes]))
+            alvos = []
+            for (k, i), (alvo, corte) in cortados.items():
+                dias, valores = casados[1 - k]
+                if not self.usado[k][i] and np.any(
+                        (np.abs(dias - self.dia[k][i]) <= corte) & (np.abs(valores) < alvo)
+                        & ((valores > 0) if self.liquido[k][i] > 0 else (valores < 0))):
+                    alvos.append((alvo, k, i))
+            alvos.sort(key=lambda a: (-a[0], a[1], a[2]))
+            for _, k, i in alvos:
+                del cortados[k, i]
+
+        origens = ("Extrato", "Sistema")
+        return pd.DataFrame(
+            [(grupo, origens[k], p) for grupo, k, posicoes in grupos for p in posicoes],
+            columns=["Grupo", "Origem", "posicao"],
+        )
+
+    def _passada_soma(self, grupos, alvos, prazo, limite_dias, max_itens, max_candidatos):
+        # Uma passada do casar_por_soma pelos `alvos`, acrescentando em
+        # `grupos`. Devolve os que não casaram com a janela cortada
+        # (alvo, lado, posição, distância do corte), ou None se o prazo estourou
+        lados = []
+        for k, pistas in enumerate(self._pistas()):
+            por_dia = self.por_dia[k][~self.usado[k][self.por_dia[k]]]
+            lados.append({"dia": self.dia[k], "valor": self.liquido[k], "usado": self.usado[k],
+                          "por_dia": por_dia, "dia_ordenado": self.dia[k][por_dia], "pistas": pistas})
+
+        cortados = []
+        for alvo, k, i in alvos:
+            if time.perf_counter() > prazo:
+                return None
+            lado, outro = lados[k], lados[1 - k]
+            if lado["usado"][i]:
+                continue
+
+            dia = lado["dia"][i]
+            ini = np.searchsorted(outro["dia_ordenado"], dia - limite_dias, side="left")
+            fim = np.searchsorted(outro["dia_ordenado"], dia + limite_dias, side="right")
+            candidatos = outro["por_dia"][ini:fim]
+            valores = outro["valor"][candidatos]
+            mesmo_sinal = (valores > 0) if lado["valor"][i] > 0 else (valores < 0)
+            candidatos = candidatos[mesmo_sinal & (np.abs(valores) < alvo) & ~outro["usado"][candidatos]]
+            if len(candidatos) < 2:
+                continue
+
+            distancias = np.abs(outro["dia"][candidatos] - dia)
+            # Pares com qualquer candidato; mais parcelas só com os que têm
+            # pista em comum com o item
+            escolhidos, corte = None, -1
+            for itens in ((2, max_itens) if max_itens > 2 else (2,)):
+                cand, dist = candidatos, distancias
+                if itens > 2:
+                    pista = lado["pistas"][i]
+                    com_pista = np.isin(outro["pistas"][cand], pista[pista >= 0]).any(axis=1)
+                    cand, dist = cand[com_pista], dist[com_pista]
+                if len(cand) < 2:
+                    continue
+                if len(cand) > max_candidatos:
+                    perto = np.argsort(dist, kind="stable")[:max_candidatos]
+                    cand, dist = cand[perto], dist[perto]
+                    corte = max(corte, int(dist.max()))
+                valores = np.abs(outro["valor"][cand])
+                # Poda: nem as maiores parcelas somadas alcançam o item
+                if np.sort(valores)[-itens:].sum() < alvo:
+                    continue
+                posicoes = _subconjunto_com_soma(alvo, valores, dist, itens)
+                if posicoes is not None:
+                    escolhidos = cand[posicoes]
+                    break
+            if escolhidos is None:
+                if corte >= 0:
+                    cortados.append((alvo, k, i, corte))
+                continue
+            lado["usado"][i] = True
+            outro["usado"][escolhidos] = True
+            grupo = len(grupos) // 2 + 1
+            grupos.append((grupo, k, [i]))
+            grupos.append((grupo, 1 - k, escolhidos.tolist()))
+        return cortados
+
+    def casar_por_dia(self, tolerancia=TOLERANCIA_DIA):
+        """
+        Linhas livres das datas cujo líquido (débito − crédito) bate nos dois
+        lados, com diferença até `tolerancia` reais (pelo comparar_por_dia).
+        Devolve (pos_extrato, pos_sistema).
+        """
+        livres, tabelas = [], []
+        for k in (0, 1):
+            posicoes = np.flatnonzero(self.valida[k] & ~self.usado[k])
+            # Data = dia inteiro; o líquido já vem em Débito
+            tabelas.append(pd.DataFrame({"Data": self.dia[k][posicoes], "Débito": self.liquido[k][posicoes],
+                                         "Crédito": 0}))
+            livres.append(posicoes)
+        dias = comparar_por_dia(*tabelas, tolerancia=tolerancia)
+        batem = dias.index[dias["Bate"]].to_numpy()
+        pos_e, pos_s = (p[np.isin(self.dia[k][p], batem)] for k, p in enumerate(livres))
+        self._marcar(pos_e, pos_s)
+        return pos_e, pos_s
+
+def _livres(indice):
+    return len(indice.livres(0)) + len(indice.livres(1))
+
+def _centavos_int(serie):
+    # Centavos int64 (aceita ainda reais, vindos de fora do tratamento)
+    if not pd.api.types.is_integer_dtype(serie):
+        serie = _reais_para_centavos(serie)
+    return serie.to_numpy(dtype=np.int64)
 
 def procecsso(caminho_extrato, caminho_sistema):
-    extrato = tratamento_extrato_bb(caminho_extrato)
-    sistema = tratamento_sistema_BB(caminho_sistema)
-    df_conciliado = concilaicao(extrato, sistema)
-
-    extrato["Crédito"] = to_number_brl(extrato["Crédito"])
-    extrato["Débito"]  = to_number_brl(extrato["Débito"])
-    df_conciliado["Débito_Extrato"] = to_number_brl(df_conciliado["Débito_Extrato"])
-    df_conciliado["Crédito_Extrato"] = to_number_brl(df_conciliado["Crédito_Extrato"])
-    sistema["Crédito"] = to_number_brl(sistema["Crédito"])
-    sistema["Débito"] = to_number_brl(sistema["Débito"])
-
-    # seus cálculos
-    total_credito_extrato = float(extrato["Crédito"].sum(skipna=True))
-    total_debito_extrato  = float(extrato["Débito"].sum(skipna=True))
-    total_credito_sistema = float(sistema["Crédito"].sum(skipna=True))
-    total_debito_sistema = float(sistema["Débito"].sum(skipna=True))
+    with etapa("procecsso") as e:
+        extrato = tratamento_extrato_bb(caminho_extrato)
+        sistema = tratamento_sistema_BB(caminho_sistema)
+        e.entrada = len(extrato) + len(sistema)
+        planilha = conciliar_tratados(extrato, sistema)
+        e.saida = len(planilha)
+    return planilha
+
+def conciliar_tratados(extrato, sistema, **opcoes):
+    # Mesmo fluxo do procecsso, a partir dos DataFrames já tratados
+    return conciliar(extrato, sistema, **opcoes).para_xlsx()
+
+def conciliar_abas(extrato, sistema, **opcoes):
+    """
+    Executa todas as etapas e devolve as abas da planilha final
+    ({nome: DataFrame}). As abas de não identificados mantêm o índice das
+    linhas de entrada.
+    """
+    return conciliar(extrato, sistema, **opcoes).abas()
+
+# Indicadores do Resumo: (chave em ResultadoConciliacao.metricas, rótulo, tipo, movimento)
+INDICADORES = [
+    ("total_credito_sistema", "Total Créditos Base Sistema", "money", "credito"),
+    ("total_debito_sistema", "Total Débito Base Sistema", "money", "debito"),
+    ("total_credito_extrato", "Total Créditos Base Extrato", "money", "credito"),
+    ("total_debito_extrato", "Total Débito Base Extrato", "money", "debito"),
+    ("itens_conciliados", "Quantidade de Itens Conciliados", "text", None),
+    ("conciliados_credito", "Total Itens Conciliados Crédito", "money", "credito"),
+    ("conciliados_debito", "Total Itens Conciliados Débito", "money", "debito"),
+    ("diferenca_credito", "Diferença Líquida", "money_diff", "credito"),
+    ("diferenca_debito", "Diferença líquida", "money_diff", "debito"),
+    ("pendentes_sistema", "Itens Não Identificados - Sistema", "text", None),
+    ("pendentes_extrato", "Itens Não Identificados - Extrato", "text", None),
+]
+
+@dataclass
+class ResultadoConciliacao:
+    """
+    DataFrames de cada etapa (valores em centavos) e os indicadores do
+    Resumo (em reais). Nada é gravado na conciliação: cada formato só é
+    gerado quando pedido (para_xlsx, para_parquet, para_csv, para_json).
+    """
+    conciliados: pd.DataFrame           # chave exata (data + valor)
+    aproximados: pd.DataFrame           # mesmo valor, data deslocada
+    por_soma: pd.DataFrame              # grupos por soma e dias cujo líquido bate
+    pendentes_extrato: pd.DataFrame     # índice das linhas de entrada
+    pendentes_sistema: pd.DataFrame
+    metricas: dict
+
+    @property
+    def resumo(self):
+        rows = [(rotulo, self.metricas[chave], tipo, movimento) for chave, rotulo, tipo, movimento in INDICADORES]
+        return pd.DataFrame(rows, columns=["Indicador", "Valor", "Tipo", "Movimento"], dtype=object)
+
+    def abas(self):
+        """As abas da planilha final ({nome: DataFrame}), na ordem."""
+        return {
+            ABA_RESUMO: self.resumo,
+            "Valores Exatos Conciliados": pd.concat([self.conciliados, self.aproximados], ignore_index=True),
+            "Identificados Por Soma": self.por_soma,
+            "Não Identificados-Extrato": self.pendentes_extrato,
+            "Não Identificados-Sistema": self.pendentes_sistema,
+        }
+
+    def para_xlsx(self, destino=None):
+        """Planilha final (ver gravar_planilha): bytes, ou grava em `destino`."""
+        return gravar_planilha(self.abas(), destino=destino)
+
+    def para_parquet(self, pasta):
+        return exportar_abas(self.abas(), pasta, formato="parquet")
+
+    def para_csv(self, pasta):
+        return exportar_abas(self.abas(), pasta, formato="csv")
+
+    def para_json(self, destino=None):
+        """
+        {"metricas": {...}, "abas": {nome: [linhas]}}, valores em centavos e
+        datas ISO. Sem `destino` devolve o texto; com ele (caminho) grava lá.
+        """
+        abas = [(nome, df) for nome, df in self.abas().items() if nome != ABA_RESUMO]
+        with etapa("exportacao_json", entrada=sum(len(df) for _, df in abas)):
+            texto = '{"metricas": %s, "abas": {%s}}' % (
+                json.dumps(self.metricas, ensure_ascii=False),
+                ", ".join("%s: %s" % (json.dumps(nome, ensure_ascii=False),
+                                      df.to_json(orient="records", date_format="iso", force_ascii=False))
+                          for nome, df in abas))
+        if destino is None:
+            return texto
+        with open(destino, "w", encoding="utf-8") as f:
+            f.write(texto)
+
+def conciliar(extrato, sistema, limite_dias=LIMITE_DIAS, limite_dias_tras=0, um_para_um=True,
+              soma_limite_dias=SOMA_LIMITE_DIAS, soma_tempo_limite=SOMA_TEMPO_LIMITE,
+              tolerancia_dia=TOLERANCIA_DIA):
+    """
+    Executa todas as etapas sobre os DataFrames já tratados e devolve o
+    ResultadoConciliacao. Todas as etapas consultam e marcam o mesmo
+    IndiceConciliacao; o que sobra livre nele são os não identificados.
+    A partir dos arquivos, como no procecsso:
+    conciliar(tratamento_extrato_bb(extrato), tratamento_sistema_BB(sistema)).
+    """
+    with etapa("conciliacao_exata", entrada=len(extrato) + len(sistema)) as e:
+        indice = IndiceConciliacao(extrato, sistema)
+        pos_extrato, pos_sistema = indice.casar_exato(um_para_um=um_para_um)
+        df_conciliado = _tabela_conciliados(extrato, sistema, pos_extrato, pos_sistema)
+        e.saida = len(df_conciliado)
+
+    # seus cálculos (em centavos inteiros; só as métricas viram reais, uma vez)
+    total_credito_extrato = int(extrato["Crédito"].sum())
+    total_debito_extrato  = int(extrato["Débito"].sum())
+    total_credito_sistema = int(sistema["Crédito"].sum())
+    total_debito_sistema = int(sistema["Débito"].sum())
 
     quantidade_itens_conciliados = df_conciliado.shape[0]
-    itens_conciliados_debito = df_conciliado["Débito_Extrato"].sum(skipna=True)
-    itens_conciliados_credito = df_conciliado["Crédito_Extrato"].sum(skipna=True)
-    erp_creditos = sistema['Crédito'].sum(skipna = True)
-    erp_debitos = sistema['Débito'].sum(skipna=True)
-    extrato_creditos = extrato["Crédito"].sum(skipna= True)
-    extrato_debito = extrato["Débito"].sum(skipna = True)
+    itens_conciliados_debito = int(df_conciliado["Débito_Extrato"].sum())
+    itens_conciliados_credito = int(df_conciliado["Crédito_Extrato"].sum())
+    erp_creditos = total_credito_sistema
+    erp_debitos = total_debito_sistema
+    extrato_creditos = total_credito_extrato
+    extrato_debito = total_debito_extrato
     diferenca_liquida_credito = erp_creditos-extrato_creditos
     diferenca_liquida_debito = erp_debitos-extrato_debito
 
-    apenas_sistema = pd.merge(sistema, extrato, how="left", on= 'Chave Procx')
-    apenas_sistema = apenas_sistema[apenas_sistema['Data_y'].isna()]
-    apenas_sistema
-    apenas_extrato = pd.merge(extrato, sistema, how="left", on= 'Chave Procx')
-    apenas_extrato = apenas_extrato[apenas_extrato['Data_y'].isna()]
-    apenas_extrato
-
-    quantidade_itens_nao_conciliados_extratos = apenas_extrato.shape[0]
-    quanitdade_itens_nao_conciliados_sistema = apenas_sistema.shape[0] 
-
-
-    rows = [
-    ("Total Créditos Base Sistema", total_credito_sistema,'money','credito'),
-    ("Total Débito Base Sistema", total_debito_sistema,'money','debito'),
-    ("Total Créditos Base Extrato", total_credito_extrato,'money','credito'),
-    ("Total Débito Base Extrato", total_debito_extrato,'money','debito'),
-    ("Quantidade de Itens Conciliados",quantidade_itens_conciliados,  'text', None),
-    ("Total Itens Conciliados Crédito",itens_conciliados_credito, 'money', "credito"),
-    ("Total Itens Conciliados Débito",itens_conciliados_debito,     'money', "debito"),
-    ("Diferença Líquida",diferenca_liquida_credito,'money_diff', "credito"),
-    ("Diferença líquida",diferenca_liquida_debito, 'money_diff', 'debito'),
-    ("Itens Não Identificados - Sistema",quanitdade_itens_nao_conciliados_sistema,'text',None),
-    ("Itens Não Identificados - Extrato", quantidade_itens_nao_conciliados_extratos,'text', None)
-    
-    ]
-    aprox, pend_banco, pend_sis = buscar_aproximado_data_pra_frente(
-        apenas_extrato, apenas_sistema,
-        col_data_b='Data_x', col_deb_b='Débito_x', col_cred_b='Crédito_x',
-        col_data_s='Data_x', col_deb_s='Débito_x', col_cred_s='Crédito_x',
-        limite_dias=10  # testa +1 até +10 dias
-        )
-
-    aprox = aprox[["data_banco","debito_banco","credito_banco","data_sistema_original","debito_sistema","credito_sistema"]]
-    aprox.columns = ["Data_Extrato","Débito_Extrato","Crédito_Extrato","Data_Sistema","Débito_Sistema","Crédito_Sistema"]
-    df_conciliado = pd.concat([df_conciliado,aprox], ignore_index=True)
-
-        # Dicionário para salvar os resultados do extrato
-    resultado_extrato = {}
-    for nome, grupos in apenas_extrato.groupby("Data_x"):
-        soma_extrato_debito = round(grupos["Débito_x"].sum(), 2)
-        soma_extrato_credito = round(grupos["Crédito_x"].sum(), 2)
-        resultado_credito_debito = soma_extrato_debito - soma_extrato_credito
-        resultado_extrato[nome] = resultado_credito_debito
-
-    # Dicionário para salvar os resultados do sistema
-    resultado_sistema = {}
-    for nome, grupos in apenas_sistema.groupby("Data_x"):
-        soma_sistema_debito = round(grupos["Débito_x"].sum(), 2)
-        soma_sistema_credito = round(grupos["Crédito_x"].sum(), 2)
-        resultado_credito_debito = soma_sistema_debito - soma_sistema_credito
-        resultado_sistema[nome] = round(resultado_credito_debito, 2)
-
-    # Lista para guardar datas que bateram
-    datas_iguais = []
-
-    # Defina a tolerância
-    TOLERANCIA = 10.00
-
-    # Comparando os dois
-    for data in resultado_extrato:
-        valor_extrato = resultado_extrato[data]
-        valor_sistema = resultado_sistema.get(data, None)
-
-        if valor_sistema is None:
-            print(f"⚠️ Data {data} está no extrato mas não no sistema.")
-        elif abs(valor_extrato - valor_sistema) <= TOLERANCIA:  # <<--- tolerância
-            print(f"✅ {data} | Valores próximos (diferença ≤ {TOLERANCIA}): "
-                f"Extrato={valor_extrato} | Sistema={valor_sistema}")
-            datas_iguais.append(data)
-        else:
-            print(f"❌ {data} | Extrato: {valor_extrato} | Sistema: {valor_sistema}")
-
-
-    # Extrato
-    extrato_resumo = apenas_extrato.groupby("Data_x").apply(
-        lambda g: round(g["Débito_x"].sum() - g["Crédito_x"].sum(), 2)
-    ).reset_index(name="resultado_extrato")
-
-    # Sistema
-    sistema_resumo = apenas_sistema.groupby("Data_x").apply(
-        lambda g: round(g["Débito_x"].sum() - g["Crédito_x"].sum(), 2)
-    ).reset_index(name="resultado_sistema")
-    comparacao = extrato_resumo.merge(sistema_resumo, on="Data_x", how="inner")
-
-    # Apenas datas onde os resultados são iguais
-    datas_ok = comparacao[
-        comparacao["resultado_extrato"] == comparacao["resultado_sistema"]
-    ]["Data_x"]
-    # Filtra no extrato
-    extrato_filtrado = apenas_extrato[apenas_extrato["Data_x"].isin(datas_ok)]
-    extrato_filtrado = extrato_filtrado[["Data_x","Histórico_x","Documento","Débito_x","Crédito_x","Saldo_x"]]
-    extrato_filtrado.columns = ["Data","Historico","Documento","Débito","Crédito","Saldo"]
-    extrato_filtrado["Origem"] = "Extrato"
-    # Filtra no sistema
-    sistema_filtrado = apenas_sistema[apenas_sistema["Data_x"].isin(datas_ok)]
-    sistema_filtrado = sistema_filtrado[["Data_x","Histórico_x","Documento","Débito_x","Crédito_x","Saldo_x"]]
-    sistema_filtrado.columns = ["Data","Historico","Documento","Débito","Crédito","Saldo"]
-    sistema_filtrado["Origem"] = "Sistema"
-
-    # Junta os dois em um só (opcional)
-    novo_dataframe = pd.concat([extrato_filtrado, sistema_filtrado], ignore_index=True)
-
-        # Remove as datas que bateram dos DataFrames de não identificados
-    apenas_extrato = apenas_extrato[~apenas_extrato["Data_x"].isin(datas_iguais)]
-    apenas_sistema = apenas_sistema[~apenas_sistema["Data_x"].isin(datas_iguais)]
-
-    apenas_extrato = apenas_extrato[["Data_x","Histórico_x","Documento","Débito_x","Crédito_x","Saldo_x"]]
-    apenas_extrato.columns = ["Data","Historico","Documento","Débito","Crédito","Saldo"]
-    apenas_extrato = apenas_extrato[~apenas_extrato.iloc[:,1].str.contains(r'500 Tar DOC/TED', case=False, na=False)] 
-
-    apenas_sistema = apenas_sistema[["Data_x","Histórico_x","Documento","Débito_x","Crédito_x","Saldo_x"]]
-    apenas_sistema.columns = ["Data","Historico","Documento","Débito","Crédito","Saldo"]
-
-    buffer = io.BytesIO()
-
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-        df_conciliado.to_excel(writer, sheet_name="Valores Exatos Conciliados", index=False)
-        novo_dataframe.to_excel(writer, sheet_name="Identificados Por Soma", index=False)
-        apenas_extrato.to_excel(writer, sheet_name="Não Identificados-Extrato", index=False)
-        apenas_sistema.to_excel(writer, sheet_name="Não Identificados-Sistema", index=False)
-
-        
-    buffer.seek(0)
-    return buffer.getvalue()  # bytes prontos para download
+    with etapa("conciliacao_aproximada", entrada=_livres(indice)) as e:
+        # sistema até limite_dias dias antes do banco, ou até limite_dias_tras depois
+        pos_extrato, pos_sistema, deslocamento = indice.casar_janela(limite_dias, limite_dias_tras)
+        aprox = pd.DataFrame({
+            "Data_Extrato": extrato["Data"].to_numpy()[pos_extrato],
+            "Débito_Extrato": _centavos_int(extrato["Débito"])[pos_extrato],
+            "Crédito_Extrato": _centavos_int(extrato["Crédito"])[pos_extrato],
+            "Data_Sistema": sistema["Data"].to_numpy()[pos_sistema],
+            "Débito_Sistema": _centavos_int(sistema["Débito"])[pos_sistema],
+            "Crédito_Sistema": _centavos_int(sistema["Crédito"])[pos_sistema],
+        })
+        # Menor deslocamento primeiro; no empate, o sistema antes do banco (deslocamento
+        # positivo, como o `antes` do consolidado), depois data e posição no extrato
+        ordem = np.lexsort((pos_extrato, aprox["Data_Extrato"].to_numpy(), deslocamento < 0, np.abs(deslocamento)))
+        aprox = aprox.take(ordem).reset_index(drop=True)
+        e.saida = len(aprox)
+
+    with etapa("conciliacao_por_soma", entrada=_livres(indice)) as e:
+        grupos_soma = indice.casar_por_soma(limite_dias=soma_limite_dias, tempo_limite=soma_tempo_limite)
+        partes = []
+        for origem, tabela in (("Extrato", extrato), ("Sistema", sistema)):
+            grupo = grupos_soma[grupos_soma["Origem"] == origem]
+            linhas = tabela.take(grupo["posicao"]).reindex(columns=["Data","Histórico","Documento","Débito","Crédito","Saldo"])
+            linhas.columns = ["Data","Historico","Documento","Débito","Crédito","Saldo"]
+            linhas.index = grupo.index
+            linhas["Origem"] = origem
+            linhas["Grupo"] = "Soma " + grupo["Grupo"].astype(str)
+            partes.append(linhas)
+        por_soma = pd.concat(partes).sort_index()
+        e.saida = grupos_soma["Grupo"].nunique()
+
+    with etapa("somas_por_dia", entrada=_livres(indice)) as e:
+        # Dias cujo líquido bate nos dois lados vão para a aba junto com os
+        # grupos por soma e saem dos não identificados
+        partes = [por_soma]
+        for origem, tabela, posicoes in zip(("Extrato", "Sistema"), (extrato, sistema),
+                                            indice.casar_por_dia(tolerancia_dia)):
+            filtrado = tabela.take(posicoes).reindex(columns=["Data","Histórico","Documento","Débito","Crédito","Saldo"])
+            filtrado.columns = ["Data","Historico","Documento","Débito","Crédito","Saldo"]
+            filtrado["Origem"] = origem
+            filtrado["Grupo"] = "Dia " + filtrado["Data"].dt.strftime("%d/%m/%Y")
+            partes.append(filtrado)
+        novo_dataframe = pd.concat(partes, ignore_index=True)
+
+        apenas_extrato = extrato.take(indice.livres(0))
+        apenas_sistema = sistema.take(indice.livres(1))
+        apenas_extrato = apenas_extrato.reindex(columns=["Data","Histórico","Documento","Débito","Crédito","Saldo"])
+        apenas_extrato.columns = ["Data","Historico","Documento","Débito","Crédito","Saldo"]
+        apenas_extrato = apenas_extrato[~apenas_extrato.iloc[:,1].str.contains(r'500 Tar DOC/TED', case=False, na=False)] 
+
+        apenas_sistema = apenas_sistema.reindex(columns=["Data","Histórico","Documento","Débito","Crédito","Saldo"])
+        apenas_sistema.columns = ["Data","Historico","Documento","Débito","Crédito","Saldo"]
+        e.saida = len(novo_dataframe)
+
+    metricas = {
+        "total_credito_sistema": total_credito_sistema / 100,
+        "total_debito_sistema": total_debito_sistema / 100,
+        "total_credito_extrato": total_credito_extrato / 100,
+        "total_debito_extrato": total_debito_extrato / 100,
+        "itens_conciliados": quantidade_itens_conciliados,
+        "conciliados_credito": itens_conciliados_credito / 100,
+        "conciliados_debito": itens_conciliados_debito / 100,
+        "diferenca_credito": diferenca_liquida_credito / 100,
+        "diferenca_debito": diferenca_liquida_debito / 100,
+        # Pendentes depois de todas as etapas (os mesmos das abas de não identificados)
+        "pendentes_sistema": apenas_sistema.shape[0],
+        "pendentes_extrato": apenas_extrato.shape[0],
+    }
+    return ResultadoConciliacao(df_conciliado, aprox, novo_dataframe, apenas_extrato, apenas_sistema, metricas)
+
+def gravar_planilha(abas, destino=None):
+    """
+    Grava as abas ({nome: DataFrame}, na ordem em que devem aparecer) em
+    XLSX; a aba ABA_RESUMO sai estilizada (write_resumo_sheet). Usa o
+    constant_memory do xlsxwriter, então a memória da gravação não cresce
+    com o tamanho das abas. Com `destino` (caminho ou arquivo) grava lá e
+    devolve None; sem ele devolve os bytes.
+    """
+    buffer = io.BytesIO() if destino is None else destino
+
+    with etapa("gravacao_xlsx", entrada=sum(len(df) for df in abas.values())) as e:
+        wb = xlsxwriter.Workbook(buffer, {"constant_memory": True,
+                                          "strings_to_formulas": False, "strings_to_urls": False})
+        formatos = {
+            "cabecalho": wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"}),
+            "data": wb.add_format({"num_format": "dd/mm/yyyy"}),
+            "valor": wb.add_format({"num_format": "#,##0.00"}),
+        }
+        try:
+            for nome, df in abas.items():
+                if nome == ABA_RESUMO:
+                    write_resumo_sheet(wb, list(df.itertuples(index=False, name=None)), nome)
+                else:
+                    _gravar_aba(wb, df, nome, formatos)
+        finally:
+            wb.close()
+        if destino is None:
+            e.saida = buffer.tell()
+
+    if destino is None:
+        return buffer.getvalue()  # bytes prontos para download
+
+def exportar_abas(abas, pasta, formato="csv"):
+    """
+    Grava cada aba também como tabela, em `pasta`: "csv" (separador ";",
+    vírgula decimal, valores em reais, para abrir no Excel) ou "parquet"
+    (colunas tipadas, valores em centavos; requer pyarrow). Devolve os caminhos.
+    """
+    if formato not in ("csv", "parquet"):
+        raise ValueError("Formato de tabela desconhecido: %r" % (formato,))
+    os.makedirs(pasta, exist_ok=True)
+    caminhos = []
+    with etapa("exportacao_%s" % formato, entrada=sum(len(df) for df in abas.values())):
+        for nome, df in abas.items():
+            caminho = os.path.join(pasta, "%s.%s" % (nome, formato))
+            if formato == "parquet":
+                df.to_parquet(caminho, index=False)
+            else:
+                saida = df.copy()
+                if nome != ABA_RESUMO:
+                    for col in _colunas_valor(saida):
+                        saida[col] = pd.to_numeric(saida[col], errors="coerce").astype(float) / 100
+                saida.to_csv(caminho, index=False, sep=";", decimal=",", encoding="utf-8-sig",
+                             date_format="%d/%m/%Y", float_format="%.2f")
+            caminhos.append(caminho)
+    return caminhos
     
 
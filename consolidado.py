@@ -0,0 +1,223 @@
+"""
+Conciliação consolidada de várias contas, com transferências entre elas.
+
+    abas = consolidado.conciliar_contas({
+        "BB 1234-5": (extrato_bb, sistema_bb),        # DataFrames já tratados
+        "Caixa 987-0": (extrato_cx, sistema_cx),
+    })
+    cc.gravar_planilha(abas, destino="Conciliação_Consolidada.xlsx")
+
+As contas vão para uma tabela só (carregar: coluna Conta categórica e
+índice único entre contas) e cada uma passa pelo mesmo conciliar_abas da
+conciliação individual. Depois, as sobras de todas as contas são casadas
+entre si: um débito em uma conta e um crédito do mesmo valor em outra,
+com datas a até TRANSFERENCIA_LIMITE_DIAS dias, é uma transferência entre
+contas próprias e sai dos não identificados. O casamento percorre a
+janela um deslocamento por vez e, em cada um, casa as linhas de mesma
+ordem dentro de cada (valor, dia), com no máximo
+TRANSFERENCIA_MAX_CANDIDATOS tentativas por linha; então o custo cresce
+com o total de linhas e não com o número de pares de contas nem com
+quantas linhas repetem o mesmo valor no mesmo dia.
+"""
+import numpy as np
+import pandas as pd
+
+import conciliacao_v1 as cc
+from instrumentacao import etapa
+
+TRANSFERENCIA_LIMITE_DIAS = 3   # distância máxima entre as datas da saída e da entrada
+TRANSFERENCIA_MAX_CANDIDATOS = 9    # entradas tentadas por saída em cada (valor, dia) e deslocamento
+ABA_TRANSFERENCIAS = "Transferências Entre Contas"
+ABA_RESUMO_CONTAS = "Resumo Por Conta"
+_ABAS_PENDENTES = (("Extrato", "Não Identificados-Extrato"), ("Sistema", "Não Identificados-Sistema"))
+
+def carregar(contas):
+    """
+    {conta: (extrato, sistema)} -> (extrato, sistema) com todas as contas:
+    coluna Conta categórica (na ordem de `contas`) e índice 0..n-1.
+    """
+    tipo_conta = pd.CategoricalDtype(list(contas))
+    tabelas = []
+    for lado in (0, 1):
+        partes = [par[lado].assign(Conta=pd.Categorical([nome] * len(par[lado]), dtype=tipo_conta))
+                  for nome, par in contas.items()]
+        tabelas.append(cc._categorizar(pd.concat(partes, ignore_index=True)))
+    return tuple(tabelas)
+
+def _por_conta(df):
+    # Posições das linhas de cada conta, em uma passada
+    return df.groupby("Conta", observed=True, sort=False).indices
+
+def detectar_transferencias(pendentes, limite_dias=TRANSFERENCIA_LIMITE_DIAS,
+                            max_candidatos=TRANSFERENCIA_MAX_CANDIDATOS):
+    """
+    Casa débitos e créditos de mesmo valor de contas diferentes, com a
+    entrada até `limite_dias` dias antes ou depois da saída; cada linha entra
+    em no máximo um par, os de datas mais próximas primeiro (no empate, a
+    entrada depois da saída). Em cada deslocamento, dentro de cada (valor,
+    dia), a k-ésima saída livre (na ordem das linhas) tenta a k-ésima
+    entrada livre e, se ela for da mesma conta ou já tiver par, as de ordem
+    k+1, k−1, k+2..., até `max_candidatos` tentativas. `pendentes`: Conta, Data, Débito,
+    Crédito (centavos), índice único. Devolve DataFrame com id_debito,
+    id_credito e dias (data do crédito − do débito).
+    """
+    pendentes = pendentes[pendentes["Data"].notna()]
+    lados = []
+    for coluna in ("Débito", "Crédito"):
+        linhas = pendentes[pendentes[coluna] > 0].sort_index()
+        lados.append({
+            "id": linhas.index.to_numpy(dtype=np.int64),
+            "conta": linhas["Conta"].cat.codes.to_numpy(),
+            "valor": linhas[coluna].to_numpy(dtype=np.int64),
+            "dia": cc._dias(linhas["Data"]),
+            "usado": np.zeros(len(linhas), dtype=bool),
+        })
+    debitos, creditos = lados
+
+    # Mais próximos primeiro; no empate, entrada depois da saída
+    deslocamentos = sorted(range(-limite_dias, limite_dias + 1), key=lambda d: (abs(d), d < 0))
+    # Ordem da entrada tentada em relação à da saída: 0, +1, -1, +2...
+    tentativas = sorted(range(-max_candidatos, max_candidatos + 1), key=lambda t: (abs(t), t < 0))[:max_candidatos]
+
+    escolhidos = []
+    for dias in deslocamentos:
+        livres = [np.flatnonzero(~lado["usado"]) for lado in lados]
+        if not len(livres[0]) or not len(livres[1]):
+            break
+        # Célula (valor, dia da saída), codificada em comum nos dois lados;
+        # ordem = posição da linha livre dentro da sua célula
+        chave = np.concatenate([
+            np.stack([debitos["valor"][livres[0]], debitos["dia"][livres[0]]], axis=1),
+            np.stack([creditos["valor"][livres[1]], creditos["dia"][livres[1]] - dias], axis=1),
+        ])
+        celula = np.unique(chave, axis=0, return_inverse=True)[1].reshape(-1)
+        celulas = (celula[:len(livres[0])], celula[len(livres[0]):])
+        ordens = [cc._posicao_no_grupo(c, np.ones(len(c), dtype=np.int64)) for c in celulas]
+        largura = max(len(livres[0]), len(livres[1])) + max_candidatos
+        codigo_credito = celulas[1] * largura + ordens[1]
+        por_codigo = np.argsort(codigo_credito)
+        codigo_ordenado = codigo_credito[por_codigo]
+
+        for tentativa in tentativas:
+            livre_d = ~debitos["usado"][livres[0]]
+            alvo = celulas[0] * largura + ordens[0] + tentativa
+            j = np.minimum(np.searchsorted(codigo_ordenado, alvo), len(codigo_ordenado) - 1)
+            achou = livre_d & (ordens[0] + tentativa >= 0) & (codigo_ordenado[j] == alvo)
+            d = livres[0][achou]
+            c = livres[1][por_codigo[j[achou]]]
+            ok = ~creditos["usado"][c] & (debitos["conta"][d] != creditos["conta"][c])
+            d, c = d[ok], c[ok]
+            debitos["usado"][d] = True
+            creditos["usado"][c] = True
+            escolhidos.append((d, c, np.full(len(d), dias, dtype=np.int64)))
+
+    if not escolhidos:
+        return pd.DataFrame({"id_debito": [], "id_credito": [], "dias": []}, dtype=np.int64)
+    d, c, dias = (np.concatenate(partes) for partes in zip(*escolhidos))
+    # Na ordem de prioridade: distância, entrada depois da saída, data, ordem das linhas
+    ordem = np.lexsort((debitos["id"][d], debitos["dia"][d], dias < 0, np.abs(dias)))
+    return pd.DataFrame({"id_debito": debitos["id"][d][ordem], "id_credito": creditos["id"][c][ordem],
+                         "dias": dias[ordem]})
+
+def _tabela_transferencias(lado, pendentes, pares):
+    debito = pendentes.loc[pares["id_debito"]]
+    credito = pendentes.loc[pares["id_credito"]]
+    return pd.DataFrame({
+        "Lado": lado,
+        "Conta_Débito": debito["Conta"].to_numpy(),
+        "Data_Débito": debito["Data"].to_numpy(),
+        "Historico_Débito": debito["Historico"].to_numpy(),
+        "Conta_Crédito": credito["Conta"].to_numpy(),
+        "Data_Crédito": credito["Data"].to_numpy(),
+        "Historico_Crédito": credito["Historico"].to_numpy(),
+        "Valor": debito["Débito"].to_numpy(),
+        "Dias": pares["dias"].to_numpy(),
+    })
+
+def _juntar_abas(nome, por_conta):
+    # Aba de todas as contas, com a coluna Conta na frente
+    # (as de não identificados mantêm o índice de carregar, único entre contas)
+    df = pd.concat([abas[nome].assign(Conta=conta) for conta, abas in por_conta.items()])
+    if not nome.startswith("Não Identificados"):
+        df = df.reset_index(drop=True)
+    df["Conta"] = pd.Categorical(df["Conta"], categories=list(por_conta))
+    return df[["Conta"] + [c for c in df.columns if c != "Conta"]]
+
+def conciliar_contas(contas, limite_transferencia=TRANSFERENCIA_LIMITE_DIAS, **opcoes):
+    """
+    Concilia cada conta ({conta: (extrato, sistema)}, já tratados; `opcoes`
+    vão para conciliar_abas) e casa as transferências entre contas nas
+    sobras. Devolve as abas da planilha consolidada ({nome: DataFrame}).
+    """
+    if not contas:
+        raise ValueError("Nenhuma conta para conciliar.")
+    extratos, sistemas = carregar(contas)
+    linhas_extrato, linhas_sistema = _por_conta(extratos), _por_conta(sistemas)
+    vazio = np.empty(0, dtype=np.int64)
+
+    por_conta = {}
+    for conta in contas:
+        with etapa("conta/%s" % conta):
+            extrato = extratos.take(linhas_extrato.get(conta, vazio)).drop(columns="Conta")
+            sistema = sistemas.take(linhas_sistema.get(conta, vazio)).drop(columns="Conta")
+            por_conta[conta] = cc.conciliar_abas(extrato, sistema, **opcoes)
+
+    transferencias = []
+    pendentes = {}
+    for lado, nome in _ABAS_PENDENTES:
+        sobras = _juntar_abas(nome, por_conta)
+        with etapa("transferencias_%s" % lado.lower(), entrada=len(sobras)) as e:
+            pares = detectar_transferencias(sobras, limite_dias=limite_transferencia)
+            transferencias.append(_tabela_transferencias(lado, sobras, pares))
+            pendentes[nome] = sobras.drop(index=np.concatenate([pares["id_debito"], pares["id_credito"]]))
+            e.saida = len(pares)
+    transferencias = pd.concat(transferencias, ignore_index=True)
+
+    resumo, resumo_contas = _resumos(por_conta, transferencias, pendentes)
+    return {
+        cc.ABA_RESUMO: resumo,
+        ABA_RESUMO_CONTAS: resumo_contas,
+        "Valores Exatos Conciliados": _juntar_abas("Valores Exatos Conciliados", por_conta),
+        "Identificados Por Soma": _juntar_abas("Identificados Por Soma", por_conta),
+        ABA_TRANSFERENCIAS: transferencias,
+        **pendentes,
+    }
+
+def _resumos(por_conta, transferencias, pendentes):
+    # Indicadores do Resumo de cada conta (pendentes já sem as transferências,
+    # mais as transferências); a aba Resumo soma as contas
+    contas = list(por_conta)
+    resumos = [abas[cc.ABA_RESUMO] for abas in por_conta.values()]
+    linhas = [[indicador, [r["Valor"].iloc[i] for r in resumos], tipo, movimento]
+              for i, (indicador, tipo, movimento)
+              in enumerate(resumos[0][["Indicador", "Tipo", "Movimento"]].itertuples(index=False))]
+
+    por_indicador = {linha[0]: linha for linha in linhas}
+    for lado, nome in _ABAS_PENDENTES:
+        por_indicador["Itens Não Identificados - %s" % lado][1] = _contagem(pendentes[nome]["Conta"], contas)
+
+    for lado in ("Extrato", "Sistema"):
+        do_lado = transferencias[transferencias["Lado"] == lado]
+        enviadas = do_lado.groupby("Conta_Débito", observed=False)["Valor"].sum().reindex(contas, fill_value=0)
+        recebidas = do_lado.groupby("Conta_Crédito", observed=False)["Valor"].sum().reindex(contas, fill_value=0)
+        quantidade = [a + b for a, b in zip(_contagem(do_lado["Conta_Débito"], contas),
+                                            _contagem(do_lado["Conta_Crédito"], contas))]
+        linhas += [
+            ["Transferências Entre Contas - %s" % lado, quantidade, "text", None],
+            ["Transferências Enviadas - %s" % lado, (enviadas / 100).tolist(), "money", "debito"],
+            ["Transferências Recebidas - %s" % lado, (recebidas / 100).tolist(), "money", "credito"],
+        ]
+
+    rows = []
+    for indicador, valores, tipo, movimento in linhas:
+        total = sum(valores)
+        if indicador.startswith("Transferências Entre Contas"):
+            total //= 2     # cada transferência aparece nas duas contas
+        rows.append((indicador, round(total, 2) if isinstance(total, float) else total, tipo, movimento))
+    resumo = pd.DataFrame(rows, columns=["Indicador", "Valor", "Tipo", "Movimento"], dtype=object)
+    resumo_contas = pd.DataFrame({linha[0]: linha[1] for linha in linhas},
+                                 index=pd.Index(contas, name="Conta")).reset_index()
+    return resumo, resumo_contas
+
+def _contagem(conta, contas):
+    return conta.value_counts().reindex(contas, fill_value=0).tolist()
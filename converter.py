@@ -1,16 +1,182 @@
+import hashlib
+import io
 import os
+import re
 import tempfile
-import aspose.pdf as ap
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+from instrumentacao import etapa
+
+# Motores de extração disponíveis
+BACKEND_ASPOSE = "aspose"   # PDF -> XLSX via Aspose (bytes)
+BACKEND_TEXTO = "texto"     # PDF -> tabela em memória a partir da camada de texto
+BACKENDS = (BACKEND_ASPOSE, BACKEND_TEXTO)
+
+# Montagem da tabela a partir das palavras do PDF (em pontos)
+TEXTO_TOLERANCIA_Y = 3      # palavras com "top" até essa distância ficam na mesma linha
+TEXTO_ESPACO_CELULA = 6     # palavras mais próximas que isso formam a mesma célula
+TEXTO_MIN_CELULAS = 3       # só linhas de lançamento com pelo menos N células definem as colunas
+
+# Número no formato brasileiro sem sufixo (ex.: "1.234,56", "-10,00")
+_NUMERO_BR = re.compile(r"^-?(?:\d{1,3}(?:\.\d{3})+|\d+),\d+$")
+# Células que marcam uma linha de lançamento: data e valor (com ou sem sufixo D/C)
+_DATA_CELULA = re.compile(r"^\d{2}/\d{2}/\d{2,4}$")
+_VALOR_CELULA = re.compile(r"^-?(?:\d{1,3}(?:\.\d{3})+|\d+),\d{2}(?: ?[DC-])?$")
 
 class ConversionError(Exception):
     pass
 
-def convert_pdf_bytes_to_xlsx_bytes(pdf_bytes, minimize_worksheets=True):
+class ConversionCache:
+    """
+    Cache de conversões endereçado pelo conteúdo: a chave é o SHA-256 dos
+    bytes do PDF mais as opções de conversão. Tem uma camada em memória
+    (LRU limitada em bytes) e, se `diretorio` for informado, uma camada em
+    disco com orçamento de bytes e despejo LRU pela data de acesso.
+    """
+
+    def __init__(self, max_bytes_memoria=256 * 2**20, diretorio=None, max_bytes_disco=2 * 2**30):
+        self.max_bytes_memoria = max_bytes_memoria
+        self.max_bytes_disco = max_bytes_disco
+        self.diretorio = diretorio
+        self._memoria = OrderedDict()
+        self._bytes_memoria = 0
+        self._lock = threading.Lock()
+        self.hits_memoria = 0
+        self.hits_disco = 0
+        self.misses = 0
+        if diretorio:
+            os.makedirs(diretorio, exist_ok=True)
+
+    @staticmethod
+    def chave(pdf_bytes, **opcoes):
+        h = hashlib.sha256(pdf_bytes)
+        for nome in sorted(opcoes):
+            h.update(("|%s=%r" % (nome, opcoes[nome])).encode())
+        return h.hexdigest()
+
+    def _caminho(self, chave):
+        return os.path.join(self.diretorio, chave + ".xlsx")
+
+    def _guardar_memoria(self, chave, dados):
+        if len(dados) > self.max_bytes_memoria:
+            return
+        if chave in self._memoria:
+            self._bytes_memoria -= len(self._memoria.pop(chave))
+        self._memoria[chave] = dados
+        self._bytes_memoria += len(dados)
+        while self._bytes_memoria > self.max_bytes_memoria:
+            _, antigo = self._memoria.popitem(last=False)
+            self._bytes_memoria -= len(antigo)
+
+    def get(self, chave):
+        with self._lock:
+            dados = self._memoria.get(chave)
+            if dados is not None:
+                self._memoria.move_to_end(chave)
+                self.hits_memoria += 1
+                return dados
+
+            if self.diretorio:
+                caminho = self._caminho(chave)
+                try:
+                    with open(caminho, "rb") as f:
+                        dados = f.read()
+                    os.utime(caminho)  # marca o acesso para o LRU do disco
+                except OSError:
+                    dados = None
+                if dados:
+                    self._guardar_memoria(chave, dados)
+                    self.hits_disco += 1
+                    return dados
+
+            self.misses += 1
+            return None
+
+    def put(self, chave, dados):
+        with self._lock:
+            self._guardar_memoria(chave, dados)
+            if self.diretorio and len(dados) <= self.max_bytes_disco:
+                # Escrita atômica: outro processo nunca lê um arquivo pela metade
+                fd, tmp = tempfile.mkstemp(dir=self.diretorio, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(dados)
+                os.replace(tmp, self._caminho(chave))
+                self._despejar_disco()
+
+    def _despejar_disco(self):
+        arquivos = []
+        for entrada in os.scandir(self.diretorio):
+            if entrada.name.endswith(".xlsx"):
+                st = entrada.stat()
+                arquivos.append((st.st_mtime, st.st_size, entrada.path))
+        total = sum(tamanho for _, tamanho, _ in arquivos)
+        for _, tamanho, caminho in sorted(arquivos):
+            if total <= self.max_bytes_disco:
+                break
+            try:
+                os.remove(caminho)
+                total -= tamanho
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits_memoria": self.hits_memoria,
+                "hits_disco": self.hits_disco,
+                "misses": self.misses,
+                "itens_memoria": len(self._memoria),
+                "bytes_memoria": self._bytes_memoria,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._memoria.clear()
+            self._bytes_memoria = 0
+            if self.diretorio:
+                for entrada in os.scandir(self.diretorio):
+                    if entrada.name.endswith(".xlsx"):
+                        os.remove(entrada.path)
+
+# Cache padrão do processo (disco só se CONCILIACAO_CACHE_DIR estiver definido)
+conversion_cache = ConversionCache(
+    max_bytes_memoria=int(os.environ.get("CONCILIACAO_CACHE_MEMORIA_MB", "256")) * 2**20,
+    diretorio=os.environ.get("CONCILIACAO_CACHE_DIR") or None,
+    max_bytes_disco=int(os.environ.get("CONCILIACAO_CACHE_DISCO_MB", "2048")) * 2**20,
+)
+
+def convert_pdf_bytes_to_xlsx_bytes(pdf_bytes, minimize_worksheets=True, usar_cache=True, usar_servico=True):
+    """
+    Com `usar_servico` a conversão vai para os processos pré-aquecidos de
+    servico_conversao.py; sem ele roda aqui mesmo (processos que já são
+    workers, como os do lote).
+    """
     if not pdf_bytes:
         raise ValueError("pdf_bytes vazio.")
 
+    if not usar_cache:
+        return _converter(pdf_bytes, minimize_worksheets, usar_servico)
+
+    # Mesmo PDF + mesmas opções -> mesmo XLSX: reaproveita sem reconverter
+    chave = ConversionCache.chave(pdf_bytes, minimize_worksheets=bool(minimize_worksheets))
+    xlsx_bytes = conversion_cache.get(chave)
+    if xlsx_bytes is None:
+        xlsx_bytes = _converter(pdf_bytes, minimize_worksheets, usar_servico)
+        conversion_cache.put(chave, xlsx_bytes)
+    return xlsx_bytes
+
+def _converter(pdf_bytes, minimize_worksheets, usar_servico):
+    if not usar_servico:
+        return _converter_aspose(pdf_bytes, minimize_worksheets)
+    import servico_conversao        # só na 1ª conversão: a interface sobe sem o Aspose
+    return servico_conversao.converter(pdf_bytes, minimize_worksheets)
+
+def _converter_aspose(pdf_bytes, minimize_worksheets):
+    import aspose.pdf as ap
+
     in_tmp = None
-    out_tmp = None
 
     try:
         # Cria um PDF temporário (entrada)
@@ -19,37 +185,241 @@ def convert_pdf_bytes_to_xlsx_bytes(pdf_bytes, minimize_worksheets=True):
         f_in.write(pdf_bytes)
         f_in.close()
 
-        # Cria um XLSX temporário (saída)
-        f_out = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-        out_tmp = f_out.name
-        f_out.close()
-
         # Abre e converte
-        doc = ap.Document(in_tmp)
+        with etapa("conversao_aspose", entrada=len(pdf_bytes)) as e:
+            doc = ap.Document(in_tmp)
+            xlsx_bytes = _salvar_xlsx(doc, minimize_worksheets)
+            e.saida = len(xlsx_bytes)
+        return xlsx_bytes
+
+    except ConversionError:
+        raise
+    except Exception as e:
+        raise ConversionError("Falha na conversão: %s" % e)
+
+    finally:
+        try:
+            if in_tmp and os.path.exists(in_tmp):
+                os.remove(in_tmp)
+        except:
+            pass
+
+def _salvar_xlsx(doc, minimize_worksheets):
+    # Document do Aspose já aberto -> bytes do XLSX
+    import aspose.pdf as ap
+
+    with tempfile.TemporaryDirectory() as pasta:
+        saida = os.path.join(pasta, "saida.xlsx")
         opts = ap.ExcelSaveOptions()
         opts.format = ap.ExcelSaveOptions.ExcelFormat.XLSX
         opts.minimize_the_number_of_worksheets = bool(minimize_worksheets)
+        doc.save(saida, opts)
+        with open(saida, "rb") as f:
+            xlsx_bytes = f.read()
+    if not xlsx_bytes:
+        raise ConversionError("Conversão gerou XLSX vazio.")
+    return xlsx_bytes
 
-        doc.save(out_tmp, opts)
+def _dividir_ou_converter_aspose(pdf_bytes, partes, paginas_min, minimize_worksheets):
+    """
+    Divide o PDF em até `partes` faixas contíguas de páginas, com pelo menos
+    `paginas_min` páginas cada: retorna (PDFs em bytes na ordem das páginas,
+    None). Documento pequeno demais para dividir já é convertido aqui
+    mesmo, sem abrir de novo: retorna (None, xlsx_bytes).
+    """
+    import aspose.pdf as ap
 
-        # Lê bytes do XLSX gerado
-        with open(out_tmp, "rb") as f:
-            xlsx_bytes = f.read()
-        if not xlsx_bytes:
-            raise ConversionError("Conversão gerou XLSX vazio.")
+    with tempfile.TemporaryDirectory() as pasta:
+        try:
+            entrada = os.path.join(pasta, "entrada.pdf")
+            with open(entrada, "wb") as f:
+                f.write(pdf_bytes)
 
-        return xlsx_bytes
+            with etapa("divisao_pdf", entrada=len(pdf_bytes)) as e:
+                doc = ap.Document(entrada)
+                paginas = len(doc.pages)
+                e.saida = paginas
+                partes = min(partes, paginas // max(1, paginas_min))
+                if partes > 1:
+                    # Faixas do mesmo tamanho (a diferença fica em no máximo uma página)
+                    limites = [1 + paginas * k // partes for k in range(partes + 1)]
+                    pdfs = []
+                    for k in range(partes):
+                        parte = ap.Document()
+                        for pagina in range(limites[k], limites[k + 1]):   # páginas do Aspose começam em 1
+                            parte.pages.add(doc.pages[pagina])
+                        saida = os.path.join(pasta, "parte%d.pdf" % k)
+                        parte.save(saida)
+                        with open(saida, "rb") as f:
+                            pdfs.append(f.read())
+                    return pdfs, None
+        except Exception as e:
+            raise ConversionError("Falha ao dividir o PDF: %s" % e)
+
+        try:
+            with etapa("conversao_aspose", entrada=len(pdf_bytes)) as e:
+                xlsx_bytes = _salvar_xlsx(doc, minimize_worksheets)
+                e.saida = len(xlsx_bytes)
+            return None, xlsx_bytes
+        except ConversionError:
+            raise
+        except Exception as e:
+            raise ConversionError("Falha na conversão: %s" % e)
+
+def juntar_xlsx(partes, minimize_worksheets=True):
+    """
+    Junta os XLSX das partes de um PDF na ordem das páginas. Com
+    minimize_worksheets as linhas de todas as partes seguem em uma aba só,
+    como na conversão do documento inteiro (cabeçalhos e rodapés de página
+    ficam onde estavam); sem ele cada aba vira uma aba do resultado.
+    """
+    import xlsxwriter
+
+    import leitor_xlsx
+
+    saida = io.BytesIO()
+    # Datas voltam do leitor como datetime: sem formato de data virariam o
+    # número de série na leitura, diferente da conversão do documento inteiro
+    wb = xlsxwriter.Workbook(saida, {"constant_memory": True, "strings_to_numbers": False,
+                                     "strings_to_formulas": False, "strings_to_urls": False,
+                                     "default_date_format": "dd/mm/yyyy"})
+    with etapa("juntar_xlsx", entrada=len(partes)) as e:
+        aba, linha = None, 0
+        for xlsx_bytes in partes:
+            for planilha in leitor_xlsx.abas(xlsx_bytes):
+                if aba is None or not minimize_worksheets:
+                    aba, linha = wb.add_worksheet(), 0
+                vazias = 0
+                for valores in planilha:
+                    if not any(v is not None and v != "" for v in valores):
+                        vazias += 1     # só entram se vier outra linha com dados depois
+                        continue
+                    linha += vazias
+                    vazias = 0
+                    aba.write_row(linha, 0, valores)
+                    linha += 1
+        e.saida = linha
+    wb.close()
+    return saida.getvalue()
+
+def _normaliza_celula(valor):
+    if valor is None:
+        return None
+    texto = " ".join(str(valor).split())
+    if not texto:
+        return None
+
+    # O Aspose grava números como células numéricas; lidas com dtype=str
+    # elas viram "1234.56". Reproduz isso para os parsers enxergarem o mesmo.
+    if _NUMERO_BR.match(texto):
+        numero = float(texto.replace(".", "").replace(",", "."))
+        return str(int(numero)) if numero.is_integer() else repr(numero)
+    return texto
+
+def _celulas_por_linha(palavras):
+    # Agrupa as palavras em linhas (pela altura) e, dentro da linha, em células
+    linhas = []
+    for w in sorted(palavras, key=lambda w: (w["top"], w["x0"])):
+        if linhas and w["top"] - linhas[-1][0] <= TEXTO_TOLERANCIA_Y:
+            linhas[-1][1].append(w)
+        else:
+            linhas.append((w["top"], [w]))
+
+    resultado = []
+    for _, ws in linhas:
+        celulas = []
+        for w in sorted(ws, key=lambda w: w["x0"]):
+            if celulas and w["x0"] - celulas[-1][1] <= TEXTO_ESPACO_CELULA:
+                x0, _, texto = celulas[-1]
+                celulas[-1] = (x0, w["x1"], texto + " " + w["text"])
+            else:
+                celulas.append((w["x0"], w["x1"], w["text"]))
+        resultado.append(celulas)
+    return resultado
+
+def _linha_de_lancamento(celulas):
+    # Cabeçalhos e rodapés de página ("Conta corrente 12345-6") não têm uma
+    # célula só de data e outra só de valor
+    return (len(celulas) >= TEXTO_MIN_CELULAS
+            and any(_DATA_CELULA.match(texto) for _, _, texto in celulas)
+            and any(_VALOR_CELULA.match(texto) for _, _, texto in celulas))
+
+def _faixas_de_colunas(linhas):
+    # Une os intervalos horizontais das células das linhas de lançamento
+    # (sem nenhuma, das linhas com TEXTO_MIN_CELULAS células); cada faixa
+    # resultante é uma coluna da planilha. As demais linhas só são
+    # distribuídas nessas faixas
+    tabela = [celulas for celulas in linhas if _linha_de_lancamento(celulas)] \
+        or [celulas for celulas in linhas if len(celulas) >= TEXTO_MIN_CELULAS]
+    intervalos = sorted((x0, x1) for celulas in tabela for x0, x1, _ in celulas)
+    faixas = []
+    for x0, x1 in intervalos:
+        if faixas and x0 <= faixas[-1][1]:
+            faixas[-1][1] = max(faixas[-1][1], x1)
+        else:
+            faixas.append([x0, x1])
+    return faixas
 
+def _coluna_da_celula(faixas, x0, x1):
+    sobreposicao = [min(x1, f1) - max(x0, f0) for f0, f1 in faixas]
+    melhor = max(range(len(faixas)), key=sobreposicao.__getitem__)
+    if sobreposicao[melhor] > 0:
+        return melhor
+    centro = (x0 + x1) / 2
+    return min(range(len(faixas)), key=lambda i: abs((faixas[i][0] + faixas[i][1]) / 2 - centro))
+
+def convert_pdf_bytes_to_table(pdf_bytes):
+    """
+    Extrai as linhas da tabela direto da camada de texto do PDF, sem passar
+    por arquivo temporário nem XLSX. Retorna um DataFrame sem cabeçalho, com
+    uma linha por linha de texto (todas as páginas em sequência, como o XLSX
+    do Aspose com minimize_worksheets=True) e None nas células vazias.
+    """
+    if not pdf_bytes:
+        raise ValueError("pdf_bytes vazio.")
+
+    try:
+        import pdfplumber
+    except ImportError:
+        raise ConversionError("Extração por texto requer o pacote pdfplumber.")
+
+    linhas = []
+    try:
+        with etapa("extracao_texto", entrada=len(pdf_bytes)) as medida:
+            with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+                for pagina in pdf.pages:
+                    linhas.extend(_celulas_por_linha(pagina.extract_words()))
+            medida.saida = len(linhas)
     except Exception as e:
-        raise ConversionError("Falha na conversão: %s" % e)
+        raise ConversionError("Falha na extração: %s" % e)
 
-    finally:
-        for path in (in_tmp, out_tmp):
-            try:
-                if path and os.path.exists(path):
-                    os.remove(path)
-            except:
-                pass
+    if not linhas:
+        raise ConversionError("Extração não encontrou linhas de texto no PDF.")
+
+    # Colunas calculadas no documento inteiro: todas as páginas ficam alinhadas
+    faixas = _faixas_de_colunas(linhas) or [[0, float("inf")]]
+    dados = []
+    for celulas in linhas:
+        linha = [None] * len(faixas)
+        for x0, x1, texto in celulas:
+            i = _coluna_da_celula(faixas, x0, x1)
+            linha[i] = texto if linha[i] is None else linha[i] + " " + texto
+        dados.append([_normaliza_celula(c) for c in linha])
+
+    return pd.DataFrame(dados, dtype=object)
+
+def convert_pdf_bytes(pdf_bytes, backend=BACKEND_ASPOSE, minimize_worksheets=True, usar_servico=True):
+    """
+    Converte o PDF com o motor escolhido. O resultado (bytes XLSX ou
+    DataFrame) é aceito diretamente por tratamento_extrato_bb,
+    tratamento_sistema_BB e procecsso.
+    """
+    if backend == BACKEND_ASPOSE:
+        return convert_pdf_bytes_to_xlsx_bytes(pdf_bytes, minimize_worksheets=minimize_worksheets,
+                                               usar_servico=usar_servico)
+    if backend == BACKEND_TEXTO:
+        return convert_pdf_bytes_to_table(pdf_bytes)
+    raise ValueError("Motor de extração desconhecido: %r" % (backend,))
 
 def sniff_output_filename(input_filename):
     base = os.path.basename(input_filename)
@@ -57,4 +427,3 @@ def sniff_output_filename(input_filename):
         base = base[:-4]
 
     return base + ".xlsx"
-
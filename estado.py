@@ -0,0 +1,204 @@
+"""
+Conciliação incremental: guarda em SQLite, por conta, as linhas já vistas
+de extrato e sistema e o que foi decidido sobre cada uma. Uma nova
+execução só concilia as linhas novas contra o que ficou pendente antes,
+então rodar todo dia custa o tamanho do movimento do dia, e os pendentes
+de um mês seguem para o próximo.
+
+    estado = EstadoConciliacao("conciliacao.sqlite")
+    planilha = estado.conciliar("BB 1234-5", extrato_tratado, sistema_tratado)
+"""
+import contextlib
+import datetime as dt
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import conciliacao_v1 as cc
+
+ESTADO_PADRAO = os.environ.get("CONCILIACAO_ESTADO", "conciliacao_estado.sqlite")
+
+_LOTE_CONSULTA = 500         # parâmetros por consulta IN (limite do SQLite é 999)
+
+PENDENTE = "pendente"
+RESOLVIDO = "resolvido"
+
+# Colunas de cada lado como saem de tratamento_extrato_bb / tratamento_sistema_BB
+COLUNAS = {
+    "extrato": ["Data", "Histórico", "Documento", "Débito", "Crédito", "Saldo", "Chave Procx"],
+    "sistema": ["NLanc", "Data", "Histórico", "Débito", "Crédito", "Saldo", "Chave Procx"],
+}
+_SQL_PARA_COLUNA = {"nlanc": "NLanc", "data": "Data", "historico": "Histórico", "documento": "Documento",
+                    "debito": "Débito", "credito": "Crédito", "saldo": "Saldo", "chave": "Chave Procx"}
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS lancamentos (
+    conta      TEXT    NOT NULL,
+    origem     TEXT    NOT NULL,     -- extrato | sistema
+    impressao  INTEGER NOT NULL,     -- hash do conteúdo da linha + ocorrência
+    nlanc      TEXT,
+    data       TEXT,                 -- AAAA-MM-DD
+    historico  TEXT,
+    documento  TEXT,
+    debito     INTEGER NOT NULL,     -- centavos
+    credito    INTEGER NOT NULL,
+    saldo      INTEGER,
+    chave      INTEGER NOT NULL,
+    situacao   TEXT    NOT NULL,     -- pendente | resolvido
+    visto_em   TEXT    NOT NULL,
+    resolvido_em TEXT,
+    PRIMARY KEY (conta, origem, impressao)
+);
+CREATE INDEX IF NOT EXISTS lancamentos_pendentes ON lancamentos (conta, origem, situacao);
+CREATE TABLE IF NOT EXISTS execucoes (
+    conta          TEXT NOT NULL,
+    quando         TEXT NOT NULL,
+    novos_extrato  INTEGER NOT NULL,
+    novos_sistema  INTEGER NOT NULL,
+    resolvidos     INTEGER NOT NULL,
+    pendentes      INTEGER NOT NULL
+);
+"""
+
+def impressoes(df):
+    """
+    Identidade estável de cada linha (int64): hash do conteúdo mais a
+    ordem entre linhas idênticas, para duplicatas legítimas não se fundirem.
+    """
+    conteudo = df.drop(columns=["Chave Procx"], errors="ignore").astype(str)
+    h = pd.util.hash_pandas_object(conteudo, index=False)
+    ocorrencia = h.groupby(h, sort=False).cumcount()
+    h = pd.util.hash_pandas_object(pd.DataFrame({"h": h, "n": ocorrencia}), index=False)
+    return pd.Series((h.to_numpy() >> np.uint64(2)).astype(np.int64), index=df.index)
+
+def _texto(valor):
+    return None if pd.isna(valor) else str(valor)
+
+def _inteiro(valor):
+    return None if pd.isna(valor) else int(valor)
+
+class EstadoConciliacao:
+
+    def __init__(self, caminho=ESTADO_PADRAO):
+        self.caminho = caminho
+        # Contas diferentes podem gravar ao mesmo tempo (lote.py): WAL, espera
+        # no bloqueio e transações explícitas com BEGIN IMMEDIATE
+        self.conexao = sqlite3.connect(caminho, timeout=60, isolation_level=None)
+        self.conexao.execute("PRAGMA journal_mode=WAL")
+        self.conexao.executescript(_ESQUEMA)
+
+    @contextlib.contextmanager
+    def _transacao(self):
+        self.conexao.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conexao.execute("ROLLBACK")
+            raise
+        self.conexao.execute("COMMIT")
+
+    def close(self):
+        self.conexao.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def pendentes(self, conta, origem):
+        """Linhas pendentes da conta, no formato do tratamento, indexadas pela impressão."""
+        df = pd.read_sql_query(
+            "SELECT impressao, nlanc, data, historico, documento, debito, credito, saldo, chave "
+            "FROM lancamentos WHERE conta = ? AND origem = ? AND situacao = ?",
+            self.conexao, params=(conta, origem, PENDENTE), index_col="impressao")
+        df = df.rename(columns=_SQL_PARA_COLUNA)
+        df.index.name = None
+        df["Data"] = pd.to_datetime(df["Data"], format="%Y-%m-%d", errors="coerce")
+        for col in ["Débito", "Crédito", "Chave Procx"]:
+            df[col] = df[col].astype(np.int64)
+        df["Saldo"] = df["Saldo"].astype("Int64")
+        df = df[COLUNAS[origem]]
+        return cc._categorizar(df)
+
+    def _novos(self, conta, origem, df):
+        # Consulta pela chave primária só as impressões do arquivo atual
+        df = df.set_axis(impressoes(df))
+        todas = [int(i) for i in df.index]
+        vistos = set()
+        for ini in range(0, len(todas), _LOTE_CONSULTA):
+            lote = todas[ini:ini + _LOTE_CONSULTA]
+            vistos.update(i for (i,) in self.conexao.execute(
+                "SELECT impressao FROM lancamentos WHERE conta = ? AND origem = ? AND impressao IN (%s)"
+                % ",".join("?" * len(lote)), [conta, origem] + lote))
+        return df[~df.index.isin(vistos)]
+
+    def _gravar_novos(self, conta, origem, df, agora):
+        vazio = [None] * len(df)
+        colunas = zip(
+            df.index,
+            df["NLanc"] if "NLanc" in df else vazio,
+            df["Data"].dt.strftime("%Y-%m-%d"),
+            df["Histórico"],
+            df["Documento"] if "Documento" in df else vazio,
+            df["Débito"], df["Crédito"], df["Saldo"], df["Chave Procx"],
+        )
+        linhas = [
+            (conta, origem, int(impressao), _texto(nlanc), _texto(data), _texto(historico), _texto(documento),
+             int(debito), int(credito), _inteiro(saldo), int(chave), PENDENTE, agora)
+            for impressao, nlanc, data, historico, documento, debito, credito, saldo, chave in colunas
+        ]
+        self.conexao.executemany(
+            "INSERT INTO lancamentos (conta, origem, impressao, nlanc, data, historico, documento, "
+            "debito, credito, saldo, chave, situacao, visto_em) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", linhas)
+
+    def _resolver(self, conta, origem, impressoes_resolvidas, agora):
+        self.conexao.executemany(
+            "UPDATE lancamentos SET situacao = ?, resolvido_em = ? "
+            "WHERE conta = ? AND origem = ? AND impressao = ?",
+            [(RESOLVIDO, agora, conta, origem, int(i)) for i in impressoes_resolvidas])
+
+    def conciliar_abas(self, conta, extrato, sistema, **opcoes):
+        """
+        Concilia só as linhas ainda não vistas da conta, junto com as que
+        ficaram pendentes nas execuções anteriores, e grava as decisões.
+        Devolve as abas como cc.conciliar_abas.
+        """
+        agora = dt.datetime.now().isoformat(timespec="seconds")
+        lados = {}
+        with self._transacao():
+            for origem, df in (("extrato", extrato), ("sistema", sistema)):
+                novos = self._novos(conta, origem, df)
+                self._gravar_novos(conta, origem, novos, agora)
+                lados[origem] = (len(novos), self.pendentes(conta, origem))
+
+        # A conciliação roda fora da transação; se falhar, as linhas novas
+        # ficam gravadas como pendentes, que é o estado correto
+        abas = cc.conciliar_abas(lados["extrato"][1], lados["sistema"][1], **opcoes)
+
+        with self._transacao():
+            # O que não sobrou nas abas de não identificados foi resolvido
+            resolvidos = 0
+            for origem, aba in (("extrato", "Não Identificados-Extrato"), ("sistema", "Não Identificados-Sistema")):
+                pool = lados[origem][1].index
+                feitos = pool[~pool.isin(abas[aba].index)]
+                self._resolver(conta, origem, feitos, agora)
+                resolvidos += len(feitos)
+
+            pendentes = len(abas["Não Identificados-Extrato"]) + len(abas["Não Identificados-Sistema"])
+            self.conexao.execute(
+                "INSERT INTO execucoes VALUES (?,?,?,?,?,?)",
+                (conta, agora, lados["extrato"][0], lados["sistema"][0], resolvidos, pendentes))
+        return abas
+
+    def conciliar(self, conta, extrato, sistema, **opcoes):
+        """Como conciliar_abas, já gravando a planilha (bytes XLSX)."""
+        return cc.gravar_planilha(self.conciliar_abas(conta, extrato, sistema, **opcoes))
+
+    def esquecer(self, conta):
+        """Apaga todo o histórico da conta (a próxima execução recomeça do zero)."""
+        with self._transacao():
+            self.conexao.execute("DELETE FROM lancamentos WHERE conta = ?", (conta,))
+            self.conexao.execute("DELETE FROM execucoes WHERE conta = ?", (conta,))
@@ -0,0 +1,220 @@
+"""
+Medição por etapa: tempo, pico de memória e linhas de entrada/saída.
+
+    with instrumentar(memoria=True) as coletor:
+        planilha = cc.procecsso(extrato, sistema)
+    print(coletor.json())
+
+Dentro do código, cada etapa é marcada com
+
+    with etapa("leitura_extrato", entrada=len(xlsx_bytes)) as e:
+        df = ...
+        e.saida = len(df)
+
+Sem coletor ativo na thread, etapa() devolve um objeto nulo compartilhado
+e não mede nada. Com CONCILIACAO_INSTRUMENTAR=1 no ambiente, toda etapa
+sem coletor é medida e só vai para o log (útil no lote e nos workers).
+Cada registro também é emitido em JSON no logger "conciliacao.instrumentacao".
+
+O tracemalloc é um só no processo: ele fica ligado enquanto alguma thread
+mede memória, e a etapa que dividiu esse tempo com a medição de outra
+thread (dois trabalhos ao mesmo tempo, por exemplo) sai com pico_mb None,
+porque o pico de uma se mistura com o da outra.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger("conciliacao.instrumentacao")
+
+CAMPOS = ["etapa", "nivel", "segundos", "entrada", "saida", "pico_mb", "rss_pico_mb", "processo"]
+
+_local = threading.local()
+
+# Threads medindo memória agora ({id da thread: etapas abertas}) e quantas
+# vezes uma thread começou a medir; protegidos por _memoria_lock
+_memoria_lock = threading.Lock()
+_medindo = {}
+_entradas = 0
+_ligamos_tracemalloc = False
+
+def _comecar_medicao():
+    # Devolve (marca, sozinha): a etapa só vale se nenhuma outra thread
+    # medir até ela terminar (ver _medicao_valida)
+    global _entradas, _ligamos_tracemalloc
+    thread = threading.get_ident()
+    with _memoria_lock:
+        if thread not in _medindo:
+            if not _medindo and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _ligamos_tracemalloc = True
+            _medindo[thread] = 0
+            _entradas += 1
+        _medindo[thread] += 1
+        return _entradas, len(_medindo) == 1
+
+def _medicao_valida(marca, sozinha):
+    with _memoria_lock:
+        return sozinha and _entradas == marca and len(_medindo) == 1
+
+def _terminar_medicao():
+    global _ligamos_tracemalloc
+    thread = threading.get_ident()
+    with _memoria_lock:
+        _medindo[thread] -= 1
+        if _medindo[thread] == 0:
+            del _medindo[thread]
+            if not _medindo and _ligamos_tracemalloc:
+                tracemalloc.stop()
+                _ligamos_tracemalloc = False
+
+def _rss_pico_mb():
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa em KB; macOS em bytes
+    return round(pico / (2**20 if pico > 2**32 else 2**10), 1)
+
+class Coletor:
+    """Guarda os registros das etapas medidas enquanto estiver ativo."""
+
+    def __init__(self, memoria=False, guardar=True):
+        self.memoria = memoria
+        self.guardar = guardar
+        self.registros = []
+        self._abertas = []
+
+    def adicionar(self, registros):
+        # Registros vindos de outro processo (ver processamento.converter_e_tratar)
+        nivel = len(self._abertas)
+        for registro in registros:
+            self._emitir(dict(registro, nivel=registro.get("nivel", 0) + nivel))
+
+    def _emitir(self, registro):
+        if self.guardar:
+            self.registros.append(registro)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(registro, ensure_ascii=False, default=str))
+
+    def em_andamento(self):
+        # Etapas abertas agora, da mais externa à mais interna (lido de outra thread)
+        return [e.nome for e in list(self._abertas)]
+
+    def json(self):
+        return json.dumps(self.registros, ensure_ascii=False, indent=2, default=str)
+
+    def tabela(self):
+        import pandas as pd
+        return pd.DataFrame(self.registros, columns=CAMPOS)
+
+class _Etapa:
+    __slots__ = ("coletor", "nome", "entrada", "saida", "_inicio", "_pico", "_marca", "_sozinha")
+
+    def __init__(self, coletor, nome, entrada):
+        self.coletor = coletor
+        self.nome = nome
+        self.entrada = entrada
+        self.saida = None
+        self._pico = 0
+        self._marca = None
+
+    def __enter__(self):
+        abertas = self.coletor._abertas
+        if self.coletor.memoria:
+            self._marca, self._sozinha = _comecar_medicao()
+            if self._sozinha:
+                if abertas:
+                    # O pico da etapa de fora até aqui não pode se perder no reset
+                    pai = abertas[-1]
+                    pai._pico = max(pai._pico, tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+        abertas.append(self)
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, erro, tb):
+        segundos = time.perf_counter() - self._inicio
+        abertas = self.coletor._abertas
+        abertas.pop()
+
+        registro = {"etapa": self.nome, "nivel": len(abertas), "segundos": round(segundos, 4),
+                    "entrada": self.entrada, "saida": self.saida}
+        if self._marca is not None:
+            if _medicao_valida(self._marca, self._sozinha) and tracemalloc.is_tracing():
+                pico = max(self._pico, tracemalloc.get_traced_memory()[1])
+                if abertas:
+                    abertas[-1]._pico = max(abertas[-1]._pico, pico)
+                registro["pico_mb"] = round(pico / 2**20, 2)
+            else:
+                registro["pico_mb"] = None      # outra thread mediu ao mesmo tempo
+            _terminar_medicao()
+        registro["rss_pico_mb"] = _rss_pico_mb()
+        registro["processo"] = os.getpid()
+        if tipo is not None:
+            registro["erro"] = tipo.__name__
+        self.coletor._emitir(registro)
+        return False
+
+class _EtapaNula:
+    # Sem coletor: nenhum custo além da chamada e do with
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, erro, tb):
+        return False
+
+    def __setattr__(self, nome, valor):
+        pass
+
+_NULA = _EtapaNula()
+_SEMPRE_NO_LOG = os.environ.get("CONCILIACAO_INSTRUMENTAR") == "1"
+if _SEMPRE_NO_LOG and not logger.handlers:
+    # Sem configuração de logging no programa: manda os registros para o stderr
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+def ativo():
+    """Coletor ativo na thread atual (ou None)."""
+    pilha = getattr(_local, "pilha", None)
+    return pilha[-1] if pilha else None
+
+def etapa(nome, entrada=None):
+    coletor = ativo()
+    if coletor is None:
+        if not _SEMPRE_NO_LOG:
+            return _NULA
+        # Um coletor só de log por thread: o aninhamento não se mistura
+        coletor = getattr(_local, "log", None)
+        if coletor is None:
+            coletor = _local.log = Coletor(guardar=False)
+    return _Etapa(coletor, nome, entrada)
+
+class instrumentar:
+    """
+    Ativa um Coletor na thread atual enquanto durar o bloco with. Um
+    `coletor` já criado pode ser passado para outra thread acompanhar o
+    progresso (ver trabalhos.py).
+    """
+
+    def __init__(self, memoria=False, coletor=None):
+        self.coletor = coletor if coletor is not None else Coletor(memoria=memoria)
+
+    def __enter__(self):
+        if not hasattr(_local, "pilha"):
+            _local.pilha = []
+        _local.pilha.append(self.coletor)
+        return self.coletor
+
+    def __exit__(self, tipo, erro, tb):
+        _local.pilha.remove(self.coletor)
+        return False
@@ -1,43 +1,80 @@
 import streamlit as st
 import conciliacao_v1 as  cc
-from converter import convert_pdf_bytes_to_xlsx_bytes, sniff_output_filename, ConversionError
+import layouts
+import servico_conversao
+import trabalhos
+from converter import sniff_output_filename, ConversionError, BACKEND_ASPOSE, BACKEND_TEXTO, conversion_cache
 
 import time 
 
+# Sobe e aquece os processos de conversão em segundo plano (uma vez por servidor)
+servico_conversao.iniciar()
+
 st.title("Conciliação Bancária")
 
 col1, col2, col3 = st.columns(3)
 extrato = st.file_uploader("Selecione o Extrato","pdf")
 sistema = st.file_uploader("Selecione o Arquivo do Sistema","pdf")
-banco = col3.selectbox("Selecione o Banco:", options=["Banco do Brasil","Caixa Econômica"])
+banco = col3.selectbox("Selecione o Banco:", options=list(layouts.EXTRATOS))
+motores = {"Aspose (XLSX)": BACKEND_ASPOSE, "Texto do PDF": BACKEND_TEXTO}
+motor = col2.selectbox("Extração:", options=list(motores))
+medir_etapas = col1.checkbox("Medir etapas")
+reparar = col1.checkbox("Reparar linhas quebradas", help="Corrige linhas do extrato com colunas deslocadas")
+conferencias = {"Interromper": True, "Só avisar": cc.AVISAR_SALDO, "Não conferir": False}
+conferencia = col2.selectbox("Saldo que não fecha:", options=list(conferencias),
+                             help="O que fazer quando o saldo corrente não bate com os lançamentos lidos")
 
 
 if extrato is not None and sistema is not None:
+    # O resultado fica no repositório de trabalhos pela chave das entradas:
+    # reruns e downloads não reprocessam
+    pdf_bytes = extrato.getvalue()
+    pdf2_bytes = sistema.getvalue()
+    trabalho = trabalhos.obter(trabalhos.chave(pdf_bytes, pdf2_bytes, banco, motores[motor], reparar,
+                                               conferencias[conferencia]))
+
     iniciar = st.button("Iniciar Processo")
 
     if iniciar:
-        # reposiciona os ponteiros para o início (seguro em reruns)
-        extrato.seek(0)
-        sistema.seek(0)
-        pdf_bytes = extrato.read()
-        pdf2_bytes = sistema.read()
         try:
-            xlsx_bytes = convert_pdf_bytes_to_xlsx_bytes(pdf_bytes, minimize_worksheets=True)
-            extrato_planilha = xlsx_bytes
-            xlsx_bytes_sistema =  convert_pdf_bytes_to_xlsx_bytes(pdf2_bytes, minimize_worksheets=True)
-            sistema_planilha = xlsx_bytes_sistema
-
-            planilha_final = cc.procecsso(extrato_planilha,sistema_planilha)
-            st.download_button(
-                label="📥 Baixar conciliação.xlsx",
-                data=planilha_final,
-                file_name=f"Conciliação_{banco}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-        except ConversionError as e:
-            st.error("Erro na conversão: %s" % e)
+            trabalho = trabalhos.submeter(pdf_bytes, pdf2_bytes, banco=banco, backend=motores[motor],
+                                          memoria=medir_etapas, reparar=reparar,
+                                          validar_saldo=conferencias[conferencia])
         except Exception as e:
             st.error("Erro inesperado: %s" % e)
 
+    if trabalho is not None and not trabalho.terminado:
+        fracao, atual = trabalho.progresso()
+        st.progress(fracao, text="Processando (%s)..." % (atual or trabalho.estado))
+        time.sleep(1)
+        st.rerun()
+    elif trabalho is not None and trabalho.estado == trabalhos.CONCLUIDO:
+        for aviso in trabalho.avisos:
+            st.warning("Leitura possivelmente inconsistente. %s" % aviso)
+        st.download_button(
+            label="📥 Baixar conciliação.xlsx",
+            data=trabalho.resultado,
+            file_name=f"Conciliação_{banco}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        cache = conversion_cache.stats()
+        st.caption("Cache de conversão: %d reaproveitadas, %d convertidas"
+                   % (cache["hits_memoria"] + cache["hits_disco"], cache["misses"]))
+        if medir_etapas:
+            with st.expander("Tempo e memória por etapa"):
+                st.dataframe(trabalho.coletor.tabela(), hide_index=True)
+                st.download_button("Baixar medições (JSON)", data=trabalho.coletor.json(),
+                                   file_name="medicoes.json", mime="application/json")
+    elif trabalho is not None and isinstance(trabalho.erro, ConversionError):
+        st.error("Erro na conversão: %s" % trabalho.erro)
+    elif trabalho is not None and isinstance(trabalho.erro, cc.SaldoInconsistente):
+        st.error("Leitura inconsistente. %s" % trabalho.erro)
+        st.dataframe(trabalho.erro.quebras)
+        if not reparar:
+            st.caption("Tente de novo com \"Reparar linhas quebradas\" marcado.")
+        st.caption("Para conciliar mesmo assim, escolha \"Só avisar\" em \"Saldo que não fecha\".")
+    elif trabalho is not None:
+        st.error("Erro inesperado: %s" % trabalho.erro)
+
 
 
 
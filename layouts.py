@@ -0,0 +1,182 @@
+"""
+Layouts das planilhas de extrato (por banco) e de sistema (ERP).
+
+Cada layout só descreve a planilha: linhas de cabeçalho/rodapé, padrões
+de linhas a descartar, como achar as colunas e como ler os valores. O
+tratamento (conciliacao_v1.tratar_planilha) é o mesmo para todos. Para
+um banco novo basta registrar um Layout:
+
+    registrar(Layout(nome="Meu Banco", tipo="extrato", ...))
+
+compilar() junta todos os padrões do layout em uma única regex aplicada
+à linha inteira (células unidas por SEPARADOR), então cada linha é
+classificada (dado, descarte ou cabeçalho) em uma só passada.
+"""
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+SEPARADOR = "\x1f"       # une as células de uma linha (não aparece em texto de PDF)
+
+# Classes de linha
+DADO = 0
+DESCARTE = 1
+CABECALHO = 2
+
+# Convenções de débito/crédito
+CONVENCAO_COLUNAS = "colunas"   # colunas Débito e Crédito separadas
+CONVENCAO_SUFIXO = "sufixo"     # coluna Valor com sufixo "D"/"C" ("1.234,56 D")
+CONVENCAO_SINAL = "sinal"       # coluna Valor com sinal (negativo = débito)
+
+# Como os números chegam nas células
+NUMEROS_BRL = "brl"             # texto no formato brasileiro ("1.234,56")
+NUMEROS_DECIMAL = "decimal"     # célula numérica do Aspose, lida como "1234.56"
+
+# Como o saldo corrente anda (para conferir o tratamento, ver conciliacao_v1.verificar_saldo)
+SALDO_BANCO = "banco"           # extrato: saldo += crédito − débito
+SALDO_RAZAO = "razao"           # razão do ERP: saldo += débito − crédito
+
+@dataclass(frozen=True)
+class Layout:
+    nome: str
+    tipo: str                           # "extrato" ou "sistema"
+    topo: int = 0                       # linhas de cabeçalho do relatório
+    rodape: int = 0                     # linhas de rodapé do relatório
+    descartar: tuple = ()               # ((coluna, regex), ...): linha some se a célula casar
+    descartar_vazia: tuple = ()         # colunas que, vazias, descartam a linha
+    cabecalho: tuple = None             # (coluna, regex) da linha com os nomes das colunas
+    pular_apos_cabecalho: int = 0       # linhas de dados ignoradas logo após o 1º cabeçalho
+    tokens: tuple = ()                  # sem cabeçalho: nomes das células não vazias, em ordem
+    colunas: tuple = ()                 # ((nome na planilha, nome canônico), ...)
+    convencao: str = CONVENCAO_COLUNAS
+    numeros: str = NUMEROS_DECIMAL
+    historico_quebrado: bool = False    # linha sem valor continua o histórico da anterior
+    limpar_historico: bool = False      # tira "nan", espaços repetidos e hífens do histórico
+    saldo_corrente: str = None          # SALDO_BANCO, SALDO_RAZAO ou None (não confere)
+
+class LayoutCompilado:
+    """Classificador de linhas de um layout: uma regex, uma passada por linha."""
+
+    def __init__(self, layout):
+        self.layout = layout
+        alternativas = []
+        if layout.cabecalho:
+            coluna, padrao = layout.cabecalho
+            alternativas.append("(?P<cabecalho>%s)" % _na_coluna(coluna, padrao))
+        descartes = [_na_coluna(coluna, padrao) for coluna, padrao in layout.descartar]
+        descartes += [_vazia(coluna) for coluna in layout.descartar_vazia]
+        if descartes:
+            alternativas.append("(?P<descarte>%s)" % "|".join(descartes))
+        self.regex = re.compile("^(?:%s)" % "|".join(alternativas), re.IGNORECASE) if alternativas else None
+        self.renomear = dict(layout.colunas)
+
+    def classificar(self, linhas):
+        """linhas: Series de textos unidos por SEPARADOR -> array de classes."""
+        classes = np.full(len(linhas), DADO, dtype=np.int8)
+        if self.regex is None or not len(linhas):
+            return classes
+        grupos = linhas.str.extract(self.regex)
+        if "descarte" in grupos:
+            classes[grupos["descarte"].notna().to_numpy()] = DESCARTE
+        if "cabecalho" in grupos:
+            classes[grupos["cabecalho"].notna().to_numpy()] = CABECALHO
+        return classes
+
+    def classificar_linha(self, texto):
+        achou = self.regex.match(texto) if self.regex is not None else None
+        if achou is None:
+            return DADO
+        return CABECALHO if achou.groupdict().get("cabecalho") is not None else DESCARTE
+
+def _na_coluna(coluna, padrao):
+    # Pula `coluna` células e procura o padrão dentro da célula seguinte
+    return "(?:[^%s]*%s){%d}[^%s]*?(?:%s)" % (SEPARADOR, SEPARADOR, coluna, SEPARADOR, padrao)
+
+def _vazia(coluna):
+    return "(?:[^%s]*%s){%d}(?=%s|$)" % (SEPARADOR, SEPARADOR, coluna, SEPARADOR)
+
+@lru_cache(maxsize=None)
+def compilar(layout):
+    return LayoutCompilado(layout)
+
+EXTRATOS = {}
+SISTEMAS = {}
+
+def registrar(layout):
+    if layout.tipo not in ("extrato", "sistema"):
+        raise ValueError("Tipo de layout desconhecido: %r" % (layout.tipo,))
+    (EXTRATOS if layout.tipo == "extrato" else SISTEMAS)[layout.nome] = layout
+    return layout
+
+def layout_extrato(banco):
+    try:
+        return EXTRATOS[banco]
+    except KeyError:
+        raise ValueError("Banco sem layout de extrato: %r" % (banco,))
+
+def layout_sistema(nome):
+    try:
+        return SISTEMAS[nome]
+    except KeyError:
+        raise ValueError("Layout de sistema desconhecido: %r" % (nome,))
+
+# Extrato BB: células coladas, lidas como sequência de tokens não vazios
+EXTRATO_BB = registrar(Layout(
+    nome="Banco do Brasil",
+    tipo="extrato",
+    topo=12,
+    rodape=2,
+    descartar=(
+        (0, r"autoatendimento|Evaluation|A CONTA NAO FOI MOVIMENTADA"),
+        (3, r"500 Tar DOC/TED"),
+    ),
+    tokens=("Data", "Agencia de Origem", "Lote", "Historico", "Documento", "Valor", "Saldo"),
+    colunas=(("Historico", "Histórico"),),
+    convencao=CONVENCAO_SUFIXO,
+    numeros=NUMEROS_BRL,
+    historico_quebrado=True,
+    limpar_historico=True,
+    saldo_corrente=SALDO_BANCO,
+))
+
+# Extrato Caixa (internet banking): cabeçalho "Data Mov. | Nr. Doc. |
+# Histórico | Valor | Saldo", valores com sufixo D/C e linhas de saldo
+# diário no meio do movimento
+EXTRATO_CAIXA = registrar(Layout(
+    nome="Caixa Econômica",
+    tipo="extrato",
+    descartar=(
+        (0, r"Evaluation|Extrato|Conta:|Per[ií]odo|P[aá]gina|SAC CAIXA|Ouvidoria"),
+        (2, r"SALDO DIA|SALDO ANTERIOR|SALDO FINAL|SALDO BLOQ"),
+    ),
+    descartar_vazia=(0,),
+    cabecalho=(0, r"Data\s*Mov"),
+    colunas=(("Data Mov.", "Data"), ("Nr. Doc.", "Documento"), ("Histórico", "Histórico"),
+             ("Valor", "Valor"), ("Saldo", "Saldo")),
+    convencao=CONVENCAO_SUFIXO,
+    numeros=NUMEROS_BRL,
+    saldo_corrente=None,                # convenção do saldo ainda não conferida em extrato real
+))
+
+# Relatório do ERP (razão da conta): NLanc | Dtlan | Histórico | Debito | Crédito | Saldo
+SISTEMA_PADRAO = registrar(Layout(
+    nome="ERP (NLanc/Dtlan)",
+    tipo="sistema",
+    topo=7,
+    descartar=(
+        (3, r"Total|Saldo Atual|Total Geral|Saldo Anterior|Histórico|CONTA ÚNICA|Página"),
+        (0, r"Evaluation|Banco:|Conta:"),
+    ),
+    descartar_vazia=(0,),
+    cabecalho=(1, r"Dtlan"),
+    pular_apos_cabecalho=1,             # linha de traços sob o cabeçalho
+    colunas=(("NLanc", "NLanc"), ("Dtlan", "Data"), ("Histórico", "Histórico"),
+             ("Debito", "Débito"), ("Crédito", "Crédito"), ("Saldo", "Saldo")),
+    convencao=CONVENCAO_COLUNAS,
+    numeros=NUMEROS_DECIMAL,
+    saldo_corrente=None,                # convenção do saldo ainda não conferida em relatório real
+))
+
+BANCO_PADRAO = EXTRATO_BB.nome
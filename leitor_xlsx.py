@@ -0,0 +1,203 @@
+"""
+Leitura rápida da 1ª aba de um XLSX, só os valores.
+
+    for valores in leitor_xlsx.linhas(xlsx_bytes):
+        ...
+    for aba in leitor_xlsx.abas(xlsx_bytes):    # todas as abas, na ordem
+        for valores in aba:
+            ...
+
+Dá os mesmos valores do openpyxl em read_only com values_only (textos,
+números int/float, datas, booleanos, None nas células vazias e linhas
+vazias no meio), mas lê o XML direto com o iterparse em C, sem montar os
+objetos de célula e de texto do openpyxl: a tabela compartilhada de
+textos, que é a maior parte do XLSX do Aspose, sai uma ordem de grandeza
+mais rápida. Estilos só são lidos para saber quais números são datas.
+"""
+import io
+import posixpath
+import zipfile
+from functools import lru_cache
+from xml.etree.ElementTree import XMLPullParser, iterparse
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601
+
+_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_PACOTE = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+_ROW = _NS + "row"
+_C = _NS + "c"
+_V = _NS + "v"
+_T = _NS + "t"
+_R = _NS + "r"
+_SI = _NS + "si"
+_IS = _NS + "is"
+_DIMENSION = _NS + "dimension"
+
+_BLOCO = 1 << 16        # bytes do XML entregues ao parser por vez
+
+def linhas(xlsx_bytes):
+    """Listas de valores por linha da 1ª aba, a partir da linha 1."""
+    for aba in abas(xlsx_bytes):
+        yield from aba
+        break
+
+def abas(xlsx_bytes):
+    """
+    As linhas (como em `linhas`) de cada aba, na ordem da pasta de trabalho.
+    Cada aba deve ser lida antes de pedir a seguinte.
+    """
+    with zipfile.ZipFile(io.BytesIO(xlsx_bytes)) as pacote:
+        caminhos, textos, estilos, epoca = _partes(pacote)
+        compartilhados = _textos(pacote, textos) if textos else []
+        datas, duracoes = _formatos_data(pacote, estilos) if estilos else (set(), set())
+        for caminho in caminhos:
+            yield _ler_aba(pacote, caminho, compartilhados, datas, duracoes, epoca)
+
+def _ler_aba(pacote, caminho, *contexto):
+    with pacote.open(caminho) as xml:
+        yield from _linhas_aba(xml, *contexto)
+
+def _partes(pacote):
+    # Caminhos das abas (em ordem), dos textos e dos estilos, e a época das datas
+    rels = _relacoes(pacote, "xl/workbook.xml")
+    caminhos, epoca = [], CALENDAR_WINDOWS_1900
+    for _, elemento in iterparse(pacote.open("xl/workbook.xml")):
+        if elemento.tag == _NS + "workbookPr" and elemento.get("date1904") in ("1", "true"):
+            epoca = CALENDAR_MAC_1904
+        elif elemento.tag == _NS + "sheet":
+            caminhos.append(rels[elemento.get(_NS_REL + "id")][1])
+    tipos = {tipo.rsplit("/", 1)[-1]: alvo for tipo, alvo in rels.values()}
+    return caminhos, tipos.get("sharedStrings"), tipos.get("styles"), epoca
+
+def _relacoes(pacote, parte):
+    pasta, nome = posixpath.split(parte)
+    caminho = posixpath.join(pasta, "_rels", nome + ".rels")
+    rels = {}
+    for _, elemento in iterparse(pacote.open(caminho)):
+        if elemento.tag == _NS_PACOTE + "Relationship":
+            alvo = elemento.get("Target")
+            alvo = alvo.lstrip("/") if alvo.startswith("/") else posixpath.normpath(posixpath.join(pasta, alvo))
+            rels[elemento.get("Id")] = (elemento.get("Type"), alvo)
+    return rels
+
+def _elementos(xml):
+    # Elementos já fechados, em ordem; o chamador limpa os que consumir
+    parser = XMLPullParser(events=("end",))
+    while True:
+        bloco = xml.read(_BLOCO)
+        if not bloco:
+            break
+        parser.feed(bloco)
+        for _, elemento in parser.read_events():
+            yield elemento
+    parser.close()
+
+def _textos(pacote, caminho):
+    # Mesmo texto do openpyxl: <t> simples ou os <r><t> de texto formatado
+    textos = []
+    with pacote.open(caminho) as xml:
+        for elemento in _elementos(xml):
+            if elemento.tag == _SI:
+                textos.append(_texto(elemento))
+                elemento.clear()
+    return textos
+
+def _texto(elemento):
+    simples = elemento.find(_T)
+    partes = [simples.text or ""] if simples is not None else []
+    partes += [r.findtext(_T) or "" for r in elemento.iterfind(_R)]
+    return "".join(partes).replace("x005F_", "")
+
+def _formatos_data(pacote, caminho):
+    # Índices de estilo (atributo s da célula) com formato de data/duração
+    personalizados, formatos = {}, []
+    dentro_xfs = False
+    for evento, elemento in iterparse(pacote.open(caminho), events=("start", "end")):
+        if elemento.tag == _NS + "cellXfs":
+            dentro_xfs = evento == "start"
+        elif evento == "end" and elemento.tag == _NS + "numFmt":
+            personalizados[int(elemento.get("numFmtId"))] = elemento.get("formatCode")
+        elif evento == "end" and elemento.tag == _NS + "xf" and dentro_xfs:
+            formatos.append(int(elemento.get("numFmtId", 0)))
+    datas, duracoes = set(), set()
+    for indice, numero in enumerate(formatos):
+        formato = personalizados.get(numero) or BUILTIN_FORMATS.get(numero)
+        if formato and is_date_format(formato):
+            datas.add(indice)
+        if formato and is_timedelta_format(formato):
+            duracoes.add(indice)
+    return datas, duracoes
+
+@lru_cache(maxsize=None)
+def _coluna(letras):
+    # "AB" -> 27 (base 0)
+    indice = 0
+    for letra in letras:
+        indice = indice * 26 + ord(letra) - 64
+    return indice - 1
+
+def _numero(texto):
+    if "." in texto or "E" in texto or "e" in texto:
+        return float(texto)
+    return int(texto)
+
+def _linhas_aba(xml, compartilhados, datas, duracoes, epoca):
+    ultima = None       # última linha pela <dimension>, como o read_only do openpyxl
+    numero = 0
+    for elemento in _elementos(xml):
+        tag = elemento.tag
+        if tag == _DIMENSION:
+            fim = elemento.get("ref", "").split(":")[-1].lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+            ultima = int(fim) if fim.isdigit() else None
+        elif tag == _ROW:
+            indice = int(elemento.get("r") or numero + 1)
+            if ultima is not None and indice > ultima:
+                break
+            while numero + 1 < indice:      # linhas que não vieram no XML
+                numero += 1
+                yield []
+            numero = indice
+
+            valores = []
+            for c in elemento:
+                if c.tag != _C:
+                    continue
+                referencia = c.get("r")
+                coluna = _coluna(referencia.rstrip("0123456789")) if referencia else len(valores)
+                if coluna > len(valores):
+                    valores.extend([None] * (coluna - len(valores)))
+                # Caminho curto para o caso comum: texto compartilhado
+                if c.get("t") == "s" and len(c) and c[0].tag == _V:
+                    valores.append(compartilhados[int(c[0].text)])
+                else:
+                    valores.append(_valor(c, compartilhados, datas, duracoes, epoca))
+            elemento.clear()
+            yield valores
+
+def _valor(c, compartilhados, datas, duracoes, epoca):
+    tipo = c.get("t", "n")
+    if tipo == "inlineStr":
+        texto = c.find(_IS)
+        return _texto(texto) if texto is not None else None
+    valor = c.findtext(_V) or None
+    if valor is None:
+        return None
+    if tipo == "n":
+        valor = _numero(valor)
+        estilo = int(c.get("s") or 0)
+        if estilo in datas:
+            try:
+                return from_excel(valor, epoca, timedelta=estilo in duracoes)
+            except (OverflowError, ValueError):
+                return "#VALUE!"
+        return valor
+    if tipo == "s":
+        return compartilhados[int(valor)]
+    if tipo == "b":
+        return bool(int(valor))
+    if tipo == "d":
+        return from_ISO8601(valor)
+    return valor        # "str" (resultado de fórmula) ou "e" (erro)
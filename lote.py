@@ -0,0 +1,324 @@
+"""
+Conciliação em lote, sem Streamlit.
+
+    python lote.py ENTRADA SAIDA [--processos N] [--timeout SEG] [--tentativas K]
+                                 [--estado ARQUIVO.sqlite] [--tabelas csv|parquet]
+                                 [--consolidado] [--conferir-motores]
+                                 [--saldo interromper|avisar|ignorar]
+
+ENTRADA pode ser:
+  - um manifesto .csv/.json com as colunas extrato, sistema, banco (e
+    opcionalmente nome); caminhos relativos partem da pasta do manifesto;
+  - uma pasta com uma subpasta por conta, contendo um PDF com "extrato" no
+    nome e outro com "sistema" no nome.
+
+Grava uma planilha de conciliação por conta em SAIDA e o relatório da
+execução em SAIDA/relatorio_execucao.csv e .json. Com --estado a
+conciliação é incremental (ver estado.py): cada conta, pelo nome, só
+concilia as linhas novas contra os pendentes das execuções anteriores.
+Com --tabelas as abas também saem como CSV ou Parquet, em SAIDA/<conta>/.
+Com --consolidado as contas são tratadas uma após a outra neste processo e
+conciliadas juntas (ver consolidado.py), em uma única planilha
+SAIDA/Conciliação_Consolidada.xlsx com as transferências entre as contas.
+Com --conferir-motores nada é conciliado: os PDFs de cada conta passam
+pelos dois motores de extração, e pelo Aspose inteiros e divididos em
+faixas de páginas; as diferenças entre as tabelas e entre os tratamentos
+vão para SAIDA/conferencia_motores.json.
+Com --saldo avisar, uma conta cujo saldo corrente não fecha com os
+lançamentos lidos é conciliada assim mesmo, com o problema na coluna
+"aviso" do relatório; --saldo ignorar nem confere (o padrão vem de
+CONCILIACAO_VALIDAR_SALDO, ver conciliacao_v1.py).
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+import conciliacao_v1 as cc
+import consolidado
+import layouts
+import processamento
+from estado import EstadoConciliacao
+from converter import ConversionError, BACKENDS, BACKEND_ASPOSE
+
+CAMPOS_RELATORIO = ["nome", "banco", "status", "tentativas", "segundos", "saida", "erro", "aviso"]
+SALDO = {"interromper": True, "avisar": cc.AVISAR_SALDO, "ignorar": False}
+
+def _nome_arquivo(nome):
+    return re.sub(r"[^\w\-. ]+", "_", nome).strip() or "conta"
+
+def ler_manifesto(caminho):
+    base = os.path.dirname(os.path.abspath(caminho))
+    if caminho.lower().endswith(".json"):
+        with open(caminho, encoding="utf-8") as f:
+            linhas = json.load(f)
+    else:
+        with open(caminho, encoding="utf-8-sig", newline="") as f:
+            linhas = list(csv.DictReader(f))
+
+    jobs = []
+    for linha in linhas:
+        extrato = os.path.join(base, linha["extrato"])
+        sistema = os.path.join(base, linha["sistema"])
+        nome = linha.get("nome") or os.path.splitext(os.path.basename(extrato))[0]
+        jobs.append({"nome": nome, "extrato": extrato, "sistema": sistema,
+                     "banco": linha.get("banco") or layouts.BANCO_PADRAO})
+    return jobs
+
+def ler_pasta(pasta, banco=layouts.BANCO_PADRAO):
+    jobs = []
+    for conta in sorted(os.listdir(pasta)):
+        caminho = os.path.join(pasta, conta)
+        if not os.path.isdir(caminho):
+            continue
+        pdfs = [f for f in sorted(os.listdir(caminho)) if f.lower().endswith(".pdf")]
+        extrato = [f for f in pdfs if "extrato" in f.lower()]
+        sistema = [f for f in pdfs if "sistema" in f.lower()]
+        if len(extrato) != 1 or len(sistema) != 1:
+            print("Ignorando %s: esperado 1 PDF de extrato e 1 de sistema." % conta, file=sys.stderr)
+            continue
+        jobs.append({"nome": conta, "banco": banco,
+                     "extrato": os.path.join(caminho, extrato[0]),
+                     "sistema": os.path.join(caminho, sistema[0])})
+    return jobs
+
+def _tratar_conta(job, relatorio, tentativas, backend, paralelo=False, validar_saldo=None):
+    # PDFs da conta -> (extrato, sistema) tratados, com nova tentativa em ConversionError
+    with open(job["extrato"], "rb") as f:
+        pdf_extrato = f.read()
+    with open(job["sistema"], "rb") as f:
+        pdf_sistema = f.read()
+
+    for tentativa in range(1, tentativas + 1):
+        relatorio["tentativas"] = tentativa
+        try:
+            extrato, sistema = processamento.tratar_em_paralelo(
+                pdf_extrato, pdf_sistema, backend=backend, paralelo=paralelo, banco=job["banco"],
+                validar_saldo=validar_saldo)
+        except ConversionError:
+            if tentativa == tentativas:
+                raise
+            time.sleep(min(2 ** tentativa, 30))
+            continue
+        relatorio["aviso"] = " | ".join(df.attrs[cc.AVISO_SALDO] for df in (extrato, sistema)
+                                        if cc.AVISO_SALDO in df.attrs)
+        return extrato, sistema
+
+def _executar_conta(job, saida, tentativas, backend, conn, estado=None, tabelas=None, validar_saldo=None):
+    # Roda em um processo próprio: o pai pode encerrá-lo no timeout
+    inicio = time.perf_counter()
+    relatorio = {"nome": job["nome"], "banco": job["banco"], "tentativas": 0, "saida": "", "erro": ""}
+    try:
+        extrato, sistema = _tratar_conta(job, relatorio, tentativas, backend, validar_saldo=validar_saldo)
+
+        if estado:
+            with EstadoConciliacao(estado) as persistido:
+                abas = persistido.conciliar_abas(job["nome"], extrato, sistema)
+        else:
+            abas = cc.conciliar_abas(extrato, sistema)
+        # Grava direto no arquivo, sem montar a planilha inteira na memória
+        destino = os.path.join(saida, "Conciliação_%s.xlsx" % _nome_arquivo(job["nome"]))
+        cc.gravar_planilha(abas, destino=destino)
+        if tabelas:
+            cc.exportar_abas(abas, os.path.join(saida, _nome_arquivo(job["nome"])), formato=tabelas)
+        relatorio.update(status="ok", saida=destino)
+    except Exception as e:
+        relatorio.update(status="erro", erro="%s: %s" % (type(e).__name__, e))
+
+    relatorio["segundos"] = round(time.perf_counter() - inicio, 3)
+    conn.send(relatorio)
+    conn.close()
+
+def executar_lote(jobs, saida, processos=None, timeout=None, tentativas=3, backend=BACKEND_ASPOSE, estado=None,
+                  tabelas=None, validar_saldo=None):
+    """
+    Executa as contas com no máximo `processos` simultâneos. Cada conta tem
+    `timeout` segundos (todas as tentativas incluídas); ao estourar, o
+    processo é encerrado. `validar_saldo` segue para cc.tratar_planilha.
+    Retorna a lista de relatórios, na ordem de `jobs`.
+    """
+    os.makedirs(saida, exist_ok=True)
+    processos = processos or os.cpu_count() or 1
+    ctx = multiprocessing.get_context("spawn")
+
+    fila = deque(enumerate(jobs))
+    ativos = {}      # conexão -> (índice, job, processo, prazo, início)
+    relatorios = [None] * len(jobs)
+
+    def concluir(i, relatorio):
+        relatorios[i] = relatorio
+        print("[%s] %s (%.1fs) %s" % (relatorio["status"].upper(), relatorio["nome"],
+                                     relatorio["segundos"], relatorio["erro"] or relatorio.get("aviso", "")))
+
+    while fila or ativos:
+        while fila and len(ativos) < processos:
+            i, job = fila.popleft()
+            receptor, emissor = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_executar_conta,
+                               args=(job, saida, tentativas, backend, emissor, estado, tabelas, validar_saldo),
+                               daemon=True)
+            proc.start()
+            emissor.close()
+            agora = time.monotonic()
+            ativos[receptor] = (i, job, proc, agora + timeout if timeout else None, agora)
+
+        prazos = [prazo for _, _, _, prazo, _ in ativos.values() if prazo is not None]
+        espera = max(0.0, min(prazos) - time.monotonic()) if prazos else None
+        prontos = wait(list(ativos), timeout=espera)
+
+        for conn in prontos:
+            i, job, proc, _, inicio = ativos.pop(conn)
+            try:
+                relatorio = conn.recv()
+            except EOFError:
+                # Processo morreu sem responder (ex.: falha no runtime do Aspose)
+                relatorio = {"nome": job["nome"], "banco": job["banco"], "status": "erro",
+                             "tentativas": 0, "saida": "",
+                             "segundos": round(time.monotonic() - inicio, 3),
+                             "erro": "Processo encerrado inesperadamente."}
+            concluir(i, relatorio)
+            conn.close()
+            proc.join()
+
+        agora = time.monotonic()
+        for conn in [c for c, (_, _, _, prazo, _) in ativos.items() if prazo is not None and prazo <= agora]:
+            i, job, proc, _, inicio = ativos.pop(conn)
+            proc.terminate()
+            proc.join()
+            conn.close()
+            concluir(i, {"nome": job["nome"], "banco": job["banco"], "status": "timeout",
+                         "tentativas": 0, "saida": "", "segundos": round(agora - inicio, 3),
+                         "erro": "Tempo limite de %s s excedido." % timeout})
+
+    return relatorios
+
+def executar_consolidado(jobs, saida, tentativas=3, backend=BACKEND_ASPOSE, tabelas=None, validar_saldo=None):
+    """
+    Trata as contas uma após a outra (as conversões de cada uma em paralelo)
+    e concilia todas juntas em SAIDA/Conciliação_Consolidada.xlsx; contas
+    com falha ficam de fora. Retorna a lista de relatórios, na ordem de `jobs`.
+    """
+    os.makedirs(saida, exist_ok=True)
+    destino = os.path.join(saida, "Conciliação_Consolidada.xlsx")
+    relatorios, contas = [], {}
+    for job in jobs:
+        inicio = time.perf_counter()
+        relatorio = {"nome": job["nome"], "banco": job["banco"], "tentativas": 0, "saida": "", "erro": ""}
+        try:
+            contas[job["nome"]] = _tratar_conta(job, relatorio, tentativas, backend, paralelo=True,
+                                                validar_saldo=validar_saldo)
+            relatorio.update(status="ok", saida=destino)
+        except Exception as e:
+            relatorio.update(status="erro", erro="%s: %s" % (type(e).__name__, e))
+        relatorio["segundos"] = round(time.perf_counter() - inicio, 3)
+        relatorios.append(relatorio)
+        print("[%s] %s (%.1fs) %s" % (relatorio["status"].upper(), relatorio["nome"],
+                                     relatorio["segundos"], relatorio["erro"] or relatorio.get("aviso", "")))
+
+    if contas:
+        abas = consolidado.conciliar_contas(contas)
+        cc.gravar_planilha(abas, destino=destino)
+        if tabelas:
+            cc.exportar_abas(abas, os.path.join(saida, "Consolidado"), formato=tabelas)
+    return relatorios
+
+def conferir_motores(jobs, saida):
+    """
+    processamento.conferir_motores e conferir_divisao para o extrato e o
+    sistema de cada conta; grava SAIDA/conferencia_motores.json e retorna a
+    lista de resultados.
+    """
+    os.makedirs(saida, exist_ok=True)
+    resultados = []
+    for job in jobs:
+        for tipo in ("extrato", "sistema"):
+            resultado = {"nome": job["nome"], "tipo": tipo}
+            try:
+                with open(job[tipo], "rb") as f:
+                    pdf_bytes = f.read()
+                resultado.update(processamento.conferir_motores(tipo, pdf_bytes, banco=job["banco"]))
+                resultado.update(processamento.conferir_divisao(tipo, pdf_bytes, banco=job["banco"]))
+                iguais = resultado["tabela_igual"] and resultado["tratado_igual"] and resultado["dividido_igual"]
+                status = "ok" if iguais else "diferente"
+            except Exception as e:
+                resultado["erro"] = "%s: %s" % (type(e).__name__, e)
+                status = "erro"
+            resultado["status"] = status
+            resultados.append(resultado)
+            print("[%s] %s/%s %s" % (status.upper(), job["nome"], tipo, resultado.get("erro", "")))
+
+    with open(os.path.join(saida, "conferencia_motores.json"), "w", encoding="utf-8") as f:
+        json.dump(resultados, f, ensure_ascii=False, indent=2)
+    return resultados
+
+def gravar_relatorio(relatorios, saida):
+    with open(os.path.join(saida, "relatorio_execucao.json"), "w", encoding="utf-8") as f:
+        json.dump(relatorios, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(saida, "relatorio_execucao.csv"), "w", encoding="utf-8-sig", newline="") as f:
+        escritor = csv.DictWriter(f, fieldnames=CAMPOS_RELATORIO, extrasaction="ignore")
+        escritor.writeheader()
+        escritor.writerows(relatorios)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conciliação bancária em lote.")
+    parser.add_argument("entrada", help="manifesto .csv/.json ou pasta com uma subpasta por conta")
+    parser.add_argument("saida", help="pasta onde gravar as planilhas e o relatório")
+    parser.add_argument("--processos", type=int, default=None, help="contas simultâneas (padrão: nº de CPUs)")
+    parser.add_argument("--timeout", type=float, default=None, help="segundos por conta")
+    parser.add_argument("--tentativas", type=int, default=3, help="tentativas em caso de ConversionError")
+    parser.add_argument("--motor", choices=BACKENDS, default=BACKEND_ASPOSE, help="motor de extração")
+    parser.add_argument("--banco", default=layouts.BANCO_PADRAO, choices=sorted(layouts.EXTRATOS),
+                        help="banco das contas (modo pasta)")
+    parser.add_argument("--estado", default=None, help="arquivo SQLite para conciliação incremental")
+    parser.add_argument("--tabelas", choices=["csv", "parquet"], default=None,
+                        help="grava também as abas como tabelas (uma pasta por conta)")
+    parser.add_argument("--consolidado", action="store_true",
+                        help="concilia todas as contas juntas, com as transferências entre elas")
+    parser.add_argument("--conferir-motores", action="store_true",
+                        help="só compara os motores de extração (e a conversão dividida) nos mesmos PDFs")
+    parser.add_argument("--saldo", choices=list(SALDO), default=None,
+                        help="saldo corrente que não fecha: interrompe a conta, só avisa no relatório ou nem confere")
+    args = parser.parse_args(argv)
+    if args.consolidado and (args.estado or args.timeout):
+        parser.error("--consolidado não combina com --estado nem com --timeout")
+    if args.conferir_motores and (args.consolidado or args.estado):
+        parser.error("--conferir-motores não combina com --consolidado nem com --estado")
+
+    if os.path.isdir(args.entrada):
+        jobs = ler_pasta(args.entrada, banco=args.banco)
+    else:
+        jobs = ler_manifesto(args.entrada)
+    if not jobs:
+        parser.error("nenhuma conta encontrada em %s" % args.entrada)
+    desconhecidos = sorted({job["banco"] for job in jobs} - set(layouts.EXTRATOS))
+    if desconhecidos:
+        parser.error("banco sem layout de extrato: %s" % ", ".join(desconhecidos))
+
+    if args.conferir_motores:
+        resultados = conferir_motores(jobs, args.saida)
+        diferentes = sum(r["status"] != "ok" for r in resultados)
+        print("%d PDFs, %d com diferença ou erro." % (len(resultados), diferentes))
+        return 1 if diferentes else 0
+
+    inicio = time.perf_counter()
+    if args.consolidado:
+        relatorios = executar_consolidado(jobs, args.saida, tentativas=args.tentativas, backend=args.motor,
+                                          tabelas=args.tabelas, validar_saldo=SALDO.get(args.saldo))
+    else:
+        relatorios = executar_lote(jobs, args.saida, processos=args.processos, timeout=args.timeout,
+                                   tentativas=args.tentativas, backend=args.motor, estado=args.estado,
+                                   tabelas=args.tabelas, validar_saldo=SALDO.get(args.saldo))
+    gravar_relatorio(relatorios, args.saida)
+
+    falhas = sum(r["status"] != "ok" for r in relatorios)
+    print("%d contas, %d com falha, %.1fs no total." % (len(relatorios), falhas, time.perf_counter() - inicio))
+    return 1 if falhas else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+"""
+Pool de processos "spawn" compartilhado, criado só no primeiro uso.
+
+    _pool = pool_processos.PoolProcessos(4)
+    futuro = _pool.obter().submit(funcao, *args)
+    ...
+    except BrokenProcessPool:
+        _pool.descartar()       # o próximo obter() sobe um pool novo
+
+"spawn": os processos não herdam as threads do Streamlit e o comportamento
+é o mesmo no Windows.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+class PoolProcessos:
+    def __init__(self, processos, ao_criar=None, **opcoes):
+        # `opcoes` seguem para o ProcessPoolExecutor; `ao_criar(executor)`
+        # roda logo depois de cada pool novo subir
+        self.processos = processos
+        self.ao_criar = ao_criar
+        self.opcoes = opcoes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def obter(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processos,
+                                                     mp_context=multiprocessing.get_context("spawn"),
+                                                     **self.opcoes)
+                if self.ao_criar is not None:
+                    self.ao_criar(self._executor)
+            return self._executor
+
+    def descartar(self):
+        # Pool quebrado (processo morto) ou encerramento: cancela o que está na fila
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,205 @@
+import difflib
+import os
+from concurrent.futures import wait
+from itertools import zip_longest
+from concurrent.futures.process import BrokenProcessPool
+
+import conciliacao_v1 as cc
+import instrumentacao
+import layouts
+import pool_processos
+import servico_conversao
+from converter import (ConversionCache, ConversionError, conversion_cache, convert_pdf_bytes,
+                       convert_pdf_bytes_to_xlsx_bytes, BACKEND_ASPOSE, BACKEND_TEXTO)
+
+# Processos para conversão/tratamento (compartilhados por todas as sessões)
+PROCESSOS = int(os.environ.get("CONCILIACAO_PROCESSOS", max(2, min(4, os.cpu_count() or 1))))
+
+ROTULOS = {"extrato": "Extrato", "sistema": "Sistema"}
+
+_pool = pool_processos.PoolProcessos(PROCESSOS)
+
+def converter_e_tratar(tipo, pdf_bytes, backend=BACKEND_ASPOSE, minimize_worksheets=True, xlsx_bytes=None,
+                       instrumentar=None, banco=layouts.BANCO_PADRAO, reparar=None, validar_saldo=None):
+    """
+    Converte o PDF (se `xlsx_bytes` não vier pronto) e aplica o tratamento do
+    `tipo` ("extrato" ou "sistema"); o extrato usa o layout do `banco`.
+    Devolve (xlsx_bytes, DataFrame tratado, registros); xlsx_bytes é None
+    quando o motor não gera XLSX. `reparar` e `validar_saldo` seguem para
+    cc.tratar_planilha.
+
+    Com `instrumentar` (True/False = medir memória ou não) as etapas são
+    medidas aqui e os registros voltam para o processo que chamou.
+    """
+    argumentos = (tipo, pdf_bytes, backend, minimize_worksheets, xlsx_bytes, banco, reparar, validar_saldo)
+    if instrumentar is None:
+        return _converter_e_tratar(*argumentos) + ([],)
+    with instrumentacao.instrumentar(memoria=instrumentar) as coletor:
+        resultado = _converter_e_tratar(*argumentos)
+    return resultado + (coletor.registros,)
+
+def _layout(tipo, banco):
+    if tipo == "extrato":
+        return layouts.layout_extrato(banco)
+    return layouts.SISTEMA_PADRAO
+
+def _converter_e_tratar(tipo, pdf_bytes, backend, minimize_worksheets, xlsx_bytes, banco, reparar, validar_saldo):
+    if xlsx_bytes is None:
+        if backend == BACKEND_ASPOSE:
+            # O cache fica no processo principal (ver tratar_em_paralelo); aqui já
+            # é um worker, então converte no próprio processo
+            xlsx_bytes = convert_pdf_bytes_to_xlsx_bytes(pdf_bytes, minimize_worksheets, usar_cache=False,
+                                                         usar_servico=False)
+            planilha = xlsx_bytes
+        else:
+            planilha = convert_pdf_bytes(pdf_bytes, backend=backend, minimize_worksheets=minimize_worksheets)
+    else:
+        planilha = xlsx_bytes
+
+    return xlsx_bytes, cc.tratar_planilha(planilha, _layout(tipo, banco), reparar=reparar,
+                                          validar_saldo=validar_saldo)
+
+def tratar_em_paralelo(pdf_extrato, pdf_sistema, backend=BACKEND_ASPOSE, minimize_worksheets=True, paralelo=True,
+                       banco=layouts.BANCO_PADRAO, reparar=None, validar_saldo=None):
+    """
+    Converte e trata extrato e sistema ao mesmo tempo, cada um em um processo
+    (em paralelo, a conversão Aspose vai para os processos pré-aquecidos de
+    servico_conversao.py). O extrato é lido com o layout do `banco` (ver layouts.py).
+    Retorna (extrato, sistema) tratados. Falhas de conversão de qualquer lado
+    voltam juntas em um único ConversionError; saldo que não fecha sai como
+    cc.SaldoInconsistente, antes da conciliação (com `validar_saldo` =
+    cc.AVISAR_SALDO só fica anotado em df.attrs, ver cc.tratar_planilha).
+    """
+    layouts.layout_extrato(banco)       # banco desconhecido falha antes de converter
+    entradas = {"extrato": pdf_extrato, "sistema": pdf_sistema}
+
+    # Consulta o cache antes: acerto só precisa do tratamento
+    chaves, prontos = {}, {}
+    for tipo, pdf_bytes in entradas.items():
+        if not pdf_bytes:
+            raise ValueError("pdf_bytes vazio.")
+        if backend == BACKEND_ASPOSE:
+            chaves[tipo] = ConversionCache.chave(pdf_bytes, minimize_worksheets=bool(minimize_worksheets))
+            prontos[tipo] = conversion_cache.get(chaves[tipo])
+
+    # Nos workers as etapas são medidas lá e os registros voltam com o resultado
+    coletor = instrumentacao.ativo()
+    if paralelo:
+        medir = coletor.memoria if coletor else None
+        if backend == BACKEND_ASPOSE:
+            prontos = _converter_no_servico(entradas, chaves, prontos, minimize_worksheets, medir, coletor)
+        pool = _pool.obter()
+        try:
+            futuros = {
+                tipo: pool.submit(converter_e_tratar, tipo, pdf_bytes, backend,
+                                  minimize_worksheets, prontos.get(tipo), medir, banco, reparar, validar_saldo)
+                for tipo, pdf_bytes in entradas.items()
+            }
+        except BrokenProcessPool:
+            _pool.descartar()
+            raise
+        wait(futuros.values())
+        resultados = {tipo: futuro.exception() or futuro.result() for tipo, futuro in futuros.items()}
+        if any(isinstance(r, BrokenProcessPool) for r in resultados.values()):
+            _pool.descartar()
+    else:
+        resultados = {}
+        for tipo, pdf_bytes in entradas.items():
+            try:
+                resultados[tipo] = converter_e_tratar(tipo, pdf_bytes, backend, minimize_worksheets, prontos.get(tipo),
+                                                      banco=banco, reparar=reparar, validar_saldo=validar_saldo)
+            except Exception as e:
+                resultados[tipo] = e
+
+    erros = ["%s: %s" % (ROTULOS[tipo], r) for tipo, r in resultados.items() if isinstance(r, ConversionError)]
+    if erros:
+        raise ConversionError("; ".join(erros))
+    for r in resultados.values():
+        if isinstance(r, BaseException):
+            raise r
+
+    tratados = {}
+    for tipo, (xlsx_bytes, df, registros) in resultados.items():
+        if tipo in chaves and prontos[tipo] is None:
+            conversion_cache.put(chaves[tipo], xlsx_bytes)
+        if coletor and registros:
+            coletor.adicionar([dict(r, etapa="%s/%s" % (tipo, r["etapa"])) for r in registros])
+        tratados[tipo] = df
+    return tratados["extrato"], tratados["sistema"]
+
+def _converter_no_servico(entradas, chaves, prontos, minimize_worksheets, medir, coletor):
+    # Converte no serviço os PDFs fora do cache, os dois ao mesmo tempo, e
+    # devolve `prontos` completo; falhas dos dois lados saem juntas
+    futuros = {tipo: servico_conversao.submeter(pdf_bytes, minimize_worksheets, medir)
+               for tipo, pdf_bytes in entradas.items() if prontos.get(tipo) is None}
+    convertidos, erros = dict(prontos), []
+    for tipo, futuro in futuros.items():
+        try:
+            xlsx_bytes, registros = servico_conversao.resultado(futuro)
+        except ConversionError as e:
+            erros.append("%s: %s" % (ROTULOS[tipo], e))
+            continue
+        conversion_cache.put(chaves[tipo], xlsx_bytes)
+        if coletor and registros:
+            coletor.adicionar([dict(r, etapa="%s/%s" % (tipo, r["etapa"])) for r in registros])
+        convertidos[tipo] = xlsx_bytes
+    if erros:
+        raise ConversionError("; ".join(erros))
+    return convertidos
+
+def conferir_motores(tipo, pdf_bytes, banco=layouts.BANCO_PADRAO, limite=20):
+    """
+    Converte o mesmo PDF pelos dois motores e compara as tabelas (células
+    não vazias de cada linha, sem as linhas vazias) e o tratamento com o
+    layout do `tipo`, que corta o topo/rodapé do layout nas linhas de cada
+    motor. Devolve um dict com tabela_igual, tratado_igual, o número de
+    linhas de cada motor e até `limite` diferenças (linha Aspose, linha texto).
+    """
+    layout = _layout(tipo, banco)
+    fontes = {BACKEND_ASPOSE: convert_pdf_bytes(pdf_bytes, backend=BACKEND_ASPOSE),
+              BACKEND_TEXTO: convert_pdf_bytes(pdf_bytes, backend=BACKEND_TEXTO)}
+    aspose, texto = (_celulas_por_linha(cc._ler_planilha(fonte)) for fonte in fontes.values())
+
+    diferencas = []
+    blocos = difflib.SequenceMatcher(None, aspose, texto, autojunk=False).get_opcodes()
+    for operacao, i1, i2, j1, j2 in blocos:
+        if operacao != "equal":
+            diferencas += zip_longest(aspose[i1:i2], texto[j1:j2])
+
+    tratados = [cc.tratar_planilha(fonte, layout, validar_saldo=False).reset_index(drop=True)
+                for fonte in fontes.values()]
+    return {
+        "tabela_igual": not diferencas,
+        "tratado_igual": tratados[0].equals(tratados[1]),
+        "linhas_aspose": len(aspose),
+        "linhas_texto": len(texto),
+        "diferencas": diferencas[:limite],
+    }
+
+def conferir_divisao(tipo, pdf_bytes, banco=layouts.BANCO_PADRAO, paginas_por_parte=1, partes=4):
+    """
+    Converte o PDF inteiro e dividido em faixas de páginas (juntadas com
+    converter.juntar_xlsx, como no serviço) e compara o tratamento das duas
+    planilhas com o layout do `tipo`. Devolve um dict com dividido_igual,
+    o número de partes (0 = pequeno demais para dividir) e as linhas
+    tratadas de cada caminho.
+    """
+    from converter import _converter_aspose, _dividir_ou_converter_aspose, juntar_xlsx
+
+    layout = _layout(tipo, banco)
+    inteiro = _converter_aspose(pdf_bytes, True)
+    pdfs, _ = _dividir_ou_converter_aspose(pdf_bytes, partes, paginas_por_parte, True)
+    dividido = juntar_xlsx([_converter_aspose(pdf, True) for pdf in pdfs]) if pdfs else inteiro
+    tratados = [cc.tratar_planilha(xlsx_bytes, layout, validar_saldo=False).reset_index(drop=True)
+                for xlsx_bytes in (inteiro, dividido)]
+    return {
+        "dividido_igual": tratados[0].equals(tratados[1]),
+        "partes": len(pdfs) if pdfs else 0,
+        "linhas_inteiro": len(tratados[0]),
+        "linhas_dividido": len(tratados[1]),
+    }
+
+def _celulas_por_linha(tabela):
+    linhas = ([v.strip() for v in linha if isinstance(v, str) and v.strip()]
+              for linha in tabela.itertuples(index=False))
+    return [tuple(linha) for linha in linhas if linha]
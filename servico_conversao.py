@@ -0,0 +1,149 @@
+"""
+Serviço de conversão PDF -> XLSX com processos pré-aquecidos.
+
+    import servico_conversao
+    servico_conversao.iniciar()                      # na subida do servidor
+    xlsx_bytes = servico_conversao.converter(pdf_bytes)
+
+Cada processo importa o Aspose, aplica a licença (CONCILIACAO_ASPOSE_LICENCA,
+caminho do .lic) e faz uma conversão mínima logo ao nascer: o runtime .NET
+e a descoberta de fontes ficam prontos antes do primeiro PDF de verdade.
+Os PDFs chegam pela fila do pool e os XLSX voltam em bytes. Depois de
+RECICLAR conversões o processo é trocado por outro, o que limita o
+vazamento de memória do runtime.
+
+PDF longo (PAGINAS_POR_PARTE páginas ou mais por processo) é dividido em
+faixas de páginas convertidas ao mesmo tempo, uma por processo, e os XLSX
+são juntados na ordem das páginas (converter.juntar_xlsx): o tempo de
+conversão cai com o número de processos.
+
+O converter.py só importa este módulo na primeira conversão, então a
+interface sobe sem carregar o Aspose.
+"""
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import instrumentacao
+import pool_processos
+
+PROCESSOS = int(os.environ.get("CONCILIACAO_CONVERSORES", max(1, min(4, os.cpu_count() or 1))))
+RECICLAR = int(os.environ.get("CONCILIACAO_CONVERSOES_POR_PROCESSO", 50))
+LICENCA = os.environ.get("CONCILIACAO_ASPOSE_LICENCA") or None
+# Mínimo de páginas por parte ao dividir um PDF (0 = nunca divide)
+PAGINAS_POR_PARTE = int(os.environ.get("CONCILIACAO_PAGINAS_POR_PARTE", 20))
+
+_aquecendo = []
+_coordenador = ThreadPoolExecutor(thread_name_prefix="conversao")   # só espera os processos
+
+def _aquecer():
+    # Roda uma vez em cada processo novo, antes de qualquer conversão
+    import aspose.pdf as ap
+    import converter    # noqa: F401 (pandas etc. também já carregados)
+    if LICENCA:
+        ap.License().set_license(LICENCA)
+    try:
+        doc = ap.Document()
+        doc.pages.add()
+        opts = ap.ExcelSaveOptions()
+        opts.format = ap.ExcelSaveOptions.ExcelFormat.XLSX
+        doc.save(io.BytesIO(), opts)
+    except Exception:
+        pass    # o aquecimento é só otimização: a conversão real reporta o erro
+
+def _pronto():
+    return os.getpid()
+
+def _medir(funcao, instrumentar, *args):
+    # Roda no processo do serviço; os registros das etapas voltam junto
+    if instrumentar is None:
+        return funcao(*args), []
+    with instrumentacao.instrumentar(memoria=instrumentar) as coletor:
+        resultado = funcao(*args)
+    return resultado, coletor.registros
+
+def _converter(pdf_bytes, minimize_worksheets, instrumentar):
+    from converter import _converter_aspose
+    return _medir(_converter_aspose, instrumentar, pdf_bytes, minimize_worksheets)
+
+def _dividir_ou_converter(pdf_bytes, minimize_worksheets, instrumentar):
+    # PDF curto já sai convertido daqui: (None, xlsx_bytes); longo, (partes, None)
+    from converter import _dividir_ou_converter_aspose
+    return _medir(_dividir_ou_converter_aspose, instrumentar, pdf_bytes, PROCESSOS, PAGINAS_POR_PARTE,
+                  minimize_worksheets)
+
+def _juntar(partes, minimize_worksheets, instrumentar):
+    from converter import juntar_xlsx
+    return _medir(juntar_xlsx, instrumentar, partes, minimize_worksheets)
+
+def _subir(executor):
+    # Sobe e aquece todos os processos já, sem esperar o 1º PDF
+    _aquecendo[:] = [executor.submit(_pronto) for _ in range(PROCESSOS)]
+
+_pool = pool_processos.PoolProcessos(PROCESSOS, ao_criar=_subir, initializer=_aquecer,
+                                     max_tasks_per_child=RECICLAR)
+
+def iniciar(esperar=False):
+    """
+    Sobe os PROCESSOS e aquece todos (só na 1ª chamada). Com `esperar` só
+    retorna quando estiverem prontos.
+    """
+    _pool.obter()
+    if esperar:
+        for futuro in list(_aquecendo):
+            futuro.result()
+
+def encerrar():
+    _pool.descartar()
+
+def _enviar(funcao, *args):
+    try:
+        return _pool.obter().submit(funcao, *args)
+    except BrokenProcessPool:
+        _pool.descartar()
+        return _pool.obter().submit(funcao, *args)
+
+def submeter(pdf_bytes, minimize_worksheets=True, instrumentar=None):
+    """
+    Coloca a conversão na fila e devolve o Future de (xlsx_bytes, registros).
+    Com `instrumentar` (True/False = medir memória ou não) as etapas são
+    medidas nos processos do serviço e os registros voltam junto.
+    """
+    if PAGINAS_POR_PARTE <= 0 or PROCESSOS <= 1:
+        return _enviar(_converter, pdf_bytes, minimize_worksheets, instrumentar)
+    return _coordenador.submit(_converter_em_partes, pdf_bytes, minimize_worksheets, instrumentar)
+
+def _converter_em_partes(pdf_bytes, minimize_worksheets, instrumentar):
+    (partes, xlsx_bytes), registros = resultado(_enviar(_dividir_ou_converter, pdf_bytes,
+                                                        minimize_worksheets, instrumentar))
+    if partes is None:
+        return xlsx_bytes, registros
+
+    # Uma faixa de páginas por processo, todas ao mesmo tempo
+    futuros = [_enviar(_converter, parte, minimize_worksheets, instrumentar) for parte in partes]
+    convertidas = []
+    for k, futuro in enumerate(futuros):
+        xlsx_bytes, mais = resultado(futuro)
+        convertidas.append(xlsx_bytes)
+        registros += [dict(r, etapa="parte%d/%s" % (k + 1, r["etapa"])) for r in mais]
+    xlsx_bytes, mais = resultado(_enviar(_juntar, convertidas, minimize_worksheets, instrumentar))
+    return xlsx_bytes, registros + mais
+
+def resultado(futuro):
+    """xlsx_bytes e registros do Future; processo que morreu vira ConversionError."""
+    from converter import ConversionError
+    try:
+        return futuro.result()
+    except BrokenProcessPool as e:
+        _pool.descartar()
+        raise ConversionError("Processo de conversão encerrado inesperadamente: %s" % e)
+
+def converter(pdf_bytes, minimize_worksheets=True):
+    """Converte no serviço e devolve os bytes do XLSX (etapas vão para o coletor ativo)."""
+    coletor = instrumentacao.ativo()
+    xlsx_bytes, registros = resultado(submeter(pdf_bytes, minimize_worksheets,
+                                               coletor.memoria if coletor else None))
+    if coletor and registros:
+        coletor.adicionar(registros)
+    return xlsx_bytes
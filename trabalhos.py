@@ -0,0 +1,137 @@
+"""
+Conciliações em segundo plano para a interface.
+
+    trabalho = trabalhos.submeter(pdf_extrato, pdf_sistema, banco="Banco do Brasil")
+    fracao, etapa_atual = trabalho.progresso()
+    if trabalho.estado == trabalhos.CONCLUIDO:
+        planilha = trabalho.resultado
+
+Os trabalhos rodam em um pool de threads único e limitado (TRABALHOS),
+compartilhado por todas as sessões do servidor; a conversão continua nos
+processos de servico_conversao.py e o tratamento nos de processamento.py.
+Cada trabalho fica guardado pela chave das entradas (hash dos PDFs, banco
+e motor): um rerun do Streamlit, outra sessão ou a mesma submissão de novo
+recebem o mesmo trabalho, já pronto.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import conciliacao_v1 as cc
+import instrumentacao
+import layouts
+import processamento
+from converter import BACKEND_ASPOSE
+
+# Conciliações simultâneas no servidor e trabalhos terminados guardados
+TRABALHOS = int(os.environ.get("CONCILIACAO_TRABALHOS", 2))
+GUARDADOS = int(os.environ.get("CONCILIACAO_TRABALHOS_GUARDADOS", 32))
+
+NA_FILA = "na fila"
+EXECUTANDO = "executando"
+CONCLUIDO = "concluído"
+ERRO = "erro"
+
+# Etapas de 1º nível, na ordem em que terminam (base do progresso)
+ETAPAS = ["tratamento", "conciliacao_exata", "conciliacao_aproximada",
+          "conciliacao_por_soma", "somas_por_dia", "gravacao_xlsx"]
+
+class Trabalho:
+
+    def __init__(self, chave, memoria=False):
+        self.chave = chave
+        self.estado = NA_FILA
+        self.coletor = instrumentacao.Coletor(memoria=memoria)
+        self.resultado = None       # bytes do XLSX
+        self.erro = None
+        self.avisos = []            # saldo que não fecha, com validar_saldo=cc.AVISAR_SALDO
+        self.segundos = None
+
+    @property
+    def terminado(self):
+        return self.estado in (CONCLUIDO, ERRO)
+
+    def progresso(self):
+        """(fração das ETAPAS concluída, etapa em andamento ou None)."""
+        if self.estado == CONCLUIDO:
+            return 1.0, None
+        feitas = {r["etapa"] for r in list(self.coletor.registros)}
+        abertas = self.coletor.em_andamento()
+        return sum(e in feitas for e in ETAPAS) / len(ETAPAS), abertas[-1] if abertas else None
+
+_trabalhos = OrderedDict()
+_lock = threading.Lock()
+_executor = None
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=TRABALHOS, thread_name_prefix="conciliacao")
+    return _executor
+
+def chave(pdf_extrato, pdf_sistema, banco=layouts.BANCO_PADRAO, backend=BACKEND_ASPOSE,
+          reparar=False, validar_saldo=None):
+    h = hashlib.sha256()
+    for pdf_bytes in (pdf_extrato, pdf_sistema):
+        h.update(hashlib.sha256(pdf_bytes).digest())
+    h.update(("%s|%s|%d|%s" % (banco, backend, bool(reparar), validar_saldo)).encode("utf-8"))
+    return h.hexdigest()
+
+def obter(chave_trabalho):
+    with _lock:
+        return _trabalhos.get(chave_trabalho)
+
+def submeter(pdf_extrato, pdf_sistema, banco=layouts.BANCO_PADRAO, backend=BACKEND_ASPOSE,
+             memoria=False, reparar=False, validar_saldo=None):
+    """
+    Coloca a conciliação na fila e devolve o Trabalho. Se as mesmas
+    entradas já foram submetidas (e não deram erro), devolve aquele.
+    `reparar` e `validar_saldo` seguem para cc.tratar_planilha.
+    """
+    if not pdf_extrato or not pdf_sistema:
+        raise ValueError("pdf_bytes vazio.")
+    layouts.layout_extrato(banco)
+
+    k = chave(pdf_extrato, pdf_sistema, banco, backend, reparar, validar_saldo)
+    with _lock:
+        trabalho = _trabalhos.get(k)
+        if trabalho is not None and trabalho.estado != ERRO:
+            _trabalhos.move_to_end(k)
+            return trabalho
+        trabalho = _trabalhos[k] = Trabalho(k, memoria=memoria)
+        _descartar_antigos()
+        _pool().submit(_executar, trabalho, pdf_extrato, pdf_sistema, banco, backend, reparar,
+                       validar_saldo)
+    return trabalho
+
+def _descartar_antigos():
+    # Só saem trabalhos terminados, dos mais antigos para os mais novos
+    excesso = len(_trabalhos) - GUARDADOS
+    if excesso > 0:
+        for k in [k for k, t in _trabalhos.items() if t.terminado][:excesso]:
+            del _trabalhos[k]
+
+def _executar(trabalho, pdf_extrato, pdf_sistema, banco, backend, reparar, validar_saldo):
+    trabalho.estado = EXECUTANDO
+    inicio = time.perf_counter()
+    try:
+        with instrumentacao.instrumentar(coletor=trabalho.coletor):
+            entrada = len(pdf_extrato) + len(pdf_sistema)
+            with instrumentacao.etapa("tratamento", entrada=entrada) as e:
+                # Converte e trata os dois arquivos ao mesmo tempo
+                extrato, sistema = processamento.tratar_em_paralelo(
+                    pdf_extrato, pdf_sistema, backend=backend, minimize_worksheets=True,
+                    banco=banco, reparar=reparar, validar_saldo=validar_saldo)
+                e.saida = len(extrato) + len(sistema)
+            trabalho.avisos = [df.attrs[cc.AVISO_SALDO] for df in (extrato, sistema)
+                               if cc.AVISO_SALDO in df.attrs]
+            trabalho.resultado = cc.conciliar_tratados(extrato, sistema)
+        trabalho.estado = CONCLUIDO
+    except Exception as erro:
+        trabalho.erro = erro
+        trabalho.estado = ERRO
+    finally:
+        trabalho.segundos = round(time.perf_counter() - inicio, 3)